@@ -0,0 +1,116 @@
+"""
+旧システムのデータ (habit_items / habit_logs) を持つ全ユーザーの移行 (ConvertService) を一括で実行する
+
+使い方:
+    python -m app.cli.convert_all --dry-run             # 対象ユーザーの一覧のみ表示
+    python -m app.cli.convert_all --concurrency 4       # 4ユーザーずつ並行して移行
+    python -m app.cli.convert_all --email a@example.com # 指定ユーザーのみ (複数指定可)
+    python -m app.cli.convert_all --json report.json    # 結果をJSONでも保存
+
+- 新ユーザー (auth.users) が未登録のユーザーはスキップする
+- 移行済み (直近のジョブが done) のユーザーは、移行後のデータを消さないようスキップする (--force で再実行)
+- 途中で失敗・中断したユーザーは、次回の実行でコミット済みの位置から再開する
+- 同時に使うDB接続は --concurrency 個まで (コネクションプールの上限を超える値は切り詰める)
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from app.database import AsyncSessionLocal, async_engine, DB_POOL_SIZE, DB_MAX_OVERFLOW
+from app.services.convert_service import ConvertService
+
+
+async def convert_user(target: dict, semaphore: asyncio.Semaphore):
+    """
+    1ユーザー分の移行を実行し、結果を返す (semaphore で同時実行数を制限する)
+    """
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            async with AsyncSessionLocal() as db:
+                job = await ConvertService.create_job(db, target["user_id"], target["old_user_id"])
+            job = await ConvertService.run_job(job["id"]) or {**job, "status": "busy", "error": "他のプロセスが実行中"}
+        except Exception as e:
+            print(f"Error converting {target['mail']}: {e}")
+            job = {"status": "failed", "error": str(e)}
+        elapsed = time.perf_counter() - start
+
+    result = {
+        "mail": target["mail"],
+        "status": job["status"],
+        "items": job.get("items_count", 0),
+        "logs": job.get("copied_logs", 0),
+        "seconds": round(elapsed, 2),
+        "error": job.get("error"),
+    }
+    print(f"  {result['status']:<7} {result['mail']}  items={result['items']} logs={result['logs']} {result['seconds']}s")
+    return result
+
+
+def print_summary(results: list, elapsed: float):
+    done = [r for r in results if r["status"] == "done"]
+    failed = [r for r in results if r["status"] not in ("done", "skipped")]
+    skipped = [r for r in results if r["status"] == "skipped"]
+    logs = sum(r["logs"] for r in done)
+    print("")
+    print(f"完了: {len(done)} / 失敗: {len(failed)} / スキップ: {len(skipped)} (対象 {len(results)} ユーザー)")
+    print(f"移行したアイテム数: {sum(r['items'] for r in done)} 件、ログ数: {logs} 件")
+    print(f"所要時間: {elapsed:.1f} 秒 ({logs / elapsed if elapsed else 0:.0f} ログ/秒)")
+    if done:
+        slowest = max(done, key=lambda r: r["seconds"])
+        print(f"最も時間のかかったユーザー: {slowest['mail']} ({slowest['seconds']} 秒)")
+    for r in failed:
+        print(f"  失敗: {r['mail']}: {r['error']}")
+
+
+async def main(concurrency: int = 4, emails: list = None, force: bool = False, dry_run: bool = False, json_path: str = None):
+    try:
+        async with AsyncSessionLocal() as db:
+            targets = await ConvertService.list_convert_targets(db)
+        if emails:
+            targets = [t for t in targets if t["mail"] in emails]
+
+        results, runnable = [], []
+        for target in targets:
+            if target["user_id"] is None:
+                reason = "新ユーザーが未登録"
+            elif target["last_status"] == "done" and not force:
+                reason = "移行済み"
+            else:
+                runnable.append(target)
+                continue
+            results.append({"mail": target["mail"], "status": "skipped", "items": 0, "logs": 0, "seconds": 0, "error": reason})
+
+        print(f"対象: {len(runnable)} ユーザー (スキップ: {len(results)} ユーザー)")
+        for r in results:
+            print(f"  skipped {r['mail']}  ({r['error']})")
+        if dry_run:
+            for target in runnable:
+                print(f"  target  {target['mail']}  old_user_id={target['old_user_id']} last_status={target['last_status']}")
+            return
+
+        # 1ユーザーあたり同時に使う接続は1つのため、同時実行数をプールの上限までに抑える
+        concurrency = max(1, min(concurrency, DB_POOL_SIZE + DB_MAX_OVERFLOW))
+        print(f"同時実行数: {concurrency}")
+        semaphore = asyncio.Semaphore(concurrency)
+        start = time.perf_counter()
+        results += await asyncio.gather(*(convert_user(target, semaphore) for target in runnable))
+        print_summary(results, time.perf_counter() - start)
+
+        if json_path:
+            with open(json_path, "w", encoding="utf-8") as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+    finally:
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="旧システムのデータを持つ全ユーザーの移行を一括で実行する")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時に移行するユーザー数 (= 使用するDB接続数)")
+    parser.add_argument("--email", dest="emails", action="append", help="対象ユーザーのメールアドレス (複数指定可)")
+    parser.add_argument("--force", action="store_true", help="移行済みのユーザーも再実行する")
+    parser.add_argument("--dry-run", action="store_true", help="対象ユーザーの一覧のみ表示する")
+    parser.add_argument("--json", dest="json_path", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+    asyncio.run(main(args.concurrency, args.emails, args.force, args.dry_run, args.json_path))
@@ -0,0 +1,127 @@
+"""
+migrations/ 配下のSQLを番号順に適用する
+
+使い方:
+    python -m app.cli.migrate           # 未適用のマイグレーションを適用
+    python -m app.cli.migrate --status  # 適用状況を表示
+
+- ファイル名は NNNN_説明.sql とし、番号順に1回だけ適用される (schema_migrations に記録)
+- 通常は1ファイルを1トランザクションで実行する
+- 1行目に "-- migrate: no-transaction" と書いたファイルは、トランザクション外で1文ずつ実行する
+  (CREATE INDEX CONCURRENTLY など)。文の区切りは行末の ";" で判定するため、関数定義などは書かないこと
+"""
+import argparse
+import re
+from pathlib import Path
+
+from app.database import engine
+
+MIGRATIONS_DIR = Path(__file__).resolve().parents[2] / "migrations"
+NO_TRANSACTION_MARKER = "-- migrate: no-transaction"
+FILENAME_PATTERN = re.compile(r"^(\d{4})_.+\.sql$")
+
+
+def load_migrations():
+    """
+    migrations/ のSQLファイルを番号順に返す
+    戻り値: [(version, path), ...]
+    """
+    migrations = []
+    for path in sorted(MIGRATIONS_DIR.glob("*.sql")):
+        match = FILENAME_PATTERN.match(path.name)
+        if match:
+            migrations.append((match.group(1), path))
+    return migrations
+
+
+def split_statements(sql: str):
+    """
+    行末の ";" で文を区切る (コメント行は除く)
+    """
+    statements, buffer = [], []
+    for line in sql.splitlines():
+        if line.strip().startswith("--"):
+            continue
+        buffer.append(line)
+        if line.rstrip().endswith(";"):
+            statement = "\n".join(buffer).strip()
+            if statement != ";":
+                statements.append(statement)
+            buffer = []
+    if "\n".join(buffer).strip():
+        statements.append("\n".join(buffer).strip())
+    return statements
+
+
+def ensure_migrations_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version text NOT NULL PRIMARY KEY,
+            name text NOT NULL,
+            applied_at timestamp without time zone NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def applied_versions(cursor):
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def apply_migration(connection, version: str, path: Path):
+    sql = path.read_text(encoding="utf-8")
+    cursor = connection.cursor()
+    if sql.lstrip().startswith(NO_TRANSACTION_MARKER):
+        # トランザクション外で1文ずつ実行する。途中で失敗した場合も再実行できるよう IF NOT EXISTS 等で書くこと
+        connection.autocommit = True
+        try:
+            for statement in split_statements(sql):
+                cursor.execute(statement)
+            cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, path.name))
+        finally:
+            connection.autocommit = False
+    else:
+        try:
+            cursor.execute(sql)
+            cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, path.name))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+
+def main(status_only: bool = False):
+    pooled = engine.raw_connection()
+    # autocommit を切り替えるため、プールのラッパーではなくドライバの接続を直接使う
+    connection = pooled.dbapi_connection
+    try:
+        cursor = connection.cursor()
+        ensure_migrations_table(cursor)
+        connection.commit()
+        applied = applied_versions(cursor)
+        connection.commit()
+
+        pending = [(version, path) for version, path in load_migrations() if version not in applied]
+        if status_only:
+            for version, path in load_migrations():
+                mark = "applied" if version in applied else "pending"
+                print(f"{mark:8} {path.name}")
+            return
+
+        if not pending:
+            print("適用するマイグレーションはありません")
+            return
+        for version, path in pending:
+            print(f"適用中: {path.name}")
+            apply_migration(connection, version, path)
+        print(f"{len(pending)} 件のマイグレーションを適用しました")
+    finally:
+        pooled.close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="migrations/ 配下のSQLを適用する")
+    parser.add_argument("--status", action="store_true", help="適用状況のみ表示する")
+    args = parser.parse_args()
+    main(args.status)
@@ -0,0 +1,30 @@
+"""
+日別集計テーブル (hadbit_daily_counts) を hadbit_logs から作り直す
+
+使い方:
+    python -m app.cli.rebuild_daily_counts              # 全ユーザー
+    python -m app.cli.rebuild_daily_counts --user UUID  # 指定ユーザーのみ
+"""
+import argparse
+import asyncio
+
+from app.database import AsyncSessionLocal, async_engine
+from app.services.hadbit_record_service import rebuild_daily_counts
+
+
+async def main(user_id: str = None):
+    try:
+        async with AsyncSessionLocal() as db:
+            rows = await rebuild_daily_counts(db, user_id)
+            await db.commit()
+        target = user_id or "全ユーザー"
+        print(f"hadbit_daily_counts を再作成しました ({target}): {rows} 行")
+    finally:
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="hadbit_daily_counts を hadbit_logs から再作成する")
+    parser.add_argument("--user", dest="user_id", help="対象ユーザーのUUID (省略時は全ユーザー)")
+    args = parser.parse_args()
+    asyncio.run(main(args.user_id))
@@ -1,8 +1,14 @@
 import os
-from sqlalchemy import create_engine
+import time
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from dotenv import load_dotenv
 
+from app.services import metrics, query_budget, timing
+
 load_dotenv()
 
 raw_url = os.getenv("DATABASE_URL")
@@ -12,14 +18,119 @@ if raw_url and raw_url.startswith("postgres://"):
     raw_url = raw_url.replace("postgres://", "postgresql://", 1)
 
 SQLALCHEMY_DATABASE_URL = raw_url
+# アプリ本体は asyncpg ドライバの非同期エンジンを使用する
+ASYNC_DATABASE_URL = raw_url.replace("postgresql://", "postgresql+asyncpg://", 1) if raw_url else raw_url
+
+# コネクションプールの設定 (環境変数で上書き可能)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# 1文あたりのタイムアウト (ミリ秒)。0 の場合は設定しない
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+# Supabase の Pooler (transaction mode) ではプリペアドステートメントを共有できないため、既定でキャッシュを無効化する
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "0"))
+
+POOL_OPTIONS = {
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_pre_ping": DB_POOL_PRE_PING,
+}
+
+# プールの計測値 (/metrics で参照)
+POOL_CHECKOUT_WAIT = metrics.histogram("db_pool_checkout_wait_ms", "プールからの接続取得にかかった時間(ms)")
+POOL_IN_USE_AT_CHECKOUT = metrics.histogram(
+    "db_pool_in_use_at_checkout", "接続取得時点で使用中の接続数", buckets=(1, 2, 3, 5, 8, 10, 15, 20, 30, 50)
+)
+POOL_OVERFLOW_EVENTS = metrics.counter("db_pool_overflow_total", "pool_size を超えて作成された接続数")
+POOL_CHECKOUT_TIMEOUTS = metrics.counter("db_pool_checkout_timeout_total", "接続取得のタイムアウト回数")
+
+
+class InstrumentedAsyncPool(AsyncAdaptedQueuePool):
+    """
+    接続取得の待ち時間・使用中の接続数を計測するプール
+    """
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            POOL_CHECKOUT_TIMEOUTS.inc()
+            raise
+        finally:
+            POOL_CHECKOUT_WAIT.observe((time.perf_counter() - start) * 1000)
+            POOL_IN_USE_AT_CHECKOUT.observe(self.checkedout())
+
+
+def _async_connect_args():
+    connect_args = {"statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        connect_args["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+    return connect_args
+
+
+def _sync_connect_args():
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        return {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return {}
+
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# 同期エンジン: マイグレーション・バッチ・テストのデータ準備など、リクエスト外の処理用
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args=_sync_connect_args(), **POOL_OPTIONS)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+# 非同期エンジン: ルーター/サービス層から使用する
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    poolclass=InstrumentedAsyncPool,
+    connect_args=_async_connect_args(),
+    **POOL_OPTIONS,
+)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def _count_overflow(dbapi_connection, connection_record):
+    # 新規接続の作成時点で overflow が正なら、pool_size を超えた接続
+    if async_engine.pool.overflow() > 0:
+        POOL_OVERFLOW_EVENTS.inc()
+
+
+@event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+    # リクエストあたりのSQL実行数 (QUERY_BUDGET_MODE が off 以外の場合にチェック)
+    query_budget.record_statement(statement)
+
+
+@event.listens_for(async_engine.sync_engine, "after_cursor_execute")
+def _record_query_time(conn, cursor, statement, parameters, context, executemany):
+    # リクエスト単位のDB時間 (Server-Timing の db) に加算する
+    start = conn.info["query_start_time"].pop()
+    timing.add("db", (time.perf_counter() - start) * 1000)
+
+
+@event.listens_for(async_engine.sync_engine, "handle_error")
+def _discard_query_timer(exception_context):
+    # 失敗したSQLでは after_cursor_execute が呼ばれないため、開始時刻をここで取り出す
+    # (残したままにすると、次のSQLの時間が誤った開始時刻で計算される)
+    conn = exception_context.connection
+    if conn is None or exception_context.execution_context is None or not conn.info.get("query_start_time"):
+        return
+    start = conn.info["query_start_time"].pop()
+    timing.add("db", (time.perf_counter() - start) * 1000)
+
+
+metrics.gauge("db_pool_size", lambda: async_engine.pool.size(), "プールの接続数上限 (overflow を除く)")
+metrics.gauge("db_pool_checked_out", lambda: async_engine.pool.checkedout(), "現在使用中の接続数")
+metrics.gauge("db_pool_overflow", lambda: async_engine.pool.overflow(), "現在の overflow 接続数 (負の値は空き枠)")
+
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
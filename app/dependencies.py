@@ -1,14 +1,23 @@
+import gzip
+import os
 from pathlib import Path
 from fastapi import Request, Depends
+from fastapi.responses import HTMLResponse, Response
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.services.supabase_client import supabase
+from app.services.token_service import authenticate_locally, cache_user
+from app.services.mail_to_id_service import resolve_mail_id
 from app.database import get_db
+from app.services import timing
+from app.services.timing import TimedTemplate
+from app.services.fragment_cache import Fragment
 
 # テンプレートの設定 (app/templates を指すように調整)
 BASE_DIR = Path(__file__).resolve().parent
 templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
+# テンプレートの描画時間を Server-Timing (render) に計上する
+templates.env.template_class = TimedTemplate
 
 # グローバルなナビゲーションリンク定義
 # templates.env.globals に追加することで、全てのテンプレートで {{ nav_links }} が利用可能になります
@@ -20,11 +29,68 @@ NAV_LINKS = [
 ]
 templates.env.globals["nav_links"] = NAV_LINKS
 
-async def get_current_user(request: Request, db: Session = Depends(get_db)):
+# ストリーミング描画用のテンプレート環境 (ローダー・グローバル変数は templates と共有し、非同期描画を有効にする)
+# コンパイル済みテンプレートは同期用と共有できないため、キャッシュは別に持つ
+stream_templates_env = templates.env.overlay(enable_async=True, cache_size=400)
+# ストリーミング描画時に、この文字数まで溜めてからクライアントへ送る
+TEMPLATE_STREAM_CHUNK_SIZE = int(os.getenv("TEMPLATE_STREAM_CHUNK_SIZE", "16384"))
+
+
+class StreamFlush:
+    """
+    テンプレート内で {{ stream_flush() }} と書いた位置までの出力を、チャンクサイズに満たなくても即座に送らせる
+    (DBの読み込み待ちの前に、ページのヘッダー部分をブラウザへ届けるため)
+    """
+
+    def __init__(self):
+        self.requested = False
+
+    def __call__(self):
+        self.requested = True
+        return ""
+
+
+async def stream_template(name: str, context: dict):
+    """
+    テンプレートを非同期に描画しながら、TEMPLATE_STREAM_CHUNK_SIZE 単位で文字列を返す (StreamingResponse 用)
+    context の値には非同期イテレーターを渡せる (テンプレートの for で DB から読みながら描画する)
+    """
+    flush = StreamFlush()
+    template = stream_templates_env.get_template(name)
+    buffer, size = [], 0
+    async for piece in template.generate_async({**context, "stream_flush": flush}):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= TEMPLATE_STREAM_CHUNK_SIZE or flush.requested:
+            flush.requested = False
+            yield "".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+def fragment_response(request: Request, fragment: Fragment, headers: dict = None) -> Response:
+    """
+    描画済みHTML (fragment_cache) をレスポンスにする
+    gzip 圧縮済みで、クライアントが gzip を受け付ける場合は展開せずにそのまま返す
+    """
+    headers = dict(headers or {})
+    if not fragment.compressed:
+        return HTMLResponse(content=fragment.body, headers=headers)
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers.update({"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+        return Response(content=fragment.body, media_type="text/html", headers=headers)
+    return HTMLResponse(content=gzip.decompress(fragment.body), headers=headers)
+
+async def get_current_user(request: Request, db: AsyncSession = Depends(get_db)):
     """
     Cookieからアクセストークンを取得し、Supabaseでユーザー情報を取得する。
     認証失敗時は None を返す。
     """
+    # 認証にかかった時間を Server-Timing (auth) に計上する
+    with timing.timed("auth"):
+        return await _resolve_current_user(request, db)
+
+async def _resolve_current_user(request: Request, db: AsyncSession):
     access_token = request.cookies.get("access_token")
     refresh_token = request.cookies.get("refresh_token")
 
@@ -34,22 +100,30 @@ async def get_current_user(request: Request, db: Session = Depends(get_db)):
     user = None
 
     # 1. Access Token でユーザー取得を試みる
+    #    キャッシュ・ローカルJWT検証で解決できない場合のみ Supabase に問い合わせる
     if access_token:
-        try:
-            user_response = supabase.auth.get_user(access_token)
-            user = user_response.user
-        except Exception:
-            pass
+        user, needs_remote = authenticate_locally(access_token)
+        if needs_remote:
+            try:
+                with timing.timed("supabase"):
+                    user_response = supabase.auth.get_user(access_token)
+                user = user_response.user
+                if user:
+                    cache_user(access_token, user)
+            except Exception:
+                pass
 
     # 2. 失敗した場合、Refresh Token でセッション更新を試みる
     if not user and refresh_token:
         try:
-            res = supabase.auth.refresh_session(refresh_token)
+            with timing.timed("supabase"):
+                res = supabase.auth.refresh_session(refresh_token)
             if res.session:
                 user = res.session.user
                 # 新しいトークンをCookieにセットするためにstateに保存 (Middlewareで処理)
                 request.state.new_access_token = res.session.access_token
                 request.state.new_refresh_token = res.session.refresh_token
+                cache_user(res.session.access_token, user)
         except Exception as e:
             print(f"Token refresh failed: {e}")
 
@@ -57,20 +131,12 @@ async def get_current_user(request: Request, db: Session = Depends(get_db)):
         return None
 
     try:
-        if user and user.email:
-            # mail_to_id テーブルから ID を取得して user オブジェクトに付与
+        if user and user.email and "db_id" not in user.user_metadata:
+            # mail_to_id テーブルから ID を取得して user オブジェクトに付与 (なければ新規追加)
             # SupabaseのUUIDと区別するため db_id としています
-            query = text("SELECT id FROM mail_to_id WHERE mail = :mail")
-            result = db.execute(query, {"mail": user.email}).fetchone()
-            if result:
-                user.user_metadata["db_id"] = result.id
-            else:
-                # データがない場合は新規追加してIDを取得
-                insert_query = text("INSERT INTO mail_to_id (mail) VALUES (:mail) RETURNING id")
-                result = db.execute(insert_query, {"mail": user.email}).fetchone()
-                db.commit()
-                if result:
-                    user.user_metadata["db_id"] = result.id
+            db_id = await resolve_mail_id(db, user.email)
+            if db_id is not None:
+                user.user_metadata["db_id"] = db_id
         # print(
         #     f"Authenticated user: {user.email} "
         #     f"with user.user_metadata.get('db_id'): {user.user_metadata.get('db_id')}"
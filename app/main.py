@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 from pathlib import Path
 
 # 自分の親ディレクトリを sys.path に追加する
@@ -11,7 +12,8 @@ if str(base_path) not in sys.path:
 from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
 
-from app.routers import auth, hadbit_record_router, hadbit_router, hadbit_record_api, pages, system, convert_router
+from app.services import query_budget, timing
+from app.routers import auth, hadbit_record_router, hadbit_router, hadbit_record_api, hadbit_transfer_api, pages, system, convert_router
 
 
 app = FastAPI()
@@ -41,6 +43,76 @@ async def update_auth_cookies(request: Request, call_next):
         )
     return response
 
+def call_after_body(response, callback):
+    """
+    レスポンス本文の送信が終わった後に callback を呼ぶ
+    StreamingResponse (記録一覧ページなど) は本文の生成中にもSQLを実行するため、その分もチェック・ログの対象にする
+    """
+    body_iterator = getattr(response, "body_iterator", None)
+    if body_iterator is None:
+        callback()
+        return response
+
+    async def iterate():
+        async for chunk in body_iterator:
+            yield chunk
+        callback()
+
+    response.body_iterator = iterate()
+    return response
+
+@app.middleware("http")
+async def enforce_query_budget(request: Request, call_next):
+    """
+    ルートごとに宣言した SQL 実行数の予算 (@query_budget) を超えていないか、
+    同じSQLが繰り返し実行されていないか (N+1) をチェックする。開発・テスト用 (QUERY_BUDGET_MODE)
+    """
+    if not query_budget.enabled():
+        return await call_next(request)
+
+    record, token = query_budget.start_request()
+    try:
+        response = await call_next(request)
+    finally:
+        query_budget.end_request(token)
+
+    route = request.scope.get("route")
+    if route is None:
+        return response
+    # ストリーミング中のSQLも記録に含めるため、本文の送信後にチェックする
+    return call_after_body(
+        response,
+        lambda: query_budget.check(f"{request.method} {route.path}", record, request.scope.get("endpoint")),
+    )
+
+@app.middleware("http")
+async def server_timing(request: Request, call_next):
+    """
+    リクエストの処理時間の内訳 (auth / db / supabase / render) を
+    Server-Timing ヘッダーとタイミングログに出力する
+    """
+    if not timing.SERVER_TIMING_ENABLED:
+        return await call_next(request)
+
+    timings, token = timing.start_request()
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        timing.end_request(token)
+    total_ms = (time.perf_counter() - start) * 1000
+
+    # ヘッダーは本文より先に送るため、ストリーミング中の処理時間はヘッダーに含まれない (ログには含める)
+    response.headers["Server-Timing"] = timing.server_timing_header(timings, total_ms)
+    if request.url.path.startswith("/static"):
+        return response
+    return call_after_body(
+        response,
+        lambda: timing.log_request(
+            request.method, request.url.path, response.status_code, timings, (time.perf_counter() - start) * 1000
+        ),
+    )
+
 @app.get("/")
 def read_root():
     return {"message": "Hello from sub-directory!"}
@@ -53,4 +125,5 @@ app.include_router(system.router)
 app.include_router(hadbit_router.router)
 app.include_router(hadbit_record_router.router)
 app.include_router(hadbit_record_api.router)
+app.include_router(hadbit_transfer_api.router)
 app.include_router(convert_router.router)
@@ -2,6 +2,7 @@ from fastapi import APIRouter, Request, Form
 from fastapi.responses import HTMLResponse, RedirectResponse
 from app.services.supabase_client import supabase
 from app.dependencies import templates
+from app.services import timing
 
 router = APIRouter()
 
@@ -12,7 +13,8 @@ async def login(request: Request, message: str = None):
 @router.post("/login")
 async def login_submit(request: Request, email: str = Form(...), password: str = Form(...)):
     try:
-        res = supabase.auth.sign_in_with_password({"email": email, "password": password})
+        with timing.timed("supabase"):
+            res = supabase.auth.sign_in_with_password({"email": email, "password": password})
         response = RedirectResponse(url="/dashboard", status_code=303)
         response.set_cookie(key="access_token", value=res.session.access_token, httponly=True, secure=False)
         response.set_cookie(key="refresh_token", value=res.session.refresh_token, httponly=True, secure=False)
@@ -27,7 +29,8 @@ async def register_form(request: Request):
 @router.post("/register")
 async def register_submit(request: Request, email: str = Form(...), password: str = Form(...)):
     try:
-        res = supabase.auth.sign_up({"email": email, "password": password})
+        with timing.timed("supabase"):
+            res = supabase.auth.sign_up({"email": email, "password": password})
         if res.session:
             return templates.TemplateResponse("login.html", {"request": request, "message": "登録が完了しました。ログインしてください。"})
         return templates.TemplateResponse("login.html", {"request": request, "message": "登録確認メールを送信しました。メール内のリンクから登録を完了してください。"})
@@ -42,7 +45,8 @@ async def forgot_password_form(request: Request):
 @router.post("/forgot-password")
 async def forgot_password_submit(request: Request, email: str = Form(...)):
     try:
-        supabase.auth.reset_password_for_email(email)
+        with timing.timed("supabase"):
+            supabase.auth.reset_password_for_email(email)
         return templates.TemplateResponse("check_email.html", {"request": request, "email": email})
     except Exception as e:
         return templates.TemplateResponse("check_email.html", {"request": request, "email": email})
@@ -54,7 +58,8 @@ async def reset_password_form(request: Request):
 @router.post("/update-password")
 async def update_password_submit(request: Request, password: str = Form(...), token: str = Form(...)):
     try:
-        supabase.auth.update_user(attributes={"password": password}, jwt=token)
+        with timing.timed("supabase"):
+            supabase.auth.update_user(attributes={"password": password}, jwt=token)
         return RedirectResponse(url="/login?message=パスワードが正常に更新されました。新しいパスワードでログインしてください。", status_code=303)
     except Exception as e:
         error_message = "パスワードのリセットに失敗しました。リンクの有効期限が切れているか、無効なリンクです。もう一度やり直してください。"
@@ -1,6 +1,6 @@
-from fastapi import APIRouter, Request, Depends
+from fastapi import APIRouter, Request, Depends, BackgroundTasks
 from fastapi.responses import HTMLResponse
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.dependencies import get_db, get_current_user, templates
 from app.services.convert_service import ConvertService
 
@@ -10,26 +10,29 @@ router = APIRouter(
 )
 
 @router.get("/", response_class=HTMLResponse)
-async def convert_preview(request: Request, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
+async def convert_preview(request: Request, db: AsyncSession = Depends(get_db), current_user = Depends(get_current_user)):
     if not current_user:
         return templates.TemplateResponse("login.html", {"request": request, "error": "ログインが必要です"})
     
-    data = ConvertService.get_preview_data(db, current_user)
+    data = await ConvertService.get_preview_data(db, current_user)
+    # 途中で止まった移行ジョブがあれば、再開ボタンを表示する
+    job = await ConvertService.get_active_job(db, current_user.id)
     
     return templates.TemplateResponse("convert/step01.html", {
         "request": request,
         "step": "preview",
         "data": data,
+        "job": job,
         "user": current_user
     })
 
 @router.post("/confirm", response_class=HTMLResponse)
-async def convert_confirm(request: Request, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
+async def convert_confirm(request: Request, db: AsyncSession = Depends(get_db), current_user = Depends(get_current_user)):
     if not current_user:
         return templates.TemplateResponse("login.html", {"request": request, "error": "ログインが必要です"})
 
     # 確認画面でもデータを再取得して表示
-    data = ConvertService.get_preview_data(db, current_user)
+    data = await ConvertService.get_preview_data(db, current_user)
     
     return templates.TemplateResponse("convert/step01.html", {
         "request": request,
@@ -39,22 +42,44 @@ async def convert_confirm(request: Request, db: Session = Depends(get_db), curre
     })
 
 @router.post("/execute", response_class=HTMLResponse)
-async def convert_execute(request: Request, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
+async def convert_execute(request: Request, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db), current_user = Depends(get_current_user)):
+    """
+    移行ジョブを登録してバックグラウンドで実行し、進捗画面を返す
+    未完了のジョブがある場合は、そのジョブを続きから再開する
+    """
     if not current_user:
         return templates.TemplateResponse("login.html", {"request": request, "error": "ログインが必要です"})
 
     try:
-        result = ConvertService.execute_conversion(db, current_user)
-        return templates.TemplateResponse("convert/step01.html", {
-            "request": request,
-            "step": "result",
-            "result": result,
-            "user": current_user
-        })
+        job = await ConvertService.start_conversion(db, current_user)
     except Exception as e:
         return templates.TemplateResponse("convert/step01.html", {
             "request": request,
             "step": "error",
             "error": str(e),
             "user": current_user
-        })
\ No newline at end of file
+        })
+
+    background_tasks.add_task(ConvertService.run_job, job["id"])
+    return templates.TemplateResponse("convert/step01.html", {
+        "request": request,
+        "step": "progress",
+        "job": job,
+        "user": current_user
+    })
+
+@router.get("/jobs/{job_id}", response_class=HTMLResponse)
+async def convert_job_progress(request: Request, job_id: int, db: AsyncSession = Depends(get_db), current_user = Depends(get_current_user)):
+    """
+    移行ジョブの進捗 (進捗画面から htmx で定期的に取得する)
+    """
+    if not current_user:
+        return HTMLResponse(content="", status_code=401)
+
+    job = await ConvertService.get_job(db, job_id, current_user.id)
+    if not job:
+        return HTMLResponse(content="", status_code=404)
+    return templates.TemplateResponse("convert/job_progress.html", {
+        "request": request,
+        "job": job,
+    })
@@ -1,47 +1,124 @@
 from fastapi import APIRouter, Request, Depends, Form
-from fastapi.responses import HTMLResponse, JSONResponse
-from sqlalchemy.orm import Session
-from datetime import datetime, timedelta, timezone
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import date, datetime
 import json
-from app.dependencies import templates, get_current_user
+from app.dependencies import templates, get_current_user, fragment_response
 from app.database import get_db
+from app.services.query_budget import query_budget
+from app.services.data_version_service import get_view_etag, etag_matches, etag_headers, load_data_version
+from app.services.fragment_cache import Fragment, get_fragment, put_fragment
 from app.services.hadbit_record_service import (
     create_hadbit_record, 
-    get_logs, 
     delete_hadbit_record, 
     get_log, 
-    update_hadbit_record
+    update_hadbit_record,
+    get_logs_for_day,
+    get_previous_log_day,
+    get_logs_compact,
+    get_daily_counts,
+    resolve_log_period,
+    get_now_jst,
 )
 
 router = APIRouter()
 
-def get_now_jst():
-    return datetime.now(timezone(timedelta(hours=9))).replace(tzinfo=None)
+async def render_day_cards(db: AsyncSession, user_id: str, changes: list[tuple[date, bool]]) -> Fragment:
+    """
+    変更のあった日付カードだけを OOB swap 用のHTMLとして生成する
+    changes: (日付, その日に記録が追加されたか) のリスト
+    値の変わらない更新の後などデータバージョンが同じ場合は、描画済みのHTMLを返す
+    """
+    version = await load_data_version(db, user_id)
+    fragment = get_fragment(user_id, "day_cards", version, tuple(changes))
+    if fragment is not None:
+        return fragment
+
+    cards = []
+    for day, added in changes:
+        day_logs = await get_logs_for_day(db, user_id, day)
+        card = {"day": day.strftime('%Y-%m-%d'), "logs": day_logs, "swap": "replace"}
+        if not day_logs:
+            card["swap"] = "delete"
+        elif added and len(day_logs) == 1:
+            # その日の最初の記録 → 一覧に無いカードなので、直前の日付カードの前に差し込む
+            # 直前の日付カードが未読み込み (ページの範囲外) の場合、このカードも範囲外のため差し込まない (次のページで表示される)
+            # 最も古い日付の場合は、最後のページまで読み込み済みのときだけある #records-end の前に差し込む
+            prev_day = await get_previous_log_day(db, user_id, day)
+            card["swap"] = "insert"
+            card["target"] = f"beforebegin:#day-{prev_day.strftime('%Y-%m-%d')}" if prev_day else "beforebegin:#records-end"
+        cards.append(card)
+    html = templates.get_template("hadbit/partials/records_day_oob.html").render({"cards": cards})
+    return put_fragment(user_id, "day_cards", version, (tuple(changes),), html)
+
+@router.get("/api/hadbit/records/logs")
+@query_budget(3)
+async def get_logs_payload(request: Request, user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """
+    直近1年の記録を JSON で返す（カレンダー・日付グリッドのタブが共有して使う）
+    項目名は items に1回だけ持たせ、記録は列ごとの配列で返す (encode_logs_payload を参照)
+    ETag 付きのため、データに変更がなければブラウザのキャッシュが使われる
+    """
+    if not user:
+        return JSONResponse(status_code=401, content={"message": "Unauthorized"})
+
+    etag = await get_view_etag(db, user.id, "logs")
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+
+    payload = await get_logs_compact(db, user.id)
+    return JSONResponse(content=payload, headers=etag_headers(etag))
+
+@router.get("/api/hadbit/records/heatmap")
+@query_budget(3)
+async def get_heatmap_counts(
+    request: Request,
+    parent_id: int | None = None,
+    user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    ヒートマップ用の日別件数を返す（直近1年）
+    counts は start から1日ずつ並べた件数の配列（記録のない日は0）
+    """
+    if not user:
+        return JSONResponse(status_code=401, content={"message": "Unauthorized"})
+
+    etag = await get_view_etag(db, user.id, "heatmap_counts", parent_id)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+
+    start_date, end_date = resolve_log_period()
+    rows = await get_daily_counts(db, user.id, start_date, end_date, parent_id)
+
+    start = start_date.date()
+    counts = [0] * ((end_date.date() - start).days + 1)
+    for row in rows:
+        counts[(row.day - start).days] = row.count
+    return JSONResponse(content={"start": start.isoformat(), "counts": counts}, headers=etag_headers(etag))
 
 @router.post("/api/hadbit/records/create")
+@query_budget(5)
 async def save_record(
     request: Request,
     hadbit_item_id: int = Form(...),
     record_date: datetime = Form(default_factory=get_now_jst),
     memo: str = Form(""),
     user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     if not user:
         return JSONResponse(status_code=401, content={"message": "Unauthorized"})
     
-    new_record = create_hadbit_record(db, user.id, hadbit_item_id, record_date, memo)
-    db.commit()
+    new_record = await create_hadbit_record(db, user.id, hadbit_item_id, record_date, memo)
+    await db.commit()
     
     # HTMXリクエストの場合のみHTMLとToastヘッダーを返す
     if request.headers.get("HX-Request"):
-        # 全件取得してリスト全体を更新する
-        logs = get_logs(db, user.id)
+        # 登録した日の日付カードだけを再描画する
+        cards = await render_day_cards(db, user.id, [(new_record.done_at.date(), True)])
 
-        # リスト全体のHTMLを生成
-        table_html = templates.get_template("hadbit/partials/records_table.html").render({"logs": logs})
-
-        response = HTMLResponse(content=table_html)
+        response = fragment_response(request, cards)
         toast_msg = f'登録しました <span class="underline font-bold ml-2 cursor-pointer" onclick="htmx.ajax(\'GET\', \'/hadbit/records/{new_record.id}/edit\', {{target:\'#modal-container\', swap:\'innerHTML\'}})">編集</span>'
         response.headers["HX-Trigger"] = json.dumps({"toast": toast_msg})
         return response
@@ -55,33 +132,38 @@ async def save_record(
     })
 
 @router.put("/api/hadbit/records/regist/{log_id}")
+@query_budget(6)
 async def update_record(
     request: Request,
     log_id: int,
     record_date: datetime = Form(...),
     memo: str = Form(""),
     user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     if not user:
         return JSONResponse(status_code=401, content={"message": "Unauthorized"})
     
     # レコードを特定して更新
-    update_hadbit_record(db, user.id, log_id, record_date, memo)
-    db.commit()
+    updated = await update_hadbit_record(db, user.id, log_id, record_date, memo)
+    await db.commit()
         
     if request.headers.get("HX-Request"):
-        # 全件取得してリスト全体を更新する（日付変更によるグループ移動に対応するため）
-        logs = get_logs(db, user.id)
-        
-        # リスト全体のHTML (swap_all=True で id="records-list" を OOB swap)
-        table_html = templates.get_template("hadbit/partials/records_table.html").render({"logs": logs, "swap_all": True})
+        # 影響のある日付カードだけを再描画する（日付変更時は移動元・移動先の両方）
+        changes = []
+        if updated:
+            old_day, new_day = updated.old_done_at.date(), updated.done_at.date()
+            if old_day == new_day:
+                changes = [(new_day, False)]
+            else:
+                changes = [(old_day, False), (new_day, True)]
+        cards = await render_day_cards(db, user.id, changes)
         
-        response = HTMLResponse(content=table_html)
+        response = fragment_response(request, cards)
         response.headers["HX-Trigger"] = json.dumps({"toast": "保存しました。"})
         return response
 
-    updated_log = get_log(db, user.id, log_id)
+    updated_log = await get_log(db, user.id, log_id)
     return JSONResponse(content={
         "id": updated_log.id,
         "item_id": updated_log.item_id,
@@ -90,33 +172,35 @@ async def update_record(
     })
 
 @router.post("/api/hadbit/records/restore")
+@query_budget(2)
 async def restore_record(
     hadbit_item_id: int = Form(...),
     record_date: datetime = Form(default_factory=get_now_jst),
     memo: str = Form(""),
     user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     if not user:
         return JSONResponse(status_code=401, content={"message": "Unauthorized"})
     
-    create_hadbit_record(db, user.id, hadbit_item_id, record_date, memo)
-    db.commit()
+    await create_hadbit_record(db, user.id, hadbit_item_id, record_date, memo)
+    await db.commit()
     
     return HTMLResponse(content="", status_code=200)
 
 @router.delete("/api/logs/delete/{log_id}")
+@query_budget(2)
 async def delete_record(
     request: Request,
     log_id: int,
     user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     if not user:
         return JSONResponse(status_code=401, content={"message": "Unauthorized"})
     
-    deleted_record = delete_hadbit_record(db, user.id, log_id)
-    db.commit()
+    deleted_record = await delete_hadbit_record(db, user.id, log_id)
+    await db.commit()
     
     if not deleted_record:
         if request.headers.get("HX-Request"):
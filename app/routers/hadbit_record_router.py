@@ -1,20 +1,41 @@
 from fastapi import APIRouter, Request, Depends
-from fastapi.responses import HTMLResponse, RedirectResponse
-from sqlalchemy.orm import Session
-from app.dependencies import templates, get_current_user
-from app.database import get_db
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, Response
+from datetime import date, datetime
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.dependencies import templates, get_current_user, stream_template, fragment_response
+from app.database import get_db, AsyncSessionLocal
+from app.services.query_budget import query_budget
+from app.services.data_version_service import (
+    get_view_etag,
+    etag_matches,
+    etag_headers,
+    load_data_version,
+    load_data_versions,
+    make_etag,
+)
+from app.services.fragment_cache import get_fragment, put_fragment
 from app.services.hadbit_service import (
     get_hadbits,
+    get_parent_hadbit_items,
+    hadbit_parents,
 )
 from app.services.hadbit_record_service import (
-    get_logs, 
     get_log, 
+    get_logs_page,
+    get_logs_for_day,
+    LogDayStream,
+    group_logs_by_day,
 )
 
 router = APIRouter()
 
 @router.get("/hadbit/records", response_class=HTMLResponse)
-async def hadbit_records(request: Request, user = Depends(get_current_user), db: Session = Depends(get_db)):
+@query_budget(4)
+async def hadbit_records(request: Request, user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """
+    記録一覧ページ。記録はレスポンスの送信中に stream_records_page で読み込む
+    SQL実行数の予算・タイミングログには送信中の読み込みも含まれる (Server-Timing ヘッダーは送信前の分のみ)
+    """
     if user:
         print(f"hadbit_records called with user")
     else:
@@ -23,65 +44,180 @@ async def hadbit_records(request: Request, user = Depends(get_current_user), db:
     if not user:
         return RedirectResponse(url="/login")
 
+    # データに変更がなければ、前回描画したページをそのまま返す
+    version, hierarchy_version = await load_data_versions(db, user.id)
+    fragment = get_fragment(user.id, "records", version)
+    if fragment is not None:
+        return fragment_response(request, fragment)
+
     habits = []
-    logs = []
     try:
         # 習慣マスタを取得 (テーブル名: habits, カラム: id, name 等を想定)
-        habits = get_hadbits(db,user)
-        logs = get_logs(db, user.id)
+        habits = await get_hadbits(db, user, hierarchy_version)
     except Exception as e:
         print(f"Error fetching data: {e}")
 
-    return templates.TemplateResponse("hadbit/records.html", {"request": request, "user": user, "habits": habits, "logs": logs})
+    # 記録は最初の1ページ分のみ。以降はスクロールで /hadbit/records/page から追加読み込みする
+    # ページのヘッダー・絞り込みボタンを先に送り、記録はDBから読みながら日付カード単位で描画する
+    return StreamingResponse(stream_records_page(request, user, habits, version), media_type="text/html")
+
+
+async def stream_records_page(request: Request, user, habits, version):
+    """
+    記録一覧ページをストリーミング描画する (描画し終えたページはキャッシュする)
+    レスポンスの送信中は依存関係 (get_db) のセッションが閉じられているため、記録の読み込み用に別のセッションを開く
+    """
+    chunks = []
+    async with AsyncSessionLocal() as db:
+        days = LogDayStream(db, user.id)
+        # 種別の一覧は習慣マスタ (キャッシュ済み) から作る。記録のない種別も絞り込みボタンに表示する
+        async for chunk in stream_template("hadbit/records.html", {
+            "request": request,
+            "user": user,
+            "habits": habits,
+            "parents": hadbit_parents(habits),
+            "days": days,
+        }):
+            chunks.append(chunk)
+            yield chunk
+    if not days.failed:
+        put_fragment(user.id, "records", version, (), "".join(chunks))
+
+
+@router.get("/hadbit/records/page", response_class=HTMLResponse)
+@query_budget(3)
+async def get_records_page(
+    request: Request,
+    before: datetime,
+    before_id: int,
+    user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    記録一覧の次ページ (日付カード) を返す。無限スクロールから呼ばれる。
+    """
+    if not user:
+        return HTMLResponse("Unauthorized", status_code=401)
+
+    version = await load_data_version(db, user.id)
+    parts = (before.isoformat(), before_id)
+    fragment = get_fragment(user.id, "records_page", version, *parts)
+    if fragment is None:
+        logs, next_cursor = await get_logs_page(db, user.id, before, before_id)
+        html = templates.get_template("hadbit/partials/records_page.html").render({
+            "request": request,
+            "days": group_logs_by_day(logs),
+            "next_cursor": next_cursor,
+        })
+        fragment = put_fragment(user.id, "records_page", version, parts, html)
+    return fragment_response(request, fragment)
 
 
 @router.get("/hadbit/records/calendar", response_class=HTMLResponse)
-async def get_calendar_view(request: Request, user = Depends(get_current_user), db: Session = Depends(get_db)):
+@query_budget(3)
+async def get_calendar_view(request: Request, user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     if not user:
         return HTMLResponse("Unauthorized", status_code=401)
-    
-    logs = []
+
+    # データに変更がなければ描画せずに 304 を返す (タブ切り替え時の再取得用)
+    # バージョンは1回で取得し、ETag と習慣マスタのキャッシュで共用する
+    version, hierarchy_version = await load_data_versions(db, user.id)
+    etag = make_etag("calendar", version) if version is not None else None
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+
+    # 記録は /api/hadbit/records/logs からブラウザ側で取得する (タブ間で共有)。ここでは絞り込みボタンのみ描画する
+    parents = []
     try:
-        logs = get_logs(db, user.id)
+        parents = hadbit_parents(await get_hadbits(db, user, hierarchy_version))
     except Exception as e:
-        print(f"Error fetching logs for calendar: {e}")
-        
-    return templates.TemplateResponse("hadbit/partials/records_calendar.html", {"request": request, "logs": logs})
+        print(f"Error fetching parents for calendar: {e}")
+
+    return templates.TemplateResponse(
+        "hadbit/partials/records_calendar.html", {"request": request, "parents": parents}, headers=etag_headers(etag)
+    )
 
 
 @router.get("/hadbit/records/heatmap", response_class=HTMLResponse)
-async def get_heatmap_view(request: Request, user = Depends(get_current_user), db: Session = Depends(get_db)):
+@query_budget(3)
+async def get_heatmap_view(request: Request, user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     if not user:
         return HTMLResponse("Unauthorized", status_code=401)
-    
-    logs = []
+
+    etag = await get_view_etag(db, user.id, "heatmap")
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+
+    # 日別件数は /api/hadbit/records/heatmap から、日ごとの記録は /hadbit/records/day/{day} から遅延取得する
+    parents = []
     try:
-        logs = get_logs(db, user.id)
+        parents = await get_parent_hadbit_items(db, user.id)
     except Exception as e:
-        print(f"Error fetching logs for heatmap: {e}")
+        print(f"Error fetching parents for heatmap: {e}")
         
-    return templates.TemplateResponse("hadbit/partials/records_heatmap.html", {"request": request, "logs": logs})
+    return templates.TemplateResponse(
+        "hadbit/partials/records_heatmap.html", {"request": request, "parents": parents}, headers=etag_headers(etag)
+    )
+
+
+@router.get("/hadbit/records/day/{day}", response_class=HTMLResponse)
+@query_budget(3)
+async def get_day_logs_view(
+    request: Request,
+    day: date,
+    parent_id: int | None = None,
+    user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    指定日の記録行を返す（ヒートマップで選択した日の詳細表示用）
+    """
+    if not user:
+        return HTMLResponse("Unauthorized", status_code=401)
+
+    version = await load_data_version(db, user.id)
+    parts = (day, parent_id)
+    fragment = get_fragment(user.id, "records_day", version, *parts)
+    if fragment is None:
+        logs = await get_logs_for_day(db, user.id, day)
+        if parent_id:
+            logs = [log for log in logs if log.parent_item_id == parent_id]
+        html = templates.get_template("hadbit/partials/records_day_rows.html").render({"request": request, "logs": logs})
+        fragment = put_fragment(user.id, "records_day", version, parts, html)
+    return fragment_response(request, fragment)
 
 
 @router.get("/hadbit/records/dategrid", response_class=HTMLResponse)
-async def get_dategrid_view(request: Request, user = Depends(get_current_user), db: Session = Depends(get_db)):
+@query_budget(3)
+async def get_dategrid_view(request: Request, user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     if not user:
         return HTMLResponse("Unauthorized", status_code=401)
-    
-    logs = []
+
+    # データに変更がなければ描画せずに 304 を返す (タブ切り替え時の再取得用)
+    # バージョンは1回で取得し、ETag と習慣マスタのキャッシュで共用する
+    version, hierarchy_version = await load_data_versions(db, user.id)
+    etag = make_etag("dategrid", version) if version is not None else None
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+
+    # 記録は /api/hadbit/records/logs からブラウザ側で取得する (タブ間で共有)。ここでは絞り込みボタンのみ描画する
+    parents = []
     try:
-        logs = get_logs(db, user.id)
+        parents = hadbit_parents(await get_hadbits(db, user, hierarchy_version))
     except Exception as e:
-        print(f"Error fetching logs for dategrid: {e}")
-        
-    return templates.TemplateResponse("hadbit/partials/records_dategrid.html", {"request": request, "logs": logs})
+        print(f"Error fetching parents for dategrid: {e}")
+
+    return templates.TemplateResponse(
+        "hadbit/partials/records_dategrid.html", {"request": request, "parents": parents}, headers=etag_headers(etag)
+    )
 
 
 @router.get("/hadbit/records/{id}/edit", response_class=HTMLResponse)
-async def record_edit_view(request: Request, id: int, user = Depends(get_current_user), db: Session = Depends(get_db)):
+@query_budget(2)
+async def record_edit_view(request: Request, id: int, user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     if not user:
         return RedirectResponse(url="/login")
-    log = get_log(db, user.id, id)
+    log = await get_log(db, user.id, id)
     return templates.TemplateResponse("hadbit/partials/record_edit_modal.html", {"request": request, "user": user, "log": log})
 
 # d:\work\dev\fastapi\hadbit-fastapi\app\routers\hadbit_router.py
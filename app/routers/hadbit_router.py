@@ -1,9 +1,12 @@
+from typing import List
 from fastapi import APIRouter, Request, Depends, Form
 from fastapi.responses import HTMLResponse, RedirectResponse
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.dependencies import templates, get_current_user
 from app.database import get_db
+from app.services.query_budget import query_budget
 from app.services.post_service import get_recent_posts
+from app.services.analytics_service import get_analytics
 from app.services.hadbit_service import (
     get_hadbits,
     get_parent_hadbit_items,
@@ -15,7 +18,10 @@ from app.services.hadbit_service import (
     delete_hadbit_item,
     restore_hadbit_item,
     move_hadbit_item_up,
-    move_hadbit_item_down
+    move_hadbit_item_down,
+    move_hadbit_item,
+    update_hadbit_tree_order,
+    ORDER_GAP
 )
 
 router = APIRouter()
@@ -35,7 +41,7 @@ async def settings(request: Request, user = Depends(get_current_user)):
     return templates.TemplateResponse("settings.html", {"request": request, "user": user})
 
 @router.get("/test_supabase", response_class=HTMLResponse)
-async def test_supabase(request: Request, user = Depends(get_current_user), db: Session = Depends(get_db)):
+async def test_supabase(request: Request, user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     if not user:
         return RedirectResponse(url="/login")
 
@@ -43,7 +49,7 @@ async def test_supabase(request: Request, user = Depends(get_current_user), db:
     error_msg = None
     try:
         # サービス層経由でデータを取得
-        posts = get_recent_posts(db)
+        posts = await get_recent_posts(db)
     except Exception as e:
         error_msg = f"データ取得エラー: {str(e)}"
 
@@ -51,26 +57,28 @@ async def test_supabase(request: Request, user = Depends(get_current_user), db:
 
 
 @router.get("/hadbit/items", response_class=HTMLResponse)
+@query_budget(3)
 async def hadbit_settings(request: Request, 
     user = Depends(get_current_user), 
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
     ):
     if not user:
         return RedirectResponse(url="/login")
     habits = []
     try:
         # 習慣マスタを取得 (テーブル名: habits, カラム: id, name 等を想定)
-        habits = get_hadbits(db,user)
+        habits = await get_hadbits(db,user)
     except Exception as e:
         print(f"Error fetching habits: {e}")
 
     return templates.TemplateResponse("hadbit/items.html", {"request": request, "user": user, "habits": habits})
 
 @router.post("/hadbit/items/new", response_class=HTMLResponse)
+@query_budget(8)
 async def create_new_habit_type(
     request: Request,
     user = Depends(get_current_user), 
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     「種別追加」ボタン押下時の処理
@@ -78,26 +86,26 @@ async def create_new_habit_type(
     """
     # 1. 並び順の最大値を取得して、末尾に追加するための値を決定
     # (parent_sort_order の最大値を取得し、+1 する)
-    max_sort = get_hadbit_tree_max_sort_order(db, user.id, 0)
-    new_sort_order = (max_sort or 0) + 1
+    max_sort = await get_hadbit_tree_max_sort_order(db, user.id, 0)
+    new_sort_order = (max_sort or 0) + ORDER_GAP
 
     # 親アイテム作成 (新規種別)
-    parent_item_id = create_hadbit_item(db, user.id, "新規種別", "新規種別", "新しい種別です")
+    parent_item_id = await create_hadbit_item(db, user.id, "新規種別", "新規種別", "新しい種別です")
     
     # 親ツリー作成
-    create_hadbit_tree(db, parent_item_id, user.id, 0, new_sort_order)
+    await create_hadbit_tree(db, parent_item_id, user.id, 0, new_sort_order)
 
     # 子アイテム作成 (新規項目)
-    child_item_id = create_hadbit_item(db, user.id, "新規項目", "新規項目", "新しい項目です")
+    child_item_id = await create_hadbit_item(db, user.id, "新規項目", "新規項目", "新しい項目です")
 
     # 子ツリー作成
-    create_hadbit_tree(db, child_item_id, user.id, parent_item_id, 1)
+    await create_hadbit_tree(db, child_item_id, user.id, parent_item_id, ORDER_GAP)
 
-    db.commit()
+    await db.commit()
 
     # 3. 最新のリストを取得
     # 一覧画面表示時と同じクエリで全データを取得し直します
-    habits = get_hadbits(db, user)
+    habits = await get_hadbits(db, user)
 
     # 4. 画面全体をレンダリングして返却
     # hx-target="body" なので、ページ全体のHTMLを返します
@@ -108,25 +116,26 @@ async def create_new_habit_type(
     })
 
 @router.post("/hadbit/items/{parent_id}/new_child", response_class=HTMLResponse)
+@query_budget(6)
 async def create_new_child_item(
     request: Request,
     parent_id: int,
     user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     指定された種別（parent_id）の中に新しい項目を追加する
     """
     # 指定された親配下での最大並び順を取得
-    max_sort = get_hadbit_tree_max_sort_order(db, user.id, parent_id)
-    new_sort_order = (max_sort or 0) + 1
+    max_sort = await get_hadbit_tree_max_sort_order(db, user.id, parent_id)
+    new_sort_order = (max_sort or 0) + ORDER_GAP
 
-    child_item_id = create_hadbit_item(db, user.id, "新規項目", "新規項目", "新しい項目です")
-    create_hadbit_tree(db, child_item_id, user.id, parent_id, new_sort_order)
+    child_item_id = await create_hadbit_item(db, user.id, "新規項目", "新規項目", "新しい項目です")
+    await create_hadbit_tree(db, child_item_id, user.id, parent_id, new_sort_order)
     
-    db.commit()
+    await db.commit()
 
-    habits = get_hadbits(db, user)
+    habits = await get_hadbits(db, user)
     return templates.TemplateResponse("hadbit/items.html", {
         "request": request,
         "user": user,
@@ -134,20 +143,21 @@ async def create_new_child_item(
     })
 
 @router.get("/hadbit/items/{id}/edit", response_class=HTMLResponse)
+@query_budget(3)
 async def get_item_edit_form(
     request: Request,
     id: int,
     user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     編集ボタン押下時：右側の編集エリアに表示するフォームを返す
     """
-    item = get_hadbit_item(db, id, user.id)
+    item = await get_hadbit_item(db, id, user.id)
     if not item:
         return HTMLResponse("<div>対象のデータが見つかりません。</div>")
 
-    parents = get_parent_hadbit_items(db, user.id)
+    parents = await get_parent_hadbit_items(db, user.id)
     return templates.TemplateResponse("hadbit/item_edit_form.html", {
         "request": request,
         "item": item,
@@ -155,6 +165,7 @@ async def get_item_edit_form(
     })
 
 @router.put("/hadbit/items/{id}", response_class=HTMLResponse)
+@query_budget(7)
 async def update_habit_item_endpoint(
     request: Request,
     id: int,
@@ -163,17 +174,17 @@ async def update_habit_item_endpoint(
     description: str = Form(None),
     parent_id: int = Form(None),
     user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     項目編集フォームの保存処理
     """
     # Noneの場合は空文字として扱う
-    update_hadbit_item(db, id, user.id, name, short_name or "", description or "", parent_id)
-    db.commit()
+    await update_hadbit_item(db, id, user.id, name, short_name or "", description or "", parent_id)
+    await db.commit()
 
     # 更新後のリストを取得して画面全体を再描画
-    habits = get_hadbits(db, user)
+    habits = await get_hadbits(db, user)
     return templates.TemplateResponse("hadbit/items.html", {
         "request": request,
         "user": user,
@@ -181,6 +192,7 @@ async def update_habit_item_endpoint(
     })
     
 @router.put("/hadbit/items/{id}", response_class=HTMLResponse)
+@query_budget(7)
 async def update_habit_item_endpoint(
     request: Request,
     id: int,
@@ -189,17 +201,17 @@ async def update_habit_item_endpoint(
     description: str = Form(None),  # 任意項目
     parent_id: int = Form(None),    # 任意項目（親カテゴリの移動用）
     user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     項目編集フォームの保存処理
     """
     # Noneの場合は空文字として扱うなどの前処理を行い、サービス層へ渡す
-    update_hadbit_item(db, id, user.id, name, short_name or "", description or "", parent_id)
-    db.commit()
+    await update_hadbit_item(db, id, user.id, name, short_name or "", description or "", parent_id)
+    await db.commit()
 
     # 更新後のリストを取得して画面全体を再描画
-    habits = get_hadbits(db, user)
+    habits = await get_hadbits(db, user)
     return templates.TemplateResponse("hadbit/items.html", {
         "request": request,
         "user": user,
@@ -207,19 +219,20 @@ async def update_habit_item_endpoint(
     })
 
 @router.delete("/hadbit/items/{id}", response_class=HTMLResponse)
+@query_budget(4)
 async def delete_item(
     request: Request,
     id: int,
     user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     項目の削除（論理削除）
     """
-    delete_hadbit_item(db, id, user.id)
-    db.commit()
+    await delete_hadbit_item(db, id, user.id)
+    await db.commit()
 
-    habits = get_hadbits(db, user)
+    habits = await get_hadbits(db, user)
     return templates.TemplateResponse("hadbit/items.html", {
         "request": request,
         "user": user,
@@ -228,19 +241,20 @@ async def delete_item(
     })
 
 @router.post("/hadbit/items/{id}/restore", response_class=HTMLResponse)
+@query_budget(4)
 async def restore_item(
     request: Request,
     id: int,
     user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     削除の取り消し
     """
-    restore_hadbit_item(db, id, user.id)
-    db.commit()
+    await restore_hadbit_item(db, id, user.id)
+    await db.commit()
 
-    habits = get_hadbits(db, user)
+    habits = await get_hadbits(db, user)
     return templates.TemplateResponse("hadbit/items.html", {
         "request": request,
         "user": user,
@@ -250,20 +264,21 @@ async def restore_item(
 
 
 @router.post("/hadbit/items/{id}/move_up", response_class=HTMLResponse)
+@query_budget(4)
 async def move_item_up(
     request: Request,
     id: int,
     user = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """
     指定されたアイテムを一つ上に移動（sort_orderを入れ替え）
     """
-    move_hadbit_item_up(db, user.id, id)
-    db.commit()
+    await move_hadbit_item_up(db, user.id, id)
+    await db.commit()
 
     # 4. 画面全体を再描画
-    habits = get_hadbits(db, user)
+    habits = await get_hadbits(db, user)
     return templates.TemplateResponse("hadbit/items.html", {
         "request": request,
         "user": user,
@@ -272,20 +287,69 @@ async def move_item_up(
 
 
 @router.post("/hadbit/items/{id}/move_down", response_class=HTMLResponse)
+@query_budget(4)
 async def move_item_down(
     request: Request,
     id: int,
     user = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """
     指定されたアイテムを一つ下に移動（sort_orderを入れ替え）
     """
-    move_hadbit_item_down(db, user.id, id)
-    db.commit()
+    await move_hadbit_item_down(db, user.id, id)
+    await db.commit()
 
     # 4. 画面全体を再描画
-    habits = get_hadbits(db, user)
+    habits = await get_hadbits(db, user)
+    return templates.TemplateResponse("hadbit/items.html", {
+        "request": request,
+        "user": user,
+        "habits": habits
+    })
+
+
+@router.post("/hadbit/items/{parent_id}/order", response_class=HTMLResponse)
+@query_budget(4)
+async def reorder_items(
+    request: Request,
+    parent_id: int,
+    item_id: List[int] = Form(...),
+    user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    parent_id 配下の並び順を一括で保存する (並び順全体をまとめて適用する場合用)
+    parent_id 配下の項目IDを、新しい並び順で item_id として複数送信する (種別の並び替えは parent_id=0)
+    ドラッグ&ドロップによる1件の移動は /hadbit/items/{id}/move を使う
+    """
+    await update_hadbit_tree_order(db, user.id, item_id, parent_id)
+    await db.commit()
+
+    habits = await get_hadbits(db, user)
+    return templates.TemplateResponse("hadbit/items.html", {
+        "request": request,
+        "user": user,
+        "habits": habits
+    })
+
+
+@router.post("/hadbit/items/{id}/move", response_class=HTMLResponse)
+@query_budget(4)
+async def move_item(
+    request: Request,
+    id: int,
+    position: int = Form(...),
+    user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    ドラッグ&ドロップで移動したアイテムを、同じ親の中の position (0始まり) に移動する
+    """
+    await move_hadbit_item(db, user.id, id, position=position)
+    await db.commit()
+
+    habits = await get_hadbits(db, user)
     return templates.TemplateResponse("hadbit/items.html", {
         "request": request,
         "user": user,
@@ -294,9 +358,21 @@ async def move_item_down(
 
 
 @router.get("/hadbit/analytics", response_class=HTMLResponse)
-async def hadbit_analytics(request: Request, user = Depends(get_current_user)):
+@query_budget(4)
+async def hadbit_analytics(request: Request, user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """
+    統計画面 (連続日数・週/月ごとの実施率・曜日/時間帯ごとの記録数・種別ごとの集計)
+    集計結果はデータバージョンごとにキャッシュされるため、記録に変更がなければ再計算しない
+    """
     if not user:
         return RedirectResponse(url="/login")
-    return templates.TemplateResponse("hadbit_analytics.html", {"request": request, "user": user})
+
+    analytics = None
+    try:
+        analytics = await get_analytics(db, user)
+    except Exception as e:
+        print(f"Error computing analytics: {e}")
+
+    return templates.TemplateResponse("hadbit/analytics.html", {"request": request, "user": user, "analytics": analytics})
 
 
@@ -0,0 +1,80 @@
+from fastapi import APIRouter, Request, Depends, UploadFile, File, Form
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.dependencies import templates, get_current_user
+from app.database import get_db, AsyncSessionLocal
+from app.services.query_budget import query_budget
+from app.services.hadbit_transfer_service import stream_export, import_logs
+from app.services.hadbit_record_service import get_today_jst
+
+router = APIRouter()
+
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson; charset=utf-8",
+}
+
+
+async def stream_export_response(user_id: str, fmt: str):
+    """
+    エクスポートをストリーミングで返す
+    レスポンスの送信中は依存関係 (get_db) のセッションが閉じられているため、読み込み用に別のセッションを開く
+    """
+    async with AsyncSessionLocal() as db:
+        async for chunk in stream_export(db, user_id, fmt):
+            yield chunk
+
+
+@router.get("/api/hadbit/export")
+@query_budget(1)
+async def export_hadbit_logs(request: Request, format: str = "csv", user = Depends(get_current_user)):
+    """
+    記録をすべて CSV / NDJSON でダウンロードする
+    サーバーサイドカーソルで一定件数ずつ読みながら送るため、記録の件数によらずメモリ使用量は一定
+    """
+    if not user:
+        return JSONResponse(status_code=401, content={"message": "Unauthorized"})
+    if format not in EXPORT_MEDIA_TYPES:
+        return JSONResponse(status_code=400, content={"message": "format は csv または ndjson を指定してください"})
+    filename = f"hadbit_logs_{get_today_jst().strftime('%Y%m%d')}.{format}"
+    return StreamingResponse(
+        stream_export_response(user.id, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@router.post("/api/hadbit/import")
+@query_budget(6)
+async def import_hadbit_logs(
+    request: Request,
+    file: UploadFile = File(...),
+    format: str = Form(None),
+    user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    CSV / NDJSON の記録を一括登録する (形式は format、省略時はファイルの拡張子で判定)
+    未登録の項目 (親項目名・項目名) は自動で作成する
+    HTMXリクエストの場合は結果をHTMLで返す (設定画面のインポートフォーム用)
+    """
+    if not user:
+        return JSONResponse(status_code=401, content={"message": "Unauthorized"})
+    fmt = format or ("ndjson" if (file.filename or "").lower().endswith((".ndjson", ".jsonl")) else "csv")
+    result, error = None, None
+    if fmt not in EXPORT_MEDIA_TYPES:
+        error = "format は csv または ndjson を指定してください"
+    else:
+        try:
+            result = await import_logs(db, user.id, file.file, fmt)
+            await db.commit()
+        except Exception as e:
+            print(f"Error importing logs: {e}")
+            await db.rollback()
+            error = "インポートに失敗しました。ファイルの形式を確認してください"
+
+    if request.headers.get("HX-Request"):
+        return templates.TemplateResponse("hadbit/partials/import_result.html", {"request": request, "result": result, "error": error})
+    if error:
+        return JSONResponse(status_code=400, content={"message": error})
+    return JSONResponse(result)
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Request, Depends
 from fastapi.responses import HTMLResponse, RedirectResponse
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.dependencies import templates, get_current_user
 from app.database import get_db
 from app.services.post_service import get_recent_posts
@@ -22,7 +22,7 @@ async def settings(request: Request, user = Depends(get_current_user)):
     return templates.TemplateResponse("settings.html", {"request": request, "user": user})
 
 @router.get("/test_supabase", response_class=HTMLResponse)
-async def test_supabase(request: Request, user = Depends(get_current_user), db: Session = Depends(get_db)):
+async def test_supabase(request: Request, user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     if not user:
         return RedirectResponse(url="/login")
 
@@ -30,7 +30,7 @@ async def test_supabase(request: Request, user = Depends(get_current_user), db:
     error_msg = None
     try:
         # サービス層経由でデータを取得
-        posts = get_recent_posts(db)
+        posts = await get_recent_posts(db)
     except Exception as e:
         error_msg = f"データ取得エラー: {str(e)}"
 
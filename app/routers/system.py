@@ -1,16 +1,23 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+import hmac
+import os
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import JSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
 from app.database import get_db
+from app.services import metrics
 
 router = APIRouter()
 
+# /metrics の参照用トークン。未設定の場合は /metrics を公開しない (404)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
 @router.get("/db-test")
-def test_db_connection(db: Session = Depends(get_db)):
+async def test_db_connection(db: AsyncSession = Depends(get_db)):
     try:
         # zst_post テーブルから最新10件を取得するクエリ
         query = text("SELECT * FROM zst_post order by update_at desc LIMIT 10")
-        result = db.execute(query)
+        result = await db.execute(query)
         
         posts = [dict(row._mapping) for row in result]
         
@@ -23,4 +30,17 @@ def test_db_connection(db: Session = Depends(get_db)):
         return {
             "status": "error",
             "message": f"エラーが発生しました: {str(e)}"
-        }
\ No newline at end of file
+        }
+
+@router.get("/metrics")
+def get_metrics(request: Request):
+    """
+    プロセス内で集計しているメトリクス (DBプール等) を返す
+    METRICS_TOKEN を設定した場合のみ有効で、Authorization: Bearer <METRICS_TOKEN> ヘッダーが必要
+    """
+    if not METRICS_TOKEN:
+        return JSONResponse(status_code=404, content={"message": "Not Found"})
+    token = request.headers.get("authorization", "").removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(token.encode("utf-8"), METRICS_TOKEN.encode("utf-8")):
+        return JSONResponse(status_code=401, content={"message": "Unauthorized"})
+    return metrics.snapshot()
@@ -0,0 +1,198 @@
+import os
+from datetime import date, timedelta
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import text
+
+from app.services import metrics
+from app.services.cache import LRUCache
+from app.services.data_version_service import load_data_versions
+from app.services.hadbit_service import get_hadbits, hadbit_parents
+from app.services.hadbit_record_service import get_today_jst
+
+# 集計結果のキャッシュ。キーは (user_id, データバージョン, 当日 (日本時間))。記録・マスタが変わるか日付が変わると別のキーになる
+_analytics_cache = LRUCache(
+    maxsize=int(os.getenv("ANALYTICS_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("ANALYTICS_CACHE_TTL", "3600")),
+)
+ANALYTICS_CACHE_HITS = metrics.counter("analytics_cache_hits_total", "統計画面の集計結果のキャッシュヒット数")
+ANALYTICS_CACHE_MISSES = metrics.counter("analytics_cache_misses_total", "統計画面の集計結果のキャッシュミス数")
+
+# 週ごと・月ごとの実施率を表示する期間
+ANALYTICS_WEEKS = 12
+ANALYTICS_MONTHS = 12
+WEEKDAY_LABELS = ["月", "火", "水", "木", "金", "土", "日"]
+
+DAY_SECONDS = 86400
+# 1970-01-01 (エポック日 0) は木曜日 (月曜日 = 0 として 3)
+EPOCH_WEEKDAY = 3
+
+
+async def load_log_times(db: AsyncSession, user_id: str):
+    """
+    ユーザーの全記録の実施日時 (エポック秒) と項目IDを、それぞれ1つの配列として取得する
+    done_at はタイムゾーンなしの日時をそのまま UTC とみなしたエポック秒 (日本時間の壁時計の時刻を保つ)
+    EXTRACT は numeric で計算するため件数が多いと遅い。double precision を返す date_part を使う
+    戻り値: (times: int64 配列, item_ids: int64 配列)
+    """
+    sql = text("""
+        SELECT
+            COALESCE(array_agg(CAST(floor(date_part('epoch', done_at)) AS bigint)), '{}') AS times,
+            COALESCE(array_agg(item_id), '{}') AS item_ids
+        FROM hadbit_logs
+        WHERE user_id = :user_id AND done_at IS NOT NULL
+    """)
+    row = (await db.execute(sql, {"user_id": user_id})).fetchone()
+    return np.array(row.times, dtype=np.int64), np.array(row.item_ids, dtype=np.int64)
+
+
+def grouped_streaks(groups: np.ndarray, days: np.ndarray, group_count: int, today: int):
+    """
+    グループ (親項目) ごとの連続実施日数を求める
+    groups / days: 記録ごとのグループ番号とエポック日 (重複・順不同でよい)
+    当日または前日まで続いている連続日数を現在の連続日数とする (当日分が未実施でも途切れていない扱い)
+    戻り値: (current: グループごとの現在の連続日数, longest: グループごとの最長連続日数)
+    """
+    current = np.zeros(group_count, dtype=np.int64)
+    longest = np.zeros(group_count, dtype=np.int64)
+    if len(days) == 0:
+        return current, longest
+
+    # (グループ, 日) の組を重複なく並べ、グループが変わるか日が連続しない位置で区切る
+    keys = np.unique(groups.astype(np.int64) << 32 | (days.astype(np.int64) & 0xFFFFFFFF))
+    key_groups = keys >> 32
+    key_days = keys & 0xFFFFFFFF
+    starts = np.ones(len(keys), dtype=bool)
+    starts[1:] = (np.diff(key_groups) != 0) | (np.diff(key_days) != 1)
+
+    start_index = np.flatnonzero(starts)
+    end_index = np.append(start_index[1:], len(keys)) - 1
+    run_lengths = end_index - start_index + 1
+    run_groups = key_groups[start_index]
+
+    np.maximum.at(longest, run_groups, run_lengths)
+    alive = key_days[end_index] >= today - 1
+    current[run_groups[alive]] = run_lengths[alive]
+    return current, longest
+
+
+def compute_analytics(times: np.ndarray, item_ids: np.ndarray, hadbits: list, today: date):
+    """
+    記録の配列から統計画面の集計をまとめて求める (記録ごとの Python のループは使わない)
+    hadbits: get_hadbits の結果 (子項目 → 親項目の対応と、親項目の並び順に使う)
+    戻り値: 連続日数・週/月ごとの実施率・曜日/時間帯ごとの件数・親項目ごとの集計の dict
+    """
+    today_day = (today - date(1970, 1, 1)).days
+    days = times // DAY_SECONDS
+    active_days = np.unique(days)
+
+    # 全体の連続日数 (グループ 0 のみとして計算する)
+    current, longest = grouped_streaks(np.zeros(len(days), dtype=np.int64), days, 1, today_day)
+
+    # 週ごとの実施率 (月曜始まり。今週は今日までの日数で割る)
+    this_week = today_day - (today_day + EPOCH_WEEKDAY) % 7
+    first_week = this_week - 7 * (ANALYTICS_WEEKS - 1)
+    in_weeks = active_days[(active_days >= first_week) & (active_days <= today_day)]
+    week_counts = np.bincount((in_weeks - first_week) // 7, minlength=ANALYTICS_WEEKS)
+    week_lengths = np.full(ANALYTICS_WEEKS, 7)
+    week_lengths[-1] = today_day - this_week + 1
+    weekly = [
+        {
+            "label": (date(1970, 1, 1) + timedelta(days=int(first_week + 7 * i))).strftime("%m/%d"),
+            "active_days": int(week_counts[i]),
+            "days": int(week_lengths[i]),
+            "rate": round(float(week_counts[i] / week_lengths[i]) * 100),
+        }
+        for i in range(ANALYTICS_WEEKS)
+    ]
+
+    # 月ごとの実施率 (今月は今日までの日数で割る)
+    this_month = np.datetime64(today, "M")
+    months = np.arange(this_month - (ANALYTICS_MONTHS - 1), this_month + 1)
+    month_first_days = months.astype("datetime64[D]").astype(np.int64)
+    month_lengths = (months + 1).astype("datetime64[D]").astype(np.int64) - month_first_days
+    month_lengths[-1] = today_day - month_first_days[-1] + 1
+    in_months = active_days[(active_days >= month_first_days[0]) & (active_days <= today_day)]
+    month_counts = np.bincount(np.searchsorted(month_first_days, in_months, side="right") - 1, minlength=ANALYTICS_MONTHS)
+    monthly = [
+        {
+            "label": str(months[i]),
+            "active_days": int(month_counts[i]),
+            "days": int(month_lengths[i]),
+            "rate": round(float(month_counts[i] / month_lengths[i]) * 100),
+        }
+        for i in range(ANALYTICS_MONTHS)
+    ]
+
+    # 曜日・時間帯ごとの件数
+    weekday_counts = np.bincount((days + EPOCH_WEEKDAY) % 7, minlength=7)
+    hour_counts = np.bincount((times % DAY_SECONDS) // 3600, minlength=24)
+
+    # 親項目ごとの集計 (子項目IDを親項目の番号に変換し、対応のない記録は除く)
+    parents = hadbit_parents(hadbits)
+    parent_index = {parent["id"]: i for i, parent in enumerate(parents)}
+    child_ids = np.array([hadbit["child_id"] for hadbit in hadbits], dtype=np.int64)
+    child_parents = np.array([parent_index[hadbit["parent_id"]] for hadbit in hadbits], dtype=np.int64)
+    order = np.argsort(child_ids)
+    child_ids, child_parents = child_ids[order], child_parents[order]
+    if len(child_ids):
+        position = np.minimum(np.searchsorted(child_ids, item_ids), len(child_ids) - 1)
+        matched = child_ids[position] == item_ids
+        log_parents = child_parents[position[matched]]
+    else:
+        matched = np.zeros(len(item_ids), dtype=bool)
+        log_parents = np.zeros(0, dtype=np.int64)
+    parent_days = days[matched]
+
+    parent_totals = np.bincount(log_parents, minlength=len(parents))
+    parent_recent = np.bincount(log_parents[parent_days > today_day - 30], minlength=len(parents))
+    parent_active = np.bincount(np.unique(log_parents << 32 | parent_days) >> 32, minlength=len(parents))
+    parent_current, parent_longest = grouped_streaks(log_parents, parent_days, len(parents), today_day)
+    by_parent = [
+        {
+            "name": parent["name"],
+            "total": int(parent_totals[i]),
+            "active_days": int(parent_active[i]),
+            "recent_30": int(parent_recent[i]),
+            "current_streak": int(parent_current[i]),
+            "longest_streak": int(parent_longest[i]),
+        }
+        for i, parent in enumerate(parents)
+    ]
+
+    first_day = date(1970, 1, 1) + timedelta(days=int(active_days[0])) if len(active_days) else None
+    return {
+        "total_logs": int(len(times)),
+        "active_days": int(len(active_days)),
+        "first_day": first_day,
+        "current_streak": int(current[0]),
+        "longest_streak": int(longest[0]),
+        "weekly": weekly,
+        "monthly": monthly,
+        "weekdays": [{"label": label, "count": int(count)} for label, count in zip(WEEKDAY_LABELS, weekday_counts)],
+        "hours": [{"label": hour, "count": int(count)} for hour, count in enumerate(hour_counts)],
+        "by_parent": by_parent,
+    }
+
+
+async def get_analytics(db: AsyncSession, user):
+    """
+    統計画面の集計を取得する。結果はデータバージョン・日付ごとにキャッシュする
+    記録の日時は日本時間のため、当日もサーバーのタイムゾーンではなく日本時間で決める
+    """
+    today = get_today_jst()
+    version, hierarchy_version = await load_data_versions(db, user.id)
+    cache_key = (str(user.id), version, today)
+    if version is not None:
+        cached = _analytics_cache.get(cache_key)
+        if cached is not None:
+            ANALYTICS_CACHE_HITS.inc()
+            return cached
+    ANALYTICS_CACHE_MISSES.inc()
+
+    hadbits = await get_hadbits(db, user, hierarchy_version)
+    times, item_ids = await load_log_times(db, user.id)
+    analytics = compute_analytics(times, item_ids, hadbits, today)
+    if version is not None:
+        _analytics_cache.set(cache_key, analytics)
+    return analytics
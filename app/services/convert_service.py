@@ -1,29 +1,54 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import text
+import os
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import text, bindparam
+from app.database import AsyncSessionLocal
+from app.services.mail_to_id_service import find_mail_id
+from app.services.hadbit_record_service import rebuild_daily_counts
+from app.services.hadbit_service import invalidate_hierarchy
+from app.services.fragment_cache import invalidate_fragments
+
+# 記録の移行・既存記録の削除を、この件数ごとにコミットする (1回のロック時間を短くし、失敗時はコミット済みの位置から再開する)
+CONVERT_CHUNK_SIZE = int(os.getenv("CONVERT_CHUNK_SIZE", "5000"))
+# running のまま更新がこの秒数を超えたジョブは、実行していたプロセスが停止したものとみなして再開できるようにする
+CONVERT_STALE_SECONDS = int(os.getenv("CONVERT_STALE_SECONDS", "120"))
+
+# 実行中・再開待ちのジョブの状態
+ACTIVE_JOB_STATUSES = ("pending", "running", "failed")
+
+
+class ConvertJobBusy(Exception):
+    """
+    他のプロセスが同じ移行ジョブのフェーズを実行中 (アドバイザリロックを取得できない)
+    """
 
 class ConvertService:
     @staticmethod
-    def get_preview_data(db: Session, user):
+    async def get_old_user_id(db: AsyncSession, user):
+        """
+        旧ユーザーIDを取得する (get_current_user で解決済みの db_id、なければ mail_to_id テーブル)
+        """
+        return user.user_metadata.get("db_id") or await find_mail_id(db, user.email)
+
+    @staticmethod
+    async def get_preview_data(db: AsyncSession, user):
         """
         移行前のプレビュー情報を取得する
         """
-        # 1. Old User ID の取得 (mail_to_id テーブル)
-        query = text("SELECT id FROM mail_to_id WHERE mail = :email")
-        result = db.execute(query, {"email": user.email}).fetchone()
-        
-        if not result:
+        # 1. Old User ID の取得
+        old_user_id = await ConvertService.get_old_user_id(db, user)
+
+        if not old_user_id:
             return {"error": f"旧ユーザーIDが見つかりません: {user.email}"}
-        
-        old_user_id = result.id
+
         new_user_uuid = user.id
 
         # 2. 旧データの件数取得
-        old_items_count = db.execute(text("SELECT COUNT(*) FROM habit_items WHERE user_id = :uid"), {"uid": old_user_id}).scalar()
-        old_logs_count = db.execute(text("SELECT COUNT(*) FROM habit_logs WHERE user_id = :uid"), {"uid": old_user_id}).scalar()
+        old_items_count = (await db.execute(text("SELECT COUNT(*) FROM habit_items WHERE user_id = :uid"), {"uid": old_user_id})).scalar()
+        old_logs_count = (await db.execute(text("SELECT COUNT(*) FROM habit_logs WHERE user_id = :uid"), {"uid": old_user_id})).scalar()
 
         # 3. 新データの件数取得 (削除対象となる現在のデータ)
-        new_items_count = db.execute(text("SELECT COUNT(*) FROM hadbit_items WHERE user_id = :uid"), {"uid": new_user_uuid}).scalar()
-        new_logs_count = db.execute(text("SELECT COUNT(*) FROM hadbit_logs WHERE user_id = :uid"), {"uid": new_user_uuid}).scalar()
+        new_items_count = (await db.execute(text("SELECT COUNT(*) FROM hadbit_items WHERE user_id = :uid"), {"uid": new_user_uuid})).scalar()
+        new_logs_count = (await db.execute(text("SELECT COUNT(*) FROM hadbit_logs WHERE user_id = :uid"), {"uid": new_user_uuid})).scalar()
 
         return {
             "target_email": user.email,
@@ -40,99 +65,301 @@ class ConvertService:
         }
 
     @staticmethod
-    def execute_conversion(db: Session, user):
+    async def get_job(db: AsyncSession, job_id: int, user_id: str = None):
+        """
+        移行ジョブを取得する (user_id を指定した場合は本人のジョブのみ)
+        """
+        user_filter = "AND user_id = :user_id" if user_id else ""
+        sql = text(f"SELECT * FROM hadbit_convert_jobs WHERE id = :job_id {user_filter}")
+        params = {"job_id": job_id, "user_id": user_id} if user_id else {"job_id": job_id}
+        row = (await db.execute(sql, params)).fetchone()
+        return dict(row._mapping) if row else None
+
+    @staticmethod
+    async def get_active_job(db: AsyncSession, user_id: str):
+        """
+        ユーザーの未完了 (実行中・失敗して再開待ち) の移行ジョブを取得する
+        """
+        sql = text("""
+            SELECT * FROM hadbit_convert_jobs
+            WHERE user_id = :user_id AND status IN :statuses
+            ORDER BY id DESC LIMIT 1
+        """).bindparams(bindparam("statuses", expanding=True))
+        row = (await db.execute(sql, {"user_id": user_id, "statuses": list(ACTIVE_JOB_STATUSES)})).fetchone()
+        return dict(row._mapping) if row else None
+
+    @staticmethod
+    async def start_conversion(db: AsyncSession, user):
         """
-        データ移行を実行する
+        ログイン中のユーザーの移行ジョブを登録する (実行は run_job で行う)
         """
-        # ID再取得
-        query = text("SELECT id FROM mail_to_id WHERE mail = :email")
-        result = db.execute(query, {"email": user.email}).fetchone()
-        
-        if not result:
+        old_user_id = await ConvertService.get_old_user_id(db, user)
+        if not old_user_id:
             raise Exception(f"旧ユーザーIDが見つかりません: {user.email}")
-            
-        old_user_id = result.id
-        new_user_uuid = user.id
+        return await ConvertService.create_job(db, user.id, old_user_id)
 
-        try:
-            # 1. 新テーブルから対象ユーザーの既存データを削除
-            db.execute(text("DELETE FROM hadbit_logs WHERE user_id = :uid"), {"uid": new_user_uuid})
-            db.execute(text("DELETE FROM hadbit_items WHERE user_id = :uid"), {"uid": new_user_uuid})
-            
-            # 2. hadbit_items への移行
-            insert_items_sql = text("""
-                INSERT INTO hadbit_items (
-                    user_id, name, short_name, description, 
-                    parent_flag, public_flag, visible_flag, delete_flag, 
-                    updated_at, created_at, item_style, is_deleted
-                )
-                SELECT 
-                    :new_uuid, name, short_name, description, 
-                    parent_flag, public_flag, visible_flag, delete_flag, 
-                    updated_at, created_at, item_style, delete_flag
-                FROM habit_items
-                WHERE user_id = :old_uid
-                ORDER BY id ASC
-            """)
-            db.execute(insert_items_sql, {"new_uuid": new_user_uuid, "old_uid": old_user_id})
-            
-            # 3. hadbit_trees への移行
-            insert_trees_sql = text("""
-                INSERT INTO hadbit_trees (item_id, user_id, parent_id, order_no)
-                SELECT 
-                    new_item.id,
-                    :new_uuid,
-                    parent_item.id,
-                    tree.order_no
-                FROM habit_item_tree tree
-                JOIN habit_items old_item ON tree.item_id = old_item.id
-                JOIN hadbit_items new_item ON new_item.name = old_item.name AND new_item.user_id = :new_uuid
-                LEFT JOIN habit_items old_parent ON tree.parent_id = old_parent.id
-                LEFT JOIN hadbit_items parent_item ON parent_item.name = old_parent.name AND parent_item.user_id = :new_uuid
-                WHERE old_item.user_id = :old_uid
-            """)
-            db.execute(insert_trees_sql, {"new_uuid": new_user_uuid, "old_uid": old_user_id})
-
-            # 4. hadbit_logs への移行
-            insert_logs_sql = text("""
+    @staticmethod
+    async def create_job(db: AsyncSession, user_id: str, old_user_id: int):
+        """
+        移行ジョブを登録する
+        未完了のジョブがある場合は新しく作らずにそのジョブを返す (続きから再開する)
+        """
+        job = await ConvertService.get_active_job(db, user_id)
+        if job:
+            return job
+
+        sql = text("""
+            INSERT INTO hadbit_convert_jobs (user_id, old_user_id, total_logs)
+            SELECT :new_uuid, :old_uid, COUNT(*) FROM habit_logs WHERE user_id = :old_uid
+            RETURNING *
+        """)
+        row = (await db.execute(sql, {"new_uuid": user_id, "old_uid": old_user_id})).fetchone()
+        await db.commit()
+        return dict(row._mapping)
+
+    @staticmethod
+    async def list_convert_targets(db: AsyncSession):
+        """
+        旧データ (habit_items / habit_logs) がある mail_to_id のユーザーを、新ユーザー (auth.users) と対応付けて返す
+        戻り値: [{"mail", "old_user_id", "user_id" (新ユーザー未登録の場合は None), "last_status" (直近の移行ジョブの状態)}]
+        """
+        sql = text("""
+            SELECT m.mail, m.id AS old_user_id, u.id AS user_id, job.status AS last_status
+            FROM mail_to_id m
+            LEFT JOIN auth.users u ON u.email = m.mail
+            LEFT JOIN LATERAL (
+                SELECT status FROM hadbit_convert_jobs j WHERE j.user_id = u.id ORDER BY j.id DESC LIMIT 1
+            ) job ON true
+            WHERE EXISTS (SELECT 1 FROM habit_items WHERE habit_items.user_id = m.id)
+               OR EXISTS (SELECT 1 FROM habit_logs WHERE habit_logs.user_id = m.id)
+            ORDER BY m.id
+        """)
+        return [dict(row._mapping) for row in (await db.execute(sql)).fetchall()]
+
+    @staticmethod
+    async def run_job(job_id: int):
+        """
+        移行ジョブを実行する (BackgroundTasks・CLI から呼ぶ。リクエストとは別のセッションを使う)
+        フェーズごと・CONVERT_CHUNK_SIZE 件ごとにコミットし、ジョブの phase / last_old_log_id に進捗を記録する。
+        失敗した場合は status を failed にして、次回はコミット済みの位置から再開する
+        戻り値: 終了時点のジョブ (他のプロセスが実行中で開始できなかった場合は None)
+        """
+        async with AsyncSessionLocal() as db:
+            job = await ConvertService._claim_job(db, job_id)
+            if job is None:
+                return None
+            try:
+                if job["phase"] == "clear":
+                    await ConvertService._clear_user_data(db, job)
+                    job["phase"] = "items"
+                if job["phase"] == "items":
+                    await ConvertService._copy_items(db, job)
+                    job["phase"] = "logs"
+                if job["phase"] == "logs":
+                    await ConvertService._copy_logs(db, job)
+                    job["phase"] = "finish"
+                if job["phase"] == "finish":
+                    await ConvertService._finish(db, job)
+            except ConvertJobBusy:
+                # 先に実行していたプロセスがまだ動いている。ジョブの状態はそのプロセスに任せる
+                print(f"Convert job {job_id} is running in another process")
+                await db.rollback()
+                return None
+            except Exception as e:
+                print(f"Error converting job {job_id}: {e}")
+                await db.rollback()
+                # DBのエラーはSQL文を含まない元の例外のメッセージを記録する (画面に表示するため)
+                await db.execute(text("""
+                    UPDATE hadbit_convert_jobs SET status = 'failed', error = :error, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = :job_id
+                """), {"job_id": job_id, "error": str(getattr(e, "orig", None) or e)})
+                await db.commit()
+            return await ConvertService.get_job(db, job_id)
+
+    @staticmethod
+    async def _claim_job(db: AsyncSession, job_id: int):
+        """
+        ジョブを running にする。他のプロセスが実行中 (更新が CONVERT_STALE_SECONDS 以内、
+        またはフェーズのトランザクションの途中でロックを持っている) の場合は None
+        """
+        sql = text("""
+            UPDATE hadbit_convert_jobs
+            SET status = 'running', error = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE id = :job_id
+              AND (status IN ('pending', 'failed')
+                   OR (status = 'running' AND updated_at < CURRENT_TIMESTAMP - make_interval(secs => :stale)))
+              AND pg_try_advisory_xact_lock(hashtext('hadbit_convert_jobs'), :job_id)
+            RETURNING *
+        """)
+        row = (await db.execute(sql, {"job_id": job_id, "stale": CONVERT_STALE_SECONDS})).fetchone()
+        await db.commit()
+        return dict(row._mapping) if row else None
+
+    @staticmethod
+    async def _lock_job(db: AsyncSession, job: dict):
+        """
+        フェーズのトランザクションの先頭で、ジョブのアドバイザリロックを取得し、更新日時 (ハートビート) を更新する
+        ロックはトランザクションの終了まで保持されるため、項目の移行・集計の再作成のように1トランザクションが長いフェーズの途中でも、
+        更新日時が古くなったジョブを他のプロセスが再開する (_claim_job) ことはできない
+        取得できない場合 (他のプロセスが実行中) は ConvertJobBusy
+        """
+        locked = (await db.execute(text("""
+            UPDATE hadbit_convert_jobs SET updated_at = CURRENT_TIMESTAMP
+            WHERE id = :job_id AND pg_try_advisory_xact_lock(hashtext('hadbit_convert_jobs'), :job_id)
+            RETURNING id
+        """), {"job_id": job["id"]})).scalar()
+        if locked is None:
+            raise ConvertJobBusy(job["id"])
+
+    @staticmethod
+    async def _set_phase(db: AsyncSession, job: dict, phase: str, **counts):
+        """
+        ジョブのフェーズ (と件数) を更新する (コミットは呼び出し側で行う)
+        """
+        sets = "".join(f", {column} = :{column}" for column in counts)
+        await db.execute(text(f"""
+            UPDATE hadbit_convert_jobs SET phase = :phase{sets}, updated_at = CURRENT_TIMESTAMP WHERE id = :job_id
+        """), {"job_id": job["id"], "phase": phase, **counts})
+
+    @staticmethod
+    async def _clear_user_data(db: AsyncSession, job: dict):
+        """
+        1. 新テーブルから対象ユーザーの既存データを削除する (記録は CONVERT_CHUNK_SIZE 件ずつコミット)
+        """
+        delete_logs_sql = text("""
+            DELETE FROM hadbit_logs WHERE id IN (
+                SELECT id FROM hadbit_logs WHERE user_id = :uid LIMIT :chunk_size
+            )
+        """)
+        while True:
+            await ConvertService._lock_job(db, job)
+            result = await db.execute(delete_logs_sql, {"uid": job["user_id"], "chunk_size": CONVERT_CHUNK_SIZE})
+            await db.commit()
+            if result.rowcount < CONVERT_CHUNK_SIZE:
+                break
+
+        await ConvertService._lock_job(db, job)
+        # hadbit_trees は外部キーの on delete cascade で削除される
+        await db.execute(text("DELETE FROM hadbit_items WHERE user_id = :uid"), {"uid": job["user_id"]})
+        await db.execute(text("DELETE FROM hadbit_daily_counts WHERE user_id = :uid"), {"uid": job["user_id"]})
+        await ConvertService._set_phase(db, job, "items")
+        invalidate_hierarchy(db, job["user_id"])
+        invalidate_fragments(db, job["user_id"])
+        await db.commit()
+
+    @staticmethod
+    async def _copy_items(db: AsyncSession, job: dict):
+        """
+        2. 旧項目ID → 新項目ID の対応表を作り、hadbit_items / hadbit_trees へ移行する (1トランザクション)
+        新項目IDはシーケンスから先に払い出すため、項目名が重複していても正しく対応付けられる
+        """
+        params = {"job_id": job["id"], "new_uuid": job["user_id"], "old_uid": job["old_user_id"]}
+        await ConvertService._lock_job(db, job)
+        await db.execute(text("DELETE FROM hadbit_convert_item_map WHERE job_id = :job_id"), params)
+        await db.execute(text("""
+            INSERT INTO hadbit_convert_item_map (job_id, old_item_id, new_item_id)
+            SELECT :job_id, id, nextval(pg_get_serial_sequence('hadbit_items', 'id'))
+            FROM habit_items
+            WHERE user_id = :old_uid
+            ORDER BY id ASC
+        """), params)
+
+        result = await db.execute(text("""
+            INSERT INTO hadbit_items (
+                id, user_id, name, short_name, description,
+                parent_flag, public_flag, visible_flag, delete_flag,
+                updated_at, created_at, item_style, is_deleted
+            )
+            SELECT
+                map.new_item_id, :new_uuid, old_item.name, old_item.short_name, old_item.description,
+                old_item.parent_flag, old_item.public_flag, old_item.visible_flag, old_item.delete_flag,
+                old_item.updated_at, old_item.created_at, old_item.item_style, old_item.delete_flag
+            FROM habit_items old_item
+            INNER JOIN hadbit_convert_item_map map ON map.job_id = :job_id AND map.old_item_id = old_item.id
+        """), params)
+        items_count = result.rowcount
+
+        # 親が無い (NULL・対応表に無い) 項目は parent_id = 0 (親項目) とする
+        await db.execute(text("""
+            INSERT INTO hadbit_trees (item_id, user_id, parent_id, order_no)
+            SELECT
+                map.new_item_id,
+                :new_uuid,
+                COALESCE(parent_map.new_item_id, 0),
+                tree.order_no
+            FROM habit_item_tree tree
+            INNER JOIN hadbit_convert_item_map map ON map.job_id = :job_id AND map.old_item_id = tree.item_id
+            LEFT JOIN hadbit_convert_item_map parent_map ON parent_map.job_id = :job_id AND parent_map.old_item_id = tree.parent_id
+        """), params)
+
+        await ConvertService._set_phase(db, job, "logs", items_count=items_count)
+        invalidate_hierarchy(db, job["user_id"])
+        await db.commit()
+
+    @staticmethod
+    async def _copy_logs(db: AsyncSession, job: dict):
+        """
+        3. hadbit_logs へ旧IDの順に CONVERT_CHUNK_SIZE 件ずつ移行する
+        移行した記録と last_old_log_id の更新を1文で行うため、途中で失敗しても重複・欠落なく再開できる
+        """
+        sql = text("""
+            WITH src AS (
+                SELECT logs.id, logs.item_id, logs.done_at, logs.updated_at, logs.created_at, logs.comment
+                FROM habit_logs logs
+                WHERE logs.user_id = :old_uid AND logs.id > :last_id
+                ORDER BY logs.id
+                LIMIT :chunk_size
+            ), ins AS (
                 INSERT INTO hadbit_logs (
                     user_id, item_id, done_at, updated_at, created_at, comment
                 )
-                SELECT 
-                    :new_uuid,
-                    new_item.id,
-                    logs.done_at,
-                    logs.updated_at,
-                    logs.created_at,
-                    logs.comment
-                FROM habit_logs logs
-                JOIN habit_items old_item ON logs.item_id = old_item.id
-                JOIN hadbit_items new_item ON new_item.name = old_item.name AND new_item.user_id = :new_uuid
-                WHERE logs.user_id = :old_uid
-            """)
-            db.execute(insert_logs_sql, {"new_uuid": new_user_uuid, "old_uid": old_user_id})
-            
-            # 5. parent_id の補正 (NULL -> 0)
-            update_trees_sql = text("""
-                UPDATE hadbit_trees
-                SET parent_id = 0
-                WHERE user_id = :new_uuid
-                AND parent_id IS NULL
-            """)
-            db.execute(update_trees_sql, {"new_uuid": new_user_uuid})
-
-            db.commit()
-            
-            # 実行後の件数確認
-            final_items = db.execute(text("SELECT COUNT(*) FROM hadbit_items WHERE user_id = :uid"), {"uid": new_user_uuid}).scalar()
-            final_logs = db.execute(text("SELECT COUNT(*) FROM hadbit_logs WHERE user_id = :uid"), {"uid": new_user_uuid}).scalar()
-            
-            return {
-                "status": "success",
-                "items_count": final_items,
-                "logs_count": final_logs
-            }
-            
-        except Exception as e:
-            db.rollback()
-            raise e
\ No newline at end of file
+                SELECT :new_uuid, map.new_item_id, src.done_at, src.updated_at, src.created_at, src.comment
+                FROM src
+                INNER JOIN hadbit_convert_item_map map ON map.job_id = :job_id AND map.old_item_id = src.item_id
+                ORDER BY src.id
+                RETURNING 1
+            ), chunk AS (
+                SELECT COUNT(*) AS rows, MAX(id) AS last_id FROM src
+            )
+            UPDATE hadbit_convert_jobs SET
+                last_old_log_id = COALESCE(chunk.last_id, last_old_log_id),
+                processed_logs = processed_logs + chunk.rows,
+                copied_logs = copied_logs + (SELECT COUNT(*) FROM ins),
+                updated_at = CURRENT_TIMESTAMP
+            FROM chunk
+            WHERE hadbit_convert_jobs.id = :job_id
+            RETURNING last_old_log_id, chunk.rows
+        """)
+        last_id = job["last_old_log_id"]
+        while True:
+            await ConvertService._lock_job(db, job)
+            row = (await db.execute(sql, {
+                "job_id": job["id"],
+                "new_uuid": job["user_id"],
+                "old_uid": job["old_user_id"],
+                "last_id": last_id,
+                "chunk_size": CONVERT_CHUNK_SIZE,
+            })).fetchone()
+            invalidate_fragments(db, job["user_id"])
+            await db.commit()
+            last_id = row.last_old_log_id
+            if row.rows < CONVERT_CHUNK_SIZE:
+                break
+
+        await ConvertService._lock_job(db, job)
+        await ConvertService._set_phase(db, job, "finish")
+        await db.commit()
+
+    @staticmethod
+    async def _finish(db: AsyncSession, job: dict):
+        """
+        4. 日別集計 (hadbit_daily_counts) を再作成し、ジョブを完了にする
+        """
+        await ConvertService._lock_job(db, job)
+        await rebuild_daily_counts(db, job["user_id"])
+        await db.execute(text("""
+            UPDATE hadbit_convert_jobs SET status = 'done', phase = 'done', updated_at = CURRENT_TIMESTAMP WHERE id = :job_id
+        """), {"job_id": job["id"]})
+        invalidate_hierarchy(db, job["user_id"])
+        invalidate_fragments(db, job["user_id"])
+        await db.commit()
@@ -0,0 +1,102 @@
+import hashlib
+from pathlib import Path
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import text
+
+from app.services.hadbit_record_service import get_today_jst
+
+# テンプレートの更新 (デプロイ) でも ETag が変わるよう、テンプレートの最終更新時刻を含める
+_TEMPLATES_DIR = Path(__file__).resolve().parents[1] / "templates"
+TEMPLATES_STAMP = str(int(max((p.stat().st_mtime for p in _TEMPLATES_DIR.rglob("*.html")), default=0)))
+
+
+async def get_data_version(db: AsyncSession, user_id: str):
+    """
+    ユーザーのデータバージョンを取得する
+    hadbit_logs / hadbit_items / hadbit_trees の変更時にトリガーで 1 上がる (migrations/0003_data_versions.sql)
+    一度も変更がないユーザーは 0
+    """
+    sql = text("SELECT version FROM hadbit_data_versions WHERE user_id = :user_id")
+    version = (await db.execute(sql, {"user_id": user_id})).scalar()
+    return version or 0
+
+
+async def get_data_versions(db: AsyncSession, user_id: str):
+    """
+    ユーザーのデータバージョンと階層のバージョンを1回のクエリで取得する
+    階層のバージョン (hierarchy_version) は hadbit_items / hadbit_trees の変更時のみ上がる (migrations/0006_hierarchy_versions.sql)
+    戻り値: (version, hierarchy_version)。一度も変更がないユーザーは (0, 0)
+    """
+    sql = text("SELECT version, hierarchy_version FROM hadbit_data_versions WHERE user_id = :user_id")
+    row = (await db.execute(sql, {"user_id": user_id})).first()
+    if row is None:
+        return 0, 0
+    return row.version, row.hierarchy_version
+
+
+def make_etag(view: str, version: int, *parts) -> str:
+    """
+    画面名・データバージョン・その他の描画条件 (クエリ文字列など) から ETag を作る
+    表示期間が当日 (日本時間) 基準のため、日本時間で日付が変わると別の ETag になる
+    """
+    key = "|".join([view, str(version), get_today_jst().isoformat(), TEMPLATES_STAMP, *(str(p) for p in parts)])
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return f'W/"{view}-{version}-{digest}"'
+
+
+async def load_data_version(db: AsyncSession, user_id: str):
+    """
+    get_data_version と同じだが、取得できない場合 (テーブル未作成など) は None を返す
+    (呼び出し側は ETag・フラグメントキャッシュを使わずに通常どおり処理する)
+    """
+    try:
+        return await get_data_version(db, user_id)
+    except Exception as e:
+        print(f"Error fetching data version: {e}")
+        await db.rollback()
+        return None
+
+
+async def load_data_versions(db: AsyncSession, user_id: str):
+    """
+    get_data_versions と同じだが、取得できない場合 (テーブル未作成など) は (None, None) を返す
+    """
+    try:
+        return await get_data_versions(db, user_id)
+    except Exception as e:
+        print(f"Error fetching data versions: {e}")
+        await db.rollback()
+        return None, None
+
+
+async def get_view_etag(db: AsyncSession, user_id: str, view: str, *parts):
+    """
+    ユーザーの現在のデータバージョンから画面の ETag を作る
+    バージョンを取得できない場合は None を返し、ETag を使わない
+    """
+    version = await load_data_version(db, user_id)
+    if version is None:
+        return None
+    return make_etag(view, version, *parts)
+
+
+def etag_matches(if_none_match: str | None, etag: str | None) -> bool:
+    """
+    If-None-Match ヘッダーの値が ETag に一致するか (弱い比較。複数指定・* に対応)
+    """
+    if not if_none_match or not etag:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    if "*" in candidates:
+        return True
+    weak = etag.removeprefix("W/")
+    return any(candidate.removeprefix("W/") == weak for candidate in candidates)
+
+
+def etag_headers(etag: str | None) -> dict:
+    """
+    ETag 付きレスポンスのヘッダー。ブラウザにはキャッシュさせつつ、毎回 If-None-Match で再検証させる
+    """
+    if not etag:
+        return {}
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
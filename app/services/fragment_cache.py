@@ -0,0 +1,96 @@
+import gzip
+import os
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy import event
+
+from app.services import metrics
+from app.services.cache import LRUCache
+
+# 描画済みHTML (記録一覧・日付カード等) のキャッシュ
+# キーは (user_id, 画面名, データバージョン, 描画条件...)。データが変わるとバージョンが上がるため、古いエントリは参照されなくなる
+FRAGMENT_CACHE_ENABLED = os.getenv("FRAGMENT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+# gzip 圧縮した状態で保持する (メモリ節約。gzip を受け付けるクライアントにはそのまま返す)
+FRAGMENT_CACHE_COMPRESS = os.getenv("FRAGMENT_CACHE_COMPRESS", "true").lower() in ("1", "true", "yes")
+_fragment_cache = LRUCache(
+    maxsize=int(os.getenv("FRAGMENT_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("FRAGMENT_CACHE_TTL", "600")),
+)
+FRAGMENT_CACHE_HITS = metrics.counter("fragment_cache_hits_total", "描画済みHTMLのキャッシュヒット数")
+FRAGMENT_CACHE_MISSES = metrics.counter("fragment_cache_misses_total", "描画済みHTMLのキャッシュミス数")
+metrics.gauge("fragment_cache_entries", lambda: len(_fragment_cache), "描画済みHTMLのキャッシュ件数")
+
+# セッションの info に、未コミットの記録変更があるユーザーIDを記録するキー
+_DIRTY_KEY = "fragment_cache_dirty"
+
+
+class Fragment:
+    """
+    描画済みHTML。compressed の場合 body は gzip 圧縮済み
+    """
+
+    __slots__ = ("body", "compressed")
+
+    def __init__(self, body: bytes, compressed: bool):
+        self.body = body
+        self.compressed = compressed
+
+    def text(self) -> str:
+        body = gzip.decompress(self.body) if self.compressed else self.body
+        return body.decode("utf-8")
+
+
+def get_fragment(user_id: str, view: str, version, *parts):
+    """
+    キャッシュ済みの描画結果を返す (無ければ None)
+    version が None (データバージョンを取得できない) の場合はキャッシュを使わない
+    """
+    if not FRAGMENT_CACHE_ENABLED or version is None:
+        return None
+    fragment = _fragment_cache.get((str(user_id), view, version, *parts))
+    if fragment is None:
+        FRAGMENT_CACHE_MISSES.inc()
+    else:
+        FRAGMENT_CACHE_HITS.inc()
+    return fragment
+
+
+def put_fragment(user_id: str, view: str, version, parts: tuple, html: str) -> Fragment:
+    """
+    描画結果をキャッシュに保存して返す
+    """
+    body = html.encode("utf-8")
+    if FRAGMENT_CACHE_COMPRESS:
+        fragment = Fragment(gzip.compress(body, compresslevel=5), True)
+    else:
+        fragment = Fragment(body, False)
+    if FRAGMENT_CACHE_ENABLED and version is not None:
+        _fragment_cache.set((str(user_id), view, version, *parts), fragment)
+    return fragment
+
+
+def invalidate_fragments(db: AsyncSession, user_id: str):
+    """
+    ユーザーの描画済みHTMLを破棄する（記録の更新系の関数から呼ぶ）
+    コミット完了時に、そのユーザーのエントリをまとめて削除する
+    """
+    db.info.setdefault(_DIRTY_KEY, set()).add(str(user_id))
+
+
+def evict_user(user_id: str) -> int:
+    """
+    ユーザーの描画済みHTMLをすべて削除する（セッション外で直接更新した場合用）
+    """
+    user_id = str(user_id)
+    return _fragment_cache.pop_matching(lambda key: key[0] == user_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _evict_after_commit(session):
+    for user_id in session.info.pop(_DIRTY_KEY, ()):
+        evict_user(user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_dirty_after_rollback(session):
+    session.info.pop(_DIRTY_KEY, None)
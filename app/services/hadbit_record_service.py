@@ -1,28 +1,74 @@
-from datetime import datetime, timedelta, timezone
-from sqlalchemy.orm import Session
+from datetime import date, datetime, time, timedelta, timezone
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
 
-def create_hadbit_record(db: Session, user_id: str, hadbit_item_id: int, record_date: datetime, memo: str = ""):
+from app.services.fragment_cache import invalidate_fragments
+
+# 記録の日時は日本時間 (タイムゾーンなし) で保存する
+JST = timezone(timedelta(hours=9))
+# 記録一覧 (/hadbit/records) の1ページあたりの件数
+LOGS_PAGE_SIZE = 100
+# ストリーミング描画時にサーバーサイドカーソルから一度に読み込む件数
+LOGS_STREAM_YIELD_PER = 50
+
+def get_now_jst():
+    """
+    日本時間の現在時刻 (タイムゾーンなし。done_at と同じ形式)
+    """
+    return datetime.now(JST).replace(tzinfo=None)
+
+def get_today_jst() -> date:
+    """
+    日本時間の当日の日付 (サーバーのタイムゾーンによらない)
+    """
+    return get_now_jst().date()
+
+async def create_hadbit_record(db: AsyncSession, user_id: str, hadbit_item_id: int, record_date: datetime, memo: str = ""):
     """
     習慣の記録を新規作成（INSERT）する
     hadbit_logs テーブルを使用。
     一日に複数回の登録を許容するため、重複チェックは行わず常にINSERTする。
     """
-    insert_query = text("INSERT INTO hadbit_logs (user_id, item_id, done_at, comment) VALUES (:user_id, :item_id, :done_at, :comment) RETURNING id")
-    result = db.execute(insert_query, {"user_id": user_id, "item_id": hadbit_item_id, "done_at": record_date, "comment": memo}).fetchone()
+    # 日別集計 (hadbit_daily_counts) の加算も同じ文で行う
+    insert_query = text("""
+        WITH ins AS (
+            INSERT INTO hadbit_logs (user_id, item_id, done_at, comment)
+            VALUES (:user_id, :item_id, :done_at, :comment)
+            RETURNING id, user_id, item_id, done_at, comment
+        ), cnt AS (
+            INSERT INTO hadbit_daily_counts (user_id, item_id, day, count)
+            SELECT user_id, item_id, done_at::date, 1 FROM ins WHERE done_at IS NOT NULL
+            ON CONFLICT (user_id, item_id, day) DO UPDATE SET count = hadbit_daily_counts.count + EXCLUDED.count
+        )
+        SELECT id, item_id, done_at, comment FROM ins
+    """)
+    invalidate_fragments(db, user_id)
+    result = (await db.execute(insert_query, {"user_id": user_id, "item_id": hadbit_item_id, "done_at": record_date, "comment": memo})).fetchone()
     return result
 
-def delete_hadbit_record(db: Session, user_id: str, log_id: int):
+async def delete_hadbit_record(db: AsyncSession, user_id: str, log_id: int):
     """
     指定されたIDの記録を削除する
     ユーザーIDの一致を確認して、他人の記録を削除できないようにする
     """
     # 削除した行のデータを返すようにRETURNING句を追加
-    query = text("DELETE FROM hadbit_logs WHERE id = :log_id AND user_id = :user_id RETURNING item_id, done_at, comment")
-    result = db.execute(query, {"log_id": log_id, "user_id": user_id}).fetchone()
+    # 日別集計 (hadbit_daily_counts) の減算も同じ文で行う (0件になった行は rebuild_daily_counts で掃除される)
+    query = text("""
+        WITH del AS (
+            DELETE FROM hadbit_logs WHERE id = :log_id AND user_id = :user_id
+            RETURNING user_id, item_id, done_at, comment
+        ), cnt AS (
+            UPDATE hadbit_daily_counts c SET count = c.count - 1
+            FROM del
+            WHERE c.user_id = del.user_id AND c.item_id = del.item_id AND c.day = del.done_at::date
+        )
+        SELECT item_id, done_at, comment FROM del
+    """)
+    invalidate_fragments(db, user_id)
+    result = (await db.execute(query, {"log_id": log_id, "user_id": user_id})).fetchone()
     return result
 
-def get_log(db: Session, user_id: str, log_id: int):
+async def get_log(db: AsyncSession, user_id: str, log_id: int):
     """
     指定されたIDの記録を取得する（表示・編集用）
     """
@@ -45,9 +91,9 @@ def get_log(db: Session, user_id: str, log_id: int):
         WHERE logs.id = :log_id AND logs.user_id = :user_id
         order by logs.done_at desc , citem.id desc
     """)
-    return db.execute(query, {"log_id": log_id, "user_id": user_id}).fetchone()
+    return (await db.execute(query, {"log_id": log_id, "user_id": user_id})).fetchone()
 
-def update_hadbit_record_memo(db: Session, user_id: str, log_id: int, memo: str):
+async def update_hadbit_record_memo(db: AsyncSession, user_id: str, log_id: int, memo: str):
     """
     指定されたIDの記録のメモを更新する
     """
@@ -56,25 +102,72 @@ def update_hadbit_record_memo(db: Session, user_id: str, log_id: int, memo: str)
         comment = :memo 
         WHERE id = :log_id 
         AND user_id = :user_id""")
-    db.execute(query, {"memo": memo, "log_id": log_id, "user_id": user_id})
+    invalidate_fragments(db, user_id)
+    await db.execute(query, {"memo": memo, "log_id": log_id, "user_id": user_id})
 
-def update_hadbit_record(db: Session, user_id: str, log_id: int, record_date: datetime, memo: str):
+async def update_hadbit_record(db: AsyncSession, user_id: str, log_id: int, record_date: datetime, memo: str):
     """
     指定されたIDの記録の日時とメモを更新する
+    更新前後の日時 (old_done_at, done_at) を返す。該当しない場合は None。
     """
-    query = text("UPDATE hadbit_logs SET done_at = :done_at, comment = :comment WHERE id = :log_id AND user_id = :user_id")
-    db.execute(query, {"done_at": record_date, "comment": memo, "log_id": log_id, "user_id": user_id})
+    # 自己結合した old 側から更新前の値を RETURNING で受け取る
+    # 日付が変わった場合は日別集計 (hadbit_daily_counts) を移動元 -1 / 移動先 +1 する
+    # (同じ日のままなら差分が 0 になるため何もしない)
+    query = text("""
+        WITH upd AS (
+            UPDATE hadbit_logs logs
+            SET done_at = :done_at, comment = :comment
+            FROM hadbit_logs old
+            WHERE logs.id = old.id
+              AND logs.id = :log_id
+              AND logs.user_id = :user_id
+            RETURNING logs.user_id, logs.item_id, old.done_at AS old_done_at, logs.done_at AS done_at,
+                      old.comment IS DISTINCT FROM logs.comment AS comment_changed
+        ), delta AS (
+            SELECT user_id, item_id, day, SUM(diff) AS diff
+            FROM (
+                SELECT user_id, item_id, old_done_at::date AS day, -1 AS diff FROM upd WHERE old_done_at IS NOT NULL
+                UNION ALL
+                SELECT user_id, item_id, done_at::date AS day, 1 AS diff FROM upd WHERE done_at IS NOT NULL
+            ) d
+            GROUP BY user_id, item_id, day
+            HAVING SUM(diff) <> 0
+        ), cnt AS (
+            INSERT INTO hadbit_daily_counts (user_id, item_id, day, count)
+            SELECT user_id, item_id, day, diff FROM delta
+            ON CONFLICT (user_id, item_id, day) DO UPDATE SET count = hadbit_daily_counts.count + EXCLUDED.count
+        )
+        SELECT old_done_at, done_at, comment_changed FROM upd
+    """)
+    result = (await db.execute(query, {"done_at": record_date, "comment": memo, "log_id": log_id, "user_id": user_id})).fetchone()
+    # 値が変わらない更新 (保存ボタンを押しただけ等) では描画済みHTMLを破棄しない
+    if result and (result.old_done_at != result.done_at or result.comment_changed):
+        invalidate_fragments(db, user_id)
+    return result
 
-def get_logs(db: Session, user_id: str, start_date: str = None, end_date: str = None):
+def resolve_log_period(start_date: str | datetime = None, end_date: str | datetime = None):
+    """
+    記録の取得期間を決定する（指定がない場合は直近1年）
+    戻り値: (start_date, end_date) の datetime
+    """
     # JSTの現在時刻を取得
-    now_jst = datetime.now(timezone(timedelta(hours=9)))
+    now_jst = get_now_jst()
 
-    # 1. デフォルト期間の設定（指定がない場合は直近1年）
     if not start_date:
         start_date = (now_jst - timedelta(days=365)).strftime('%Y-%m-%d')
     if not end_date:
         # 時刻を含まない日付比較の場合、その日の終わりまで含める工夫が必要な場合があります
         end_date = now_jst.strftime('%Y-%m-%d 23:59:59')
+    # asyncpg は timestamp 型のパラメータに文字列を受け付けないため datetime に変換する
+    if isinstance(start_date, str):
+        start_date = datetime.fromisoformat(start_date)
+    if isinstance(end_date, str):
+        end_date = datetime.fromisoformat(end_date)
+    return start_date, end_date
+
+async def get_logs(db: AsyncSession, user_id: str, start_date: str | datetime = None, end_date: str | datetime = None):
+    # 1. デフォルト期間の設定（指定がない場合は直近1年）
+    start_date, end_date = resolve_log_period(start_date, end_date)
 
     # 2. SQLクエリの定義（:user_id を追加）
     sql = text("""
@@ -105,5 +198,259 @@ def get_logs(db: Session, user_id: str, start_date: str = None, end_date: str =
         "end_date": end_date
     }
     
-    result = db.execute(sql, params)
-    return result.fetchall()
\ No newline at end of file
+    result = await db.execute(sql, params)
+    return result.fetchall()
+
+async def get_daily_counts(db: AsyncSession, user_id: str, start_date: str | datetime = None, end_date: str | datetime = None, parent_id: int = None):
+    """
+    日ごとの記録件数を集計する（ヒートマップ用）
+    hadbit_logs ではなく日別集計テーブル (hadbit_daily_counts) を参照する。
+    parent_id を指定した場合は、その種別配下の項目の記録のみを数える。
+    戻り値: [(date, count), ...] 日付の昇順、記録のない日は含まない
+    """
+    start_date, end_date = resolve_log_period(start_date, end_date)
+
+    parent_clause = "AND tree.parent_id = :parent_id" if parent_id else ""
+    sql = text(f"""
+        SELECT 
+            counts.day,
+            SUM(counts.count) AS count
+        FROM hadbit_daily_counts counts
+        INNER JOIN hadbit_trees tree ON tree.item_id = counts.item_id
+        WHERE counts.user_id = :user_id
+          AND counts.day BETWEEN :start_date AND :end_date
+          AND counts.count > 0
+          {parent_clause}
+        GROUP BY counts.day
+        ORDER BY counts.day
+    """)
+    params = {"user_id": user_id, "start_date": start_date.date(), "end_date": end_date.date()}
+    if parent_id:
+        params["parent_id"] = parent_id
+    return (await db.execute(sql, params)).fetchall()
+
+async def rebuild_daily_counts(db: AsyncSession, user_id: str = None):
+    """
+    日別集計 (hadbit_daily_counts) を hadbit_logs から作り直す
+    user_id を指定した場合はそのユーザー分のみ、省略時は全ユーザー分を対象とする。
+    既存データの移行後や、集計のずれを解消したいときに使用する（コミットは呼び出し側で行う）
+    戻り値: 作成した集計行数
+    """
+    user_clause = "WHERE user_id = :user_id" if user_id else ""
+    params = {"user_id": user_id} if user_id else {}
+    await db.execute(text(f"DELETE FROM hadbit_daily_counts {user_clause}"), params)
+
+    user_filter = "AND user_id = :user_id" if user_id else ""
+    sql = text(f"""
+        INSERT INTO hadbit_daily_counts (user_id, item_id, day, count)
+        SELECT user_id, item_id, done_at::date, COUNT(*)
+        FROM hadbit_logs
+        WHERE done_at IS NOT NULL {user_filter}
+        GROUP BY user_id, item_id, done_at::date
+    """)
+    result = await db.execute(sql, params)
+    return result.rowcount
+
+def _logs_page_query(user_id: str, before_done_at: datetime = None, before_id: int = None, limit: int = LOGS_PAGE_SIZE):
+    """
+    記録のキーセットページング用のSQLとパラメータを作る (次ページの有無の判定用に limit + 1 件取得する)
+    done_at が NULL の記録は日付カードに表示できないため除く (降順では NULL が先頭に並ぶ)
+    """
+    cursor_clause = ""
+    params = {"user_id": user_id, "limit": limit + 1}
+    if before_done_at is not None and before_id is not None:
+        cursor_clause = "AND (logs.done_at, logs.id) < (:before_done_at, :before_id)"
+        params.update({"before_done_at": before_done_at, "before_id": before_id})
+
+    sql = text(f"""
+        SELECT 
+            logs.id AS log_id,
+            logs.done_at AS done_at,
+            logs.item_id AS item_id,
+            logs.comment,
+            pitem.id AS parent_item_id, 
+            pitem.name AS parent_name, 
+            pitem.short_name AS parent_short_name,
+            citem.id AS child_item_id,
+            citem.name AS child_name, 
+            citem.short_name AS child_short_name
+        FROM hadbit_logs logs
+        INNER JOIN hadbit_items citem ON citem.id = logs.item_id
+        INNER JOIN hadbit_trees tree ON tree.item_id = logs.item_id
+        INNER JOIN hadbit_items pitem ON pitem.id = tree.parent_id
+        WHERE logs.user_id = :user_id
+          AND logs.done_at IS NOT NULL
+          {cursor_clause}
+        ORDER BY logs.done_at DESC, logs.id DESC
+        LIMIT :limit
+    """)
+    return sql, params
+
+async def get_logs_page(db: AsyncSession, user_id: str, before_done_at: datetime = None, before_id: int = None, limit: int = LOGS_PAGE_SIZE):
+    """
+    記録を (done_at, id) の降順でキーセットページングして1ページ分取得する。
+    before_done_at / before_id を指定すると、その記録より古いものを返す。
+
+    日付カードがページをまたいで分断されないよう、ページ末尾の日付が途中で切れる場合は
+    その日付を丸ごと次のページに回す (1ページ内が1日だけの場合はそのまま返す)。
+    戻り値: (logs, next_cursor)  next_cursor は次ページ取得用の (done_at, log_id)、最終ページなら None
+    """
+    sql, params = _logs_page_query(user_id, before_done_at, before_id, limit)
+    logs = (await db.execute(sql, params)).fetchall()
+
+    if len(logs) <= limit:
+        return logs, None
+
+    logs = logs[:limit]
+    last_day = logs[-1].done_at.date()
+    if logs[0].done_at.date() != last_day:
+        # 末尾の日付は次のページでまとめて取得する
+        logs = [log for log in logs if log.done_at.date() != last_day]
+    last = logs[-1]
+    return logs, (last.done_at, last.log_id)
+
+class LogDayStream:
+    """
+    記録の1ページ分を、サーバーサイドカーソルで読みながら日付ごとにまとめて返す非同期イテレーター
+    ページの区切りは get_logs_page と同じで、読み終わると next_cursor に次ページ取得用のカーソルが入る
+    (メモリ上に保持するのは1日分の記録のみ)
+    戻り値 (反復): ("YYYY-MM-DD", [log, ...])
+    """
+
+    def __init__(self, db: AsyncSession, user_id: str, before_done_at: datetime = None, before_id: int = None, limit: int = LOGS_PAGE_SIZE):
+        self.db = db
+        self.user_id = user_id
+        self.before_done_at = before_done_at
+        self.before_id = before_id
+        self.limit = limit
+        self.next_cursor = None
+        self.failed = False
+
+    async def __aiter__(self):
+        sql, params = _logs_page_query(self.user_id, self.before_done_at, self.before_id, self.limit)
+        day, day_logs, last = None, [], None
+        try:
+            result = await self.db.stream(sql.execution_options(yield_per=LOGS_STREAM_YIELD_PER), params)
+            count = 0
+            async for log in result:
+                count += 1
+                if count > self.limit:
+                    # 次のページがある。末尾の日付は次のページでまとめて取得する (1ページ内が1日だけの場合はそのまま返す)
+                    if last is not None:
+                        day_logs = []
+                    else:
+                        last = day_logs[-1]
+                    self.next_cursor = (last.done_at, last.log_id)
+                    break
+                log_day = log.done_at.strftime('%Y-%m-%d')
+                if log_day != day:
+                    if day_logs:
+                        last = day_logs[-1]
+                        yield day, day_logs
+                    day, day_logs = log_day, []
+                day_logs.append(log)
+            await result.close()
+        except Exception as e:
+            print(f"Error streaming logs: {e}")
+            self.next_cursor = None
+            self.failed = True
+            return
+        if day_logs:
+            yield day, day_logs
+
+async def get_logs_for_day(db: AsyncSession, user_id: str, day: date):
+    """
+    指定日 (0:00〜23:59:59) の記録を取得する（日付カード単位の再描画用）
+    """
+    start = datetime.combine(day, time.min)
+    end = datetime.combine(day, time.max)
+    return await get_logs(db, user_id, start, end)
+
+async def get_previous_log_day(db: AsyncSession, user_id: str, day: date):
+    """
+    指定日より前で、記録が存在する直近の日付を返す（なければ None）
+    新しい日付カードを一覧の正しい位置に差し込むために使用する。
+    """
+    query = text("""
+        SELECT MAX(done_at) FROM hadbit_logs
+        WHERE user_id = :user_id AND done_at < :day_start
+    """)
+    result = (await db.execute(query, {"user_id": user_id, "day_start": datetime.combine(day, time.min)})).scalar()
+    return result.date() if result else None
+
+def group_logs_by_day(logs):
+    """
+    done_at の降順に並んだ記録を日付ごとにまとめる
+    戻り値: [("YYYY-MM-DD", [log, ...]), ...]
+    """
+    days = []
+    for log in logs:
+        day = log.done_at.strftime('%Y-%m-%d')
+        if not days or days[-1][0] != day:
+            days.append((day, []))
+        days[-1][1].append(log)
+    return days
+
+async def get_logs_compact(db: AsyncSession, user_id: str, start_date: str | datetime = None, end_date: str | datetime = None):
+    """
+    記録を列ごとの配列として1行で取得する (/api/hadbit/records/logs 用)
+    get_logs と違い項目名を記録ごとに結合せず、ユーザーの項目一覧を別の配列で1回だけ返す
+    done_at はタイムゾーンなしの日時をそのまま UTC とみなしたエポック秒 (壁時計の時刻を保つ)
+    """
+    start_date, end_date = resolve_log_period(start_date, end_date)
+    # 記録と項目は別々に集約して結合する (記録側を項目の配列でグループ化すると、その並べ替えが重い)
+    sql = text("""
+        SELECT logs.*, items.*
+        FROM (
+            SELECT
+                COALESCE(array_agg(id ORDER BY done_at DESC, id DESC), '{}') AS log_ids,
+                COALESCE(array_agg(CAST(EXTRACT(EPOCH FROM done_at) AS bigint) ORDER BY done_at DESC, id DESC), '{}') AS times,
+                COALESCE(array_agg(item_id ORDER BY done_at DESC, id DESC), '{}') AS item_ids,
+                COALESCE(array_agg(comment ORDER BY done_at DESC, id DESC), '{}') AS comments
+            FROM hadbit_logs
+            WHERE user_id = :user_id
+              AND done_at BETWEEN :start_date AND :end_date
+        ) logs
+        CROSS JOIN (
+            SELECT
+                COALESCE(array_agg(item.id ORDER BY item.id), '{}') AS dict_item_ids,
+                COALESCE(array_agg(item.name ORDER BY item.id), '{}') AS dict_names,
+                COALESCE(array_agg(item.short_name ORDER BY item.id), '{}') AS dict_short_names,
+                COALESCE(array_agg(tree.parent_id ORDER BY item.id), '{}') AS dict_parent_ids
+            FROM hadbit_items item
+            INNER JOIN hadbit_trees tree ON tree.item_id = item.id
+            WHERE item.user_id = :user_id
+        ) items
+    """)
+    params = {"user_id": user_id, "start_date": start_date, "end_date": end_date}
+    row = (await db.execute(sql, params)).fetchone()
+    return encode_logs_payload(row, start_date, end_date)
+
+def encode_logs_payload(row, start_date: datetime, end_date: datetime):
+    """
+    get_logs_compact の結果を辞書エンコードした JSON 用の dict に変換する
+    - items: 項目ID → {name, short_name, parent_id}。記録ごとには項目名を持たせない
+    - logs: 記録の列ごとの配列 (id / t: エポック秒 / item: 項目ID / comment: comments の添字 or null)
+    - comments: 重複を除いたコメントの一覧
+    項目一覧に無い (ツリーから外れた) 項目の記録は除く (get_logs の INNER JOIN と同じ)
+    """
+    items = {
+        item_id: {"name": name, "short_name": short_name, "parent_id": parent_id}
+        for item_id, name, short_name, parent_id in zip(row.dict_item_ids, row.dict_names, row.dict_short_names, row.dict_parent_ids)
+    }
+    log_ids, times, item_ids, comment_refs = [], [], [], []
+    comments = {}
+    for log_id, t, item_id, comment in zip(row.log_ids, row.times, row.item_ids, row.comments):
+        if item_id not in items:
+            continue
+        log_ids.append(log_id)
+        times.append(t)
+        item_ids.append(item_id)
+        comment_refs.append(comments.setdefault(comment, len(comments)) if comment else None)
+    return {
+        "start": start_date.isoformat(),
+        "end": end_date.isoformat(),
+        "items": {str(item_id): item for item_id, item in items.items()},
+        "logs": {"id": log_ids, "t": times, "item": item_ids, "comment": comment_refs},
+        "comments": list(comments),
+    }
@@ -1,9 +1,53 @@
+import os
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy import event, text
 
-def get_hadbits(db: Session, user) :
+from app.services import metrics
+from app.services.cache import LRUCache
+from app.services.data_version_service import load_data_versions
+from app.services.fragment_cache import invalidate_fragments
+
+# 習慣の階層 (get_hadbits の結果) のユーザー別キャッシュ
+# キーは (user_id, 階層のバージョン)。階層のバージョンは hadbit_items / hadbit_trees の変更時のみトリガーで上がるため、
+# 他のワーカー・CLI・インポートでの変更でも古いエントリは参照されなくなり、記録の登録ではキャッシュが無効にならない
+_hierarchy_cache = LRUCache(
+    maxsize=int(os.getenv("HADBIT_HIERARCHY_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("HADBIT_HIERARCHY_CACHE_TTL", "600")),
+)
+HIERARCHY_CACHE_HITS = metrics.counter("hadbit_hierarchy_cache_hits_total", "get_hadbits のキャッシュヒット数")
+HIERARCHY_CACHE_MISSES = metrics.counter("hadbit_hierarchy_cache_misses_total", "get_hadbits のキャッシュミス数")
+metrics.gauge("hadbit_hierarchy_cache_entries", lambda: len(_hierarchy_cache), "get_hadbits のキャッシュ件数")
+
+# hadbit_trees.order_no の間隔。間を空けて採番しておくことで、移動時は移動する1行の更新だけで済む
+ORDER_GAP = 1024
+
+# セッションの info に、未コミットの階層変更があるユーザーIDを記録するキー
+_DIRTY_KEY = "hadbit_hierarchy_dirty"
+
+
+def invalidate_hierarchy(db: AsyncSession, user_id: str):
+    """
+    ユーザーの階層の変更を記録する（更新系の関数から呼ぶ）
+    コミットまでは同じセッションからの get_hadbits はキャッシュを使わない
+    (未コミットのデータバージョンでキャッシュすると、ロールバック後に同じバージョンが別の内容で使われるため)
+    """
+    db.info.setdefault(_DIRTY_KEY, set()).add(str(user_id))
+    # 項目名・並び順は記録一覧の描画結果にも含まれる
+    invalidate_fragments(db, user_id)
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _discard_dirty_after_transaction(session):
+    session.info.pop(_DIRTY_KEY, None)
+
+
+async def get_hadbits(db: AsyncSession, user, hierarchy_version: int = None) :
     """
     hadbits テーブルからユーザーの習慣を取得する (親子関係・順序考慮)
+    結果はユーザー・階層のバージョンごとにキャッシュする
+    hierarchy_version: 呼び出し側で取得済みの階層のバージョン (省略時はここで取得する)
     """
     # print(f"get_hadbits called for User(id={user.id}, email={user.email}, metadata={getattr(user, 'user_metadata', {})}) ")
     db_id = user.id
@@ -12,6 +56,21 @@ def get_hadbits(db: Session, user) :
     if db_id is None:
         return []
 
+    # 同じセッションに未コミットの変更がある場合は、自身の変更を読むためキャッシュを使わない
+    cacheable = str(db_id) not in db.info.get(_DIRTY_KEY, ())
+    if cacheable and hierarchy_version is None:
+        _, hierarchy_version = await load_data_versions(db, db_id)
+    # バージョンを取得できない場合 (テーブル未作成など) はキャッシュを使わない
+    cacheable = cacheable and hierarchy_version is not None
+    # クエリ実行前のバージョンで保存し、実行中に他のリクエストが更新した場合は古い結果として扱われるようにする
+    cache_key = (str(db_id), hierarchy_version)
+    if cacheable:
+        cached = _hierarchy_cache.get(cache_key)
+        if cached is not None:
+            HIERARCHY_CACHE_HITS.inc()
+            return [dict(row) for row in cached]
+    HIERARCHY_CACHE_MISSES.inc()
+
     # 再帰的CTEを使用して、habit_item_treeに基づく順序で取得
     query = text("""
         SELECT 
@@ -45,24 +104,43 @@ def get_hadbits(db: Session, user) :
         parent_sort_order, 
         child_sort_order;
     """)
-    result = db.execute(query, {"user_id": db_id})
-    return [dict(row._mapping) for row in result]
+    result = await db.execute(query, {"user_id": db_id})
+    hadbits = [dict(row._mapping) for row in result]
+    if cacheable:
+        _hierarchy_cache.set(cache_key, hadbits)
+        return [dict(row) for row in hadbits]
+    return hadbits
+
+def hadbit_parents(hadbits):
+    """
+    get_hadbits の結果から親項目 (種別) を、並び順のまま重複なく返す
+    戻り値: [{"id", "name", "short_name"}, ...]
+    """
+    parents = {}
+    for hadbit in hadbits:
+        if hadbit["parent_id"] not in parents:
+            parents[hadbit["parent_id"]] = {
+                "id": hadbit["parent_id"],
+                "name": hadbit["parent_name"],
+                "short_name": hadbit["parent_short_name"],
+            }
+    return list(parents.values())
 
-def get_parent_hadbit_items(db: Session, user_id: str):
+async def get_parent_hadbit_items(db: AsyncSession, user_id: str):
     """
     親項目（種別）の一覧を取得する
     """
     query = text("""
-        SELECT i.id, i.name 
+        SELECT i.id, i.name, i.short_name 
         FROM hadbit_items i
         JOIN hadbit_trees t ON i.id = t.item_id
         WHERE t.parent_id = 0 AND i.user_id = :user_id AND i.is_deleted = false
         ORDER BY t.order_no
     """)
-    result = db.execute(query, {"user_id": user_id}).fetchall()
+    result = (await db.execute(query, {"user_id": user_id})).fetchall()
     return [dict(row._mapping) for row in result]
 
-def get_hadbit_tree_max_sort_order(db: Session, user_id: str, parent_id: int = 0) -> int:
+async def get_hadbit_tree_max_sort_order(db: AsyncSession, user_id: str, parent_id: int = 0) -> int:
     """
     hadbit_trees テーブルから、指定ユーザー・指定親ID配下の最大order_noを取得する
     """
@@ -70,11 +148,11 @@ def get_hadbit_tree_max_sort_order(db: Session, user_id: str, parent_id: int = 0
 SELECT MAX(order_no) 
 FROM hadbit_trees 
 WHERE user_id = :user_id AND parent_id = :parent_id""")
-    result = db.execute(query, {"user_id": user_id, "parent_id": parent_id}).scalar()
+    result = (await db.execute(query, {"user_id": user_id, "parent_id": parent_id})).scalar()
     return result if result is not None else 0
 
-def create_hadbit_tree(
-        db: Session, 
+async def create_hadbit_tree(
+        db: AsyncSession, 
         item_id: int, 
         user_id: str, 
         parent_id: int, 
@@ -87,14 +165,15 @@ def create_hadbit_tree(
 INSERT INTO hadbit_trees (item_id, user_id, parent_id, order_no)
 VALUES (:item_id, :user_id, :parent_id, :order_no)
     """)
-    db.execute(query, {
+    await db.execute(query, {
         "item_id": item_id,
         "user_id": user_id,
         "parent_id": parent_id,
         "order_no": order_no
     })
+    invalidate_hierarchy(db, user_id)
 
-def create_hadbit_item(db: Session, user_id: str, name: str, short_name: str = "", description: str = "") -> int:
+async def create_hadbit_item(db: AsyncSession, user_id: str, name: str, short_name: str = "", description: str = "") -> int:
     """
     hadbit_items テーブルに新しいレコードを作成し、IDを返す
     """
@@ -103,15 +182,16 @@ INSERT INTO hadbit_items (user_id, name, short_name, description)
 VALUES (:user_id, :name, :short_name, :description)
 RETURNING id
     """)
-    result = db.execute(query, {
+    result = (await db.execute(query, {
         "user_id": user_id,
         "name": name,
         "short_name": short_name,
         "description": description
-    }).scalar()
+    })).scalar()
+    invalidate_hierarchy(db, user_id)
     return result
 
-def get_hadbit_item(db: Session, item_id: int, user_id: str):
+async def get_hadbit_item(db: AsyncSession, item_id: int, user_id: str):
     """
     IDを指定してhadbit_itemsのレコードを取得する
     """
@@ -122,10 +202,10 @@ def get_hadbit_item(db: Session, item_id: int, user_id: str):
         LEFT JOIN hadbit_items p ON t.parent_id = p.id
         WHERE i.id = :id AND i.user_id = :user_id
     """)
-    result = db.execute(query, {"id": item_id, "user_id": user_id}).fetchone()
+    result = (await db.execute(query, {"id": item_id, "user_id": user_id})).fetchone()
     return dict(result._mapping) if result else None
 
-def update_hadbit_item(db: Session, item_id: int, user_id: str, name: str, short_name: str, description: str, new_parent_id: int = None):
+async def update_hadbit_item(db: AsyncSession, item_id: int, user_id: str, name: str, short_name: str, description: str, new_parent_id: int = None):
     """
     hadbit_items テーブルのレコードを更新する
     """
@@ -134,24 +214,25 @@ UPDATE hadbit_items
 SET name = :name, short_name = :short_name, description = :description
 WHERE id = :id AND user_id = :user_id
     """)
-    db.execute(query, {
+    await db.execute(query, {
         "id": item_id,
         "user_id": user_id,
         "name": name,
         "short_name": short_name,
         "description": description
     })
+    invalidate_hierarchy(db, user_id)
 
     # 親IDが指定されており、かつ変更がある場合は移動処理を行う
     if new_parent_id is not None:
         # 現在の親IDを取得
         curr_query = text("SELECT parent_id FROM hadbit_trees WHERE item_id = :item_id AND user_id = :user_id")
-        curr = db.execute(curr_query, {"item_id": item_id, "user_id": user_id}).fetchone()
+        curr = (await db.execute(curr_query, {"item_id": item_id, "user_id": user_id})).fetchone()
         
         if curr and curr.parent_id != new_parent_id:
-            # 移動先の親における最大order_noを取得して+1する
-            max_order = get_hadbit_tree_max_sort_order(db, user_id, new_parent_id)
-            new_order = (max_order or 0) + 1
+            # 移動先の親における最大order_noを取得して末尾に追加する
+            max_order = await get_hadbit_tree_max_sort_order(db, user_id, new_parent_id)
+            new_order = (max_order or 0) + ORDER_GAP
             
             # ツリー情報を更新
             update_tree = text("""
@@ -159,91 +240,191 @@ WHERE id = :id AND user_id = :user_id
                 SET parent_id = :pid, order_no = :ord 
                 WHERE item_id = :iid AND user_id = :uid
             """)
-            db.execute(update_tree, {
+            await db.execute(update_tree, {
                 "pid": new_parent_id,
                 "ord": new_order,
                 "iid": item_id,
                 "uid": user_id
             })
 
-def delete_hadbit_item(db: Session, item_id: int, user_id: str):
+async def delete_hadbit_item(db: AsyncSession, item_id: int, user_id: str):
     """
     論理削除を行う（is_deletedフラグを立てる）
     """
     query = text("UPDATE hadbit_items SET is_deleted = true WHERE id = :id AND user_id = :user_id")
-    db.execute(query, {"id": item_id, "user_id": user_id})
+    await db.execute(query, {"id": item_id, "user_id": user_id})
+    invalidate_hierarchy(db, user_id)
 
-def restore_hadbit_item(db: Session, item_id: int, user_id: str):
+async def restore_hadbit_item(db: AsyncSession, item_id: int, user_id: str):
     """
     削除を取り消す（is_deletedフラグを下ろす）
     """
     query = text("UPDATE hadbit_items SET is_deleted = false WHERE id = :id AND user_id = :user_id")
-    db.execute(query, {"id": item_id, "user_id": user_id})
-
-def update_hadbit_tree_order(db: Session, user_id: str, item_ids: list[int]):
-    """
-    渡されたitem_idのリスト順にorder_noを更新する
-    """
-    for index, item_id in enumerate(item_ids):
-        query = text("""
-            UPDATE hadbit_trees 
-            SET order_no = :order_no 
-            WHERE item_id = :item_id AND user_id = :user_id
-        """)
-        db.execute(query, {"order_no": index + 1, "item_id": item_id, "user_id": user_id})
-
-
-
-def move_hadbit_item_up(db: Session, user_id: int, child_id: int):
-    """
-    指定されたアイテムを一つ上に移動（sort_orderを入れ替え）
-    """
-    # 1. 対象アイテムを取得
-    query_curr = text("SELECT item_id, parent_id, order_no FROM hadbit_trees WHERE user_id = :uid AND item_id = :cid")
-    curr = db.execute(query_curr, {"uid": user_id, "cid": child_id}).fetchone()
-
-    if curr:
-        # 2. 一つ上のアイテム（交換対象）を探す
-        query_prev = text("""
-            SELECT item_id, order_no FROM hadbit_trees 
-            WHERE user_id = :uid AND parent_id = :pid AND order_no < :so 
-            ORDER BY order_no DESC LIMIT 1
-        """)
-        prev = db.execute(query_prev, {"uid": user_id, "pid": curr.parent_id, "so": curr.order_no}).fetchone()
-
-        # 3. 見つかれば sort_order を入れ替える
-        if prev:
-            update_sql = text("""
-UPDATE 
-hadbit_trees SET order_no = :so 
-WHERE user_id = :uid AND item_id = :cid""")
-            db.execute(update_sql, 
-                    {"so": prev.order_no, 
-                    "uid": user_id, 
-                    "cid": curr.item_id
-                    }
-                )
-            db.execute(update_sql, {"so": curr.order_no, "uid": user_id, "cid": prev.item_id})
-
-def move_hadbit_item_down(db: Session, user_id: int, child_id: int):
-    """
-    指定されたアイテムを一つ下に移動（sort_orderを入れ替え）
-    """
-    # 1. 対象アイテムを取得
-    query_curr = text("SELECT item_id, parent_id, order_no FROM hadbit_trees WHERE user_id = :uid AND item_id = :cid")
-    curr = db.execute(query_curr, {"uid": user_id, "cid": child_id}).fetchone()
-
-    if curr:
-        # 2. 一つ下のアイテム（交換対象）を探す
-        query_next = text("""
-            SELECT item_id, order_no FROM hadbit_trees 
-            WHERE user_id = :uid AND parent_id = :pid AND order_no > :so 
-            ORDER BY order_no ASC LIMIT 1
-        """)
-        next_item = db.execute(query_next, {"uid": user_id, "pid": curr.parent_id, "so": curr.order_no}).fetchone()
-
-        # 3. 見つかれば sort_order を入れ替える
-        if next_item:
-            update_sql = text("UPDATE hadbit_trees SET order_no = :so WHERE user_id = :uid AND item_id = :cid")
-            db.execute(update_sql, {"so": next_item.order_no, "uid": user_id, "cid": curr.item_id})
-            db.execute(update_sql, {"so": curr.order_no, "uid": user_id, "cid": next_item.item_id})
+    await db.execute(query, {"id": item_id, "user_id": user_id})
+    invalidate_hierarchy(db, user_id)
+
+async def update_hadbit_tree_order(db: AsyncSession, user_id: str, item_ids: list[int], parent_id: int = None) -> int:
+    """
+    渡されたitem_idのリスト順にorder_noを ORDER_GAP 間隔で振り直す
+    配列を unnest して結合する1文のUPDATEで、件数に関わらず1往復で更新する。
+    parent_id を指定した場合は、その親の配下にある項目のみを更新対象とする。
+    戻り値: 更新した件数
+    """
+    if not item_ids:
+        return 0
+
+    parent_clause = "AND t.parent_id = :parent_id" if parent_id is not None else ""
+    query = text(f"""
+        UPDATE hadbit_trees t
+        SET order_no = v.ord * :gap
+        FROM unnest(CAST(:item_ids AS integer[])) WITH ORDINALITY AS v(item_id, ord)
+        WHERE t.item_id = v.item_id
+          AND t.user_id = :user_id
+          {parent_clause}
+    """)
+    params = {"item_ids": list(item_ids), "user_id": user_id, "gap": ORDER_GAP}
+    if parent_id is not None:
+        params["parent_id"] = parent_id
+    result = await db.execute(query, params)
+    invalidate_hierarchy(db, user_id)
+    return result.rowcount
+
+async def move_hadbit_item(db: AsyncSession, user_id: str, item_id: int, position: int = None, offset: int = 0):
+    """
+    指定されたアイテムを同じ親の中で移動する
+    position: 移動先の位置 (0始まり)。省略時は現在位置 + offset (上へ1つ: -1 / 下へ1つ: +1)
+    位置は画面に表示される兄弟 (get_hadbits と同じく、削除済みの項目・子項目のない親項目を除く) の中で数える
+
+    兄弟の行をロックした上で、移動先の前後の order_no の中間値を1文で設定する。
+    order_no は ORDER_GAP 間隔で採番しているため、通常は移動する1行だけの更新で済む。
+    間隔を使い切っている場合のみ、兄弟全体を振り直す (renumber_hadbit_trees)。
+    戻り値: 移動後の位置 (対象が見つからない場合は None)
+    """
+    query = text("""
+        WITH locked AS (
+            SELECT item_id, parent_id, order_no
+            FROM hadbit_trees
+            WHERE user_id = :user_id
+              AND parent_id = (SELECT parent_id FROM hadbit_trees WHERE item_id = :item_id AND user_id = :user_id)
+            ORDER BY item_id
+            FOR UPDATE
+        ), cur AS (
+            SELECT item_id, parent_id, order_no FROM locked WHERE item_id = :item_id
+        ), sib AS (
+            -- 画面に表示される兄弟のみ (削除済みの項目、親項目の場合は表示される子項目のないものを除く)
+            SELECT locked.item_id, locked.order_no, row_number() OVER (ORDER BY locked.order_no, locked.item_id) AS rn
+            FROM locked
+            INNER JOIN hadbit_items item ON item.id = locked.item_id AND item.is_deleted = false
+            WHERE locked.item_id <> :item_id
+              AND (locked.parent_id <> 0 OR EXISTS (
+                  SELECT 1
+                  FROM hadbit_trees child_tree
+                  INNER JOIN hadbit_items child_item ON child_item.id = child_tree.item_id AND child_item.is_deleted = false
+                  WHERE child_tree.parent_id = locked.item_id AND child_tree.user_id = :user_id
+              ))
+        ), pos AS (
+            SELECT
+                cur_idx,
+                LEAST(GREATEST(COALESCE(CAST(:position AS integer), cur_idx + CAST(:offset AS integer)), 0),
+                      (SELECT COUNT(*) FROM sib)) AS p
+            FROM (
+                SELECT COUNT(*) FILTER (WHERE (sib.order_no, sib.item_id) < (cur.order_no, cur.item_id)) AS cur_idx
+                FROM cur LEFT JOIN sib ON true
+            ) idx
+        ), target AS (
+            SELECT
+                pos.p,
+                pos.cur_idx,
+                b.lo_item_id,
+                CASE
+                    WHEN lo IS NULL AND hi IS NULL THEN CAST(:gap AS integer)
+                    WHEN lo IS NULL THEN hi - CAST(:gap AS integer)
+                    WHEN hi IS NULL THEN lo + CAST(:gap AS integer)
+                    WHEN hi - lo > 1 THEN lo + (hi - lo) / 2
+                END AS new_order
+            FROM pos
+            CROSS JOIN LATERAL (
+                SELECT
+                    (SELECT item_id FROM sib WHERE rn = pos.p) AS lo_item_id,
+                    (SELECT order_no FROM sib WHERE rn = pos.p) AS lo,
+                    (SELECT order_no FROM sib WHERE rn = pos.p + 1) AS hi
+            ) b
+        ), upd AS (
+            UPDATE hadbit_trees t
+            SET order_no = target.new_order
+            FROM target
+            WHERE t.item_id = :item_id
+              AND t.user_id = :user_id
+              AND target.p <> target.cur_idx
+              AND target.new_order IS NOT NULL
+            RETURNING t.item_id
+        )
+        SELECT cur.parent_id, target.p AS position, target.cur_idx, target.new_order, target.lo_item_id
+        FROM cur CROSS JOIN target
+    """)
+    result = (await db.execute(query, {
+        "user_id": user_id,
+        "item_id": item_id,
+        "position": position,
+        "offset": offset,
+        "gap": ORDER_GAP,
+    })).fetchone()
+    if not result:
+        return None
+
+    if result.position != result.cur_idx:
+        if result.new_order is None:
+            # 前後の order_no に間隔が残っていない → 兄弟全体を振り直して移動する
+            await renumber_hadbit_trees(db, user_id, result.parent_id, item_id, result.lo_item_id)
+        invalidate_hierarchy(db, user_id)
+    return result.position
+
+async def renumber_hadbit_trees(db: AsyncSession, user_id: str, parent_id: int, item_id: int = None, after_item_id: int = None):
+    """
+    指定された親の配下の order_no を ORDER_GAP 間隔で振り直す
+    item_id を指定した場合は、その項目を after_item_id の直後 (省略時は先頭) に置いて振り直す
+    """
+    query = text("""
+        WITH ranked AS (
+            SELECT item_id, row_number() OVER (PARTITION BY item_id = :item_id ORDER BY order_no NULLS LAST, item_id) AS rn
+            FROM hadbit_trees
+            WHERE user_id = :user_id AND parent_id = :parent_id
+        ), keyed AS (
+            SELECT
+                item_id,
+                CASE
+                    WHEN item_id = :item_id THEN COALESCE((SELECT rn FROM ranked WHERE item_id = :after_item_id), 0) * 2 + 1
+                    ELSE rn * 2
+                END AS sort_key
+            FROM ranked
+        ), v AS (
+            SELECT item_id, row_number() OVER (ORDER BY sort_key) * CAST(:gap AS integer) AS new_order
+            FROM keyed
+        )
+        UPDATE hadbit_trees t
+        SET order_no = v.new_order
+        FROM v
+        WHERE t.item_id = v.item_id
+          AND t.user_id = :user_id
+          AND t.order_no IS DISTINCT FROM v.new_order
+    """)
+    await db.execute(query, {
+        "user_id": user_id,
+        "parent_id": parent_id,
+        "item_id": item_id if item_id is not None else -1,
+        "after_item_id": after_item_id if after_item_id is not None else -1,
+        "gap": ORDER_GAP,
+    })
+    invalidate_hierarchy(db, user_id)
+
+async def move_hadbit_item_up(db: AsyncSession, user_id: str, child_id: int):
+    """
+    指定されたアイテムを一つ上に移動
+    """
+    return await move_hadbit_item(db, user_id, child_id, offset=-1)
+
+async def move_hadbit_item_down(db: AsyncSession, user_id: str, child_id: int):
+    """
+    指定されたアイテムを一つ下に移動
+    """
+    return await move_hadbit_item(db, user_id, child_id, offset=1)
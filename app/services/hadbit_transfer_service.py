@@ -0,0 +1,274 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import text
+
+from app.services.hadbit_service import invalidate_hierarchy, ORDER_GAP
+from app.services.hadbit_record_service import rebuild_daily_counts
+from app.services.fragment_cache import invalidate_fragments
+
+# エクスポート・インポートの列 (CSV のヘッダー / NDJSON のキー)
+LOG_COLUMNS = ["done_at", "parent_name", "item_name", "comment"]
+# エクスポート時にサーバーサイドカーソルから一度に読み込む件数 (この件数ごとにクライアントへ送る)
+EXPORT_CHUNK_SIZE = 1000
+# インポート時に1回の COPY で登録する件数
+IMPORT_CHUNK_SIZE = 5000
+# インポート結果に含めるエラーの最大件数
+IMPORT_MAX_ERRORS = 20
+
+JST = timezone(timedelta(hours=9))
+
+
+async def stream_export(db: AsyncSession, user_id: str, fmt: str = "csv"):
+    """
+    ユーザーの記録 (と NDJSON の場合は項目) をサーバーサイドカーソルで読みながら、
+    EXPORT_CHUNK_SIZE 件ごとの文字列として返す (StreamingResponse 用)
+    - csv: done_at,parent_name,item_name,comment のヘッダー付き
+    - ndjson: 先頭に {"type": "item", ...} を項目の数だけ、続けて {"type": "log", ...} を記録の数だけ
+    """
+    if fmt == "ndjson":
+        items = await db.execute(text("""
+            SELECT pitem.name AS parent_name, citem.name, citem.short_name
+            FROM hadbit_items citem
+            INNER JOIN hadbit_trees tree ON tree.item_id = citem.id
+            LEFT JOIN hadbit_items pitem ON pitem.id = tree.parent_id
+            WHERE citem.user_id = :user_id AND citem.is_deleted = false
+            ORDER BY tree.parent_id, tree.order_no
+        """), {"user_id": user_id})
+        yield "".join(
+            json.dumps({"type": "item", "parent_name": row.parent_name, "name": row.name, "short_name": row.short_name}, ensure_ascii=False) + "\n"
+            for row in items
+        )
+
+    sql = text("""
+        SELECT logs.done_at, pitem.name AS parent_name, citem.name AS item_name, logs.comment
+        FROM hadbit_logs logs
+        INNER JOIN hadbit_items citem ON citem.id = logs.item_id
+        INNER JOIN hadbit_trees tree ON tree.item_id = logs.item_id
+        INNER JOIN hadbit_items pitem ON pitem.id = tree.parent_id
+        WHERE logs.user_id = :user_id
+        ORDER BY logs.done_at, logs.id
+    """)
+    result = await db.stream(sql.execution_options(yield_per=EXPORT_CHUNK_SIZE), {"user_id": user_id})
+
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(LOG_COLUMNS)
+        async for partition in result.partitions():
+            for row in partition:
+                writer.writerow([row.done_at.isoformat(sep=" ") if row.done_at else "", row.parent_name, row.item_name, row.comment or ""])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        async for partition in result.partitions():
+            yield "".join(
+                json.dumps({
+                    "type": "log",
+                    "done_at": row.done_at.isoformat() if row.done_at else None,
+                    "parent_name": row.parent_name,
+                    "item_name": row.item_name,
+                    "comment": row.comment,
+                }, ensure_ascii=False) + "\n"
+                for row in partition
+            )
+
+
+def read_import_rows(file, fmt: str):
+    """
+    インポートファイル (バイナリのファイルオブジェクト) を1行ずつ読み、(行番号, dict, エラー) を返すジェネレーター
+    NDJSON の "type": "item" の行は項目定義として、その他は記録として扱う
+    JSON として読めない行・オブジェクトでない行・値が文字列でない行は、dict を None にしてエラーの内容を返す
+    """
+    stream = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    try:
+        if fmt == "csv":
+            for line_no, row in enumerate(csv.DictReader(stream), start=2):
+                yield line_no, row, None
+        else:
+            for line_no, line in enumerate(stream, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    yield line_no, None, "JSON の形式が正しくありません"
+                    continue
+                yield line_no, *validate_import_row(row)
+    finally:
+        # 呼び出し側で seek して再度読めるよう、元のファイルは閉じない
+        stream.detach()
+
+
+def validate_import_row(row):
+    """
+    NDJSON の1行の値を確認する
+    戻り値: (row, None)、問題がある場合は (None, エラーの内容)
+    """
+    if not isinstance(row, dict):
+        return None, "1行に1つの JSON オブジェクトを指定してください"
+    invalid = [key for key in ("type", "name", "short_name", *LOG_COLUMNS) if row.get(key) is not None and not isinstance(row[key], str)]
+    if invalid:
+        return None, f"{', '.join(invalid)} は文字列で指定してください"
+    return row, None
+
+
+def parse_done_at(value: str) -> datetime:
+    """
+    インポートの done_at を、DBに保存する形式 (タイムゾーンなしの日本時間) に変換する
+    """
+    done_at = datetime.fromisoformat(value.strip())
+    if done_at.tzinfo is not None:
+        done_at = done_at.astimezone(JST).replace(tzinfo=None)
+    return done_at
+
+
+async def resolve_import_items(db: AsyncSession, user_id: str, names: dict, parent_names=()):
+    """
+    インポートファイルに含まれる (親項目名, 項目名) を項目IDに解決する。存在しない項目はまとめて作成する
+    names: {(parent_name, item_name): short_name}
+    parent_names: 子項目がなくても作成する親項目名 (NDJSON の親項目の定義行)
+    戻り値: ({(parent_name, item_name): item_id}, 作成した項目数)
+    """
+    rows = (await db.execute(text("""
+        SELECT citem.id, citem.name, tree.parent_id, pitem.name AS parent_name
+        FROM hadbit_items citem
+        INNER JOIN hadbit_trees tree ON tree.item_id = citem.id
+        LEFT JOIN hadbit_items pitem ON pitem.id = tree.parent_id
+        WHERE citem.user_id = :user_id AND citem.is_deleted = false
+    """), {"user_id": user_id})).fetchall()
+    parents = {row.name: row.id for row in rows if not row.parent_id}
+    children = {(row.parent_name, row.name): row.id for row in rows if row.parent_id}
+    created = 0
+
+    # 親項目 (種別) の作成
+    new_parents = sorted({parent for parent, _ in names if parent not in parents} | {parent for parent in parent_names if parent not in parents})
+    if new_parents:
+        result = await db.execute(text("""
+            WITH base AS (
+                SELECT COALESCE(MAX(order_no), 0) AS max_order FROM hadbit_trees WHERE user_id = :user_id AND parent_id = 0
+            ), ins AS (
+                INSERT INTO hadbit_items (user_id, name, short_name, description)
+                SELECT :user_id, name, name, '' FROM unnest(CAST(:names AS text[])) WITH ORDINALITY AS n(name, ord)
+                ORDER BY ord
+                RETURNING id, name
+            ), tree AS (
+                INSERT INTO hadbit_trees (item_id, user_id, parent_id, order_no)
+                SELECT ins.id, :user_id, 0, base.max_order + :gap * ROW_NUMBER() OVER (ORDER BY ins.id)
+                FROM ins CROSS JOIN base
+            )
+            SELECT id, name FROM ins
+        """), {"user_id": user_id, "names": new_parents, "gap": ORDER_GAP})
+        for row in result:
+            parents[row.name] = row.id
+        created += len(new_parents)
+
+    # 子項目の作成
+    new_children = sorted(key for key in names if key not in children)
+    if new_children:
+        result = await db.execute(text("""
+            WITH ins AS (
+                INSERT INTO hadbit_items (user_id, name, short_name, description)
+                SELECT :user_id, n.name, n.short_name, '' FROM unnest(
+                    CAST(:names AS text[]), CAST(:short_names AS text[]), CAST(:parent_ids AS integer[])
+                ) WITH ORDINALITY AS n(name, short_name, parent_id, ord)
+                ORDER BY n.ord
+                RETURNING id
+            ), numbered AS (
+                SELECT id, ROW_NUMBER() OVER (ORDER BY id) AS ord FROM ins
+            ), src AS (
+                SELECT n.parent_id, n.ord FROM unnest(CAST(:parent_ids AS integer[])) WITH ORDINALITY AS n(parent_id, ord)
+            ), tree AS (
+                INSERT INTO hadbit_trees (item_id, user_id, parent_id, order_no)
+                SELECT numbered.id, :user_id, src.parent_id,
+                       COALESCE((SELECT MAX(order_no) FROM hadbit_trees t WHERE t.user_id = :user_id AND t.parent_id = src.parent_id), 0)
+                       + :gap * ROW_NUMBER() OVER (PARTITION BY src.parent_id ORDER BY numbered.ord)
+                FROM numbered INNER JOIN src ON src.ord = numbered.ord
+            )
+            SELECT id FROM numbered ORDER BY ord
+        """), {
+            "user_id": user_id,
+            "names": [name for _, name in new_children],
+            "short_names": [names[key] or key[1] for key in new_children],
+            "parent_ids": [parents[parent] for parent, _ in new_children],
+            "gap": ORDER_GAP,
+        })
+        for key, row in zip(new_children, result):
+            children[key] = row.id
+        created += len(new_children)
+
+    if created:
+        invalidate_hierarchy(db, user_id)
+    return children, created
+
+
+async def _copy_logs(db: AsyncSession, records: list):
+    """
+    記録を COPY でまとめて登録する (asyncpg の copy_records_to_table を使用)
+    """
+    connection = await db.connection()
+    raw = await connection.get_raw_connection()
+    await raw.driver_connection.copy_records_to_table(
+        "hadbit_logs", records=records, columns=["user_id", "item_id", "done_at", "comment"]
+    )
+
+
+async def import_logs(db: AsyncSession, user_id: str, file, fmt: str = "csv"):
+    """
+    CSV / NDJSON の記録を一括登録する (コミットは呼び出し側で行う)
+    1. ファイルを1回読んで、(親項目名, 項目名) の一覧を集め、項目IDへの解決・未登録の項目の作成をまとめて行う
+    2. もう1回読みながら IMPORT_CHUNK_SIZE 件ずつ COPY で登録する
+    3. 日別集計 (hadbit_daily_counts) をユーザー単位で作り直す
+    戻り値: {"imported", "created_items", "skipped", "errors"}
+    """
+    names, parent_names = {}, set()
+    for _, row, error in read_import_rows(file, fmt):
+        if error:
+            continue
+        if row.get("type") == "item":
+            if row.get("parent_name") and row.get("name"):
+                names[(row["parent_name"], row["name"])] = row.get("short_name")
+            elif row.get("name"):
+                # parent_name のない項目の定義行は親項目 (種別)
+                parent_names.add(row["name"])
+        elif row.get("parent_name") and row.get("item_name"):
+            names.setdefault((row["parent_name"], row["item_name"]), None)
+    item_ids, created = await resolve_import_items(db, user_id, names, parent_names)
+
+    file.seek(0)
+    imported, skipped, errors, chunk = 0, 0, [], []
+    for line_no, row, error in read_import_rows(file, fmt):
+        if error is None:
+            if row.get("type") == "item":
+                continue
+            item_id = item_ids.get((row.get("parent_name"), row.get("item_name")))
+            try:
+                done_at = parse_done_at(row.get("done_at") or "")
+            except ValueError:
+                done_at = None
+            if item_id is None:
+                error = "parent_name / item_name がありません"
+            elif done_at is None:
+                error = f"done_at の形式が正しくありません ({row.get('done_at')})"
+        if error:
+            skipped += 1
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append(f"{line_no}行目: {error}")
+            continue
+        chunk.append((user_id, item_id, done_at, row.get("comment") or None))
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            await _copy_logs(db, chunk)
+            imported += len(chunk)
+            chunk = []
+    if chunk:
+        await _copy_logs(db, chunk)
+        imported += len(chunk)
+
+    if imported:
+        await rebuild_daily_counts(db, user_id)
+        invalidate_fragments(db, user_id)
+    return {"imported": imported, "created_items": created, "skipped": skipped, "errors": errors}
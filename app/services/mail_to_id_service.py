@@ -0,0 +1,57 @@
+import os
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import text
+
+from app.services.cache import LRUCache
+
+# mail → mail_to_id.id の対応はユーザー作成後に変わらないため、期限なしでキャッシュする
+_mail_id_cache = LRUCache(maxsize=int(os.getenv("MAIL_ID_CACHE_SIZE", "4096")))
+
+
+async def find_mail_id(db: AsyncSession, mail: str):
+    """
+    mail_to_id テーブルからメールアドレスに対応するIDを取得する (存在しなければ None)
+    """
+    mail_id = _mail_id_cache.get(mail)
+    if mail_id is not None:
+        return mail_id
+
+    query = text("SELECT id FROM mail_to_id WHERE mail = :mail")
+    result = (await db.execute(query, {"mail": mail})).fetchone()
+    if result:
+        _mail_id_cache.set(mail, result.id)
+        return result.id
+    return None
+
+
+async def resolve_mail_id(db: AsyncSession, mail: str):
+    """
+    メールアドレスに対応する mail_to_id のIDを取得する。なければ新規追加してIDを返す。
+    キャッシュにない場合のみ、INSERT ... ON CONFLICT を1文で実行する。
+    (mail_to_id.mail に一意制約が必要)
+    """
+    mail_id = _mail_id_cache.get(mail)
+    if mail_id is not None:
+        return mail_id
+
+    query = text("""
+        WITH ins AS (
+            INSERT INTO mail_to_id (mail) VALUES (:mail)
+            ON CONFLICT (mail) DO NOTHING
+            RETURNING id
+        )
+        SELECT id, true AS inserted FROM ins
+        UNION ALL
+        SELECT id, false AS inserted FROM mail_to_id WHERE mail = :mail
+        LIMIT 1
+    """)
+    result = (await db.execute(query, {"mail": mail})).fetchone()
+    if result is None:
+        # 他のリクエストが同時に同じメールアドレスを追加した場合、ON CONFLICT は何も返さず、
+        # 同じ文の SELECT は文の開始時点のスナップショットのため追加された行が見えない。別の文で取得し直す
+        return await find_mail_id(db, mail)
+    # 追加した場合のみコミットする
+    if result.inserted:
+        await db.commit()
+    _mail_id_cache.set(mail, result.id)
+    return result.id
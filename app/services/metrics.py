@@ -0,0 +1,101 @@
+import bisect
+import threading
+
+# ミリ秒単位の既定バケット (Histogram)
+DEFAULT_MS_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Counter:
+    """
+    単調増加するカウンター
+    """
+
+    def __init__(self, name: str, description: str = ""):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return {"type": "counter", "description": self.description, "value": self.value}
+
+
+class Histogram:
+    """
+    バケット境界ごとの件数・合計・件数を保持するヒストグラム
+    """
+
+    def __init__(self, name: str, description: str = "", buckets=DEFAULT_MS_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def snapshot(self):
+        labels = [f"le_{b}" for b in self.buckets] + ["le_inf"]
+        return {
+            "type": "histogram",
+            "description": self.description,
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "avg": round(self.sum / self.count, 3) if self.count else 0,
+            "max": round(self.max, 3),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class Gauge:
+    """
+    参照時に関数を呼び出して現在値を返すゲージ
+    """
+
+    def __init__(self, name: str, func, description: str = ""):
+        self.name = name
+        self.description = description
+        self.func = func
+
+    def snapshot(self):
+        try:
+            value = self.func()
+        except Exception:
+            value = None
+        return {"type": "gauge", "description": self.description, "value": value}
+
+
+_registry = {}
+
+
+def counter(name: str, description: str = "") -> Counter:
+    return _registry.setdefault(name, Counter(name, description))
+
+
+def histogram(name: str, description: str = "", buckets=DEFAULT_MS_BUCKETS) -> Histogram:
+    return _registry.setdefault(name, Histogram(name, description, buckets))
+
+
+def gauge(name: str, func, description: str = "") -> Gauge:
+    _registry[name] = Gauge(name, func, description)
+    return _registry[name]
+
+
+def snapshot() -> dict:
+    """
+    登録済みの全メトリクスの現在値を返す
+    """
+    return {name: metric.snapshot() for name, metric in sorted(_registry.items())}
@@ -0,0 +1,110 @@
+import contextvars
+import os
+import re
+from collections import Counter
+
+# リクエストあたりのSQL実行数のチェック
+#   off  : チェックしない (本番)
+#   warn : 予算超過・N+1 の疑いをログに出力する (開発)
+#   raise: QueryBudgetExceeded を送出する (テスト)
+QUERY_BUDGET_MODE = os.getenv("QUERY_BUDGET_MODE", "off").lower()
+# 予算を宣言していないルートに適用する上限 (0 以下で宣言済みのルートのみチェック)
+QUERY_BUDGET_DEFAULT = int(os.getenv("QUERY_BUDGET_DEFAULT", "0"))
+# 1リクエスト内で同じSQLがこの回数以上実行されたら N+1 の疑いとみなす
+QUERY_REPEAT_THRESHOLD = int(os.getenv("QUERY_REPEAT_THRESHOLD", "5"))
+
+_current = contextvars.ContextVar("query_budget_record", default=None)
+_whitespace = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(Exception):
+    """
+    リクエストのSQL実行数が予算を超えた、または同じSQLが繰り返し実行された
+    """
+
+
+class QueryRecord:
+    """
+    1リクエスト中に実行されたSQLの記録
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.statements = Counter()
+
+    def add(self, statement: str):
+        self.count += 1
+        self.statements[_whitespace.sub(" ", statement).strip()] += 1
+
+
+def query_budget(max_queries: int):
+    """
+    ルートの関数に、1リクエストあたりのSQL実行数の上限を宣言するデコレーター
+    (認証・依存関係で実行されるSQLも含む)
+
+        @router.get("/hadbit/items")
+        @query_budget(3)
+        async def hadbit_settings(...): ...
+    """
+    def decorator(func):
+        func.__query_budget__ = max_queries
+        return func
+    return decorator
+
+
+def enabled() -> bool:
+    return QUERY_BUDGET_MODE in ("warn", "raise")
+
+
+def start_request():
+    record = QueryRecord()
+    return record, _current.set(record)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def record_statement(statement: str):
+    """
+    SQLの実行を現在のリクエストに記録する (cursor イベントから呼ぶ。リクエスト外では何もしない)
+    """
+    record = _current.get()
+    if record is not None:
+        record.add(statement)
+
+
+def budget_for(endpoint):
+    """
+    ルートの関数に宣言された予算を返す。宣言がなければ QUERY_BUDGET_DEFAULT (0 以下なら None)
+    """
+    budget = getattr(endpoint, "__query_budget__", None)
+    if budget is None and QUERY_BUDGET_DEFAULT > 0:
+        budget = QUERY_BUDGET_DEFAULT
+    return budget
+
+
+def find_problems(record: QueryRecord, budget: int = None, repeat_threshold: int = QUERY_REPEAT_THRESHOLD):
+    """
+    予算超過・同じSQLの繰り返し (N+1 の疑い) を検出してメッセージのリストを返す
+    """
+    problems = []
+    if budget is not None and record.count > budget:
+        problems.append(f"SQL {record.count} 件 (予算 {budget} 件)")
+    for statement, count in record.statements.items():
+        if count >= repeat_threshold:
+            problems.append(f"同じSQLが {count} 回実行されています (N+1 の疑い): {statement[:200]}")
+    return problems
+
+
+def check(label: str, record: QueryRecord, endpoint):
+    """
+    リクエスト終了時のチェック。モードに応じてログ出力または例外を送出する
+    """
+    problems = find_problems(record, budget_for(endpoint))
+    if not problems:
+        return
+    message = f"Query budget: {label}: " + " / ".join(problems)
+    if QUERY_BUDGET_MODE == "raise":
+        raise QueryBudgetExceeded(message)
+    print(f"WARNING: {message}")
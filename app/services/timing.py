@@ -0,0 +1,104 @@
+import contextvars
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import jinja2
+
+# Server-Timing ヘッダー・タイミングログの設定
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").lower() in ("1", "true", "yes")
+# 処理時間がこのミリ秒以上のリクエストのみログに出力する (負の値でログ出力しない)
+SERVER_TIMING_LOG_MS = float(os.getenv("SERVER_TIMING_LOG_MS", "0"))
+
+# リクエスト単位の計測値 (区分名 → {"dur": 合計ミリ秒, "count": 回数})
+_timings = contextvars.ContextVar("request_timings", default=None)
+
+# Server-Timing に出力する区分と説明
+SEGMENTS = {
+    "auth": "get_current_user",
+    "db": "SQL",
+    "supabase": "Supabase API",
+    "render": "Jinja render",
+}
+
+
+def start_request():
+    """
+    リクエストの計測を開始する。戻り値は終了時に end_request に渡す。
+    """
+    timings = {}
+    return timings, _timings.set(timings)
+
+
+def end_request(token):
+    _timings.reset(token)
+
+
+def add(name: str, duration_ms: float):
+    """
+    現在のリクエストの区分 name に処理時間を加算する (リクエスト外では何もしない)
+    """
+    timings = _timings.get()
+    if timings is None:
+        return
+    entry = timings.setdefault(name, {"dur": 0.0, "count": 0})
+    entry["dur"] += duration_ms
+    entry["count"] += 1
+
+
+@contextmanager
+def timed(name: str):
+    """
+    with ブロック内の処理時間を区分 name に加算する
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, (time.perf_counter() - start) * 1000)
+
+
+def server_timing_header(timings: dict, total_ms: float) -> str:
+    """
+    計測値を Server-Timing ヘッダーの値に変換する
+    例: auth;dur=1.2;desc="get_current_user", db;dur=3.4;desc="SQL x3", total;dur=10.5
+    """
+    parts = []
+    for name, entry in timings.items():
+        desc = SEGMENTS.get(name, name)
+        if entry["count"] > 1:
+            desc = f"{desc} x{entry['count']}"
+        parts.append(f'{name};dur={entry["dur"]:.1f};desc="{desc}"')
+    parts.append(f"total;dur={total_ms:.1f}")
+    return ", ".join(parts)
+
+
+def log_request(method: str, path: str, status: int, timings: dict, total_ms: float):
+    """
+    リクエストの処理時間の内訳を1行のJSONとして出力する
+    """
+    if SERVER_TIMING_LOG_MS < 0 or total_ms < SERVER_TIMING_LOG_MS:
+        return
+    fields = {
+        "event": "request_timing",
+        "method": method,
+        "path": path,
+        "status": status,
+        "total_ms": round(total_ms, 1),
+    }
+    for name, entry in timings.items():
+        fields[f"{name}_ms"] = round(entry["dur"], 1)
+        fields[f"{name}_count"] = entry["count"]
+    print(json.dumps(fields, ensure_ascii=False), flush=True)
+
+
+class TimedTemplate(jinja2.Template):
+    """
+    render() の処理時間を区分 render に加算するテンプレート
+    (include / import されたテンプレートは親の render 内で描画されるため二重には数えない)
+    """
+
+    def render(self, *args, **kwargs):
+        with timed("render"):
+            return super().render(*args, **kwargs)
@@ -0,0 +1,145 @@
+import hashlib
+import os
+import time
+from pathlib import Path
+
+import httpx
+from dotenv import load_dotenv
+from jose import jwt, JWTError, ExpiredSignatureError
+
+from app.services.cache import LRUCache
+
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+load_dotenv(BASE_DIR / ".env")
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+# Supabase プロジェクトの JWT Secret (HS256)。未設定の場合は JWKS (非対称鍵) のみで検証する
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+
+# 検証済みトークンのキャッシュ設定
+TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "1024"))
+TOKEN_CACHE_TTL = float(os.getenv("AUTH_TOKEN_CACHE_TTL", "300"))
+# 有効期限がこの秒数以内に迫ったトークンはキャッシュせず、Supabase に問い合わせる
+TOKEN_EXPIRY_MARGIN = float(os.getenv("AUTH_TOKEN_EXPIRY_MARGIN", "60"))
+JWKS_TTL = float(os.getenv("AUTH_JWKS_TTL", "600"))
+
+_token_cache = LRUCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+_jwks_cache = LRUCache(maxsize=1, ttl=JWKS_TTL)
+
+
+class AuthUser:
+    """
+    ローカル検証した JWT のクレームから組み立てるユーザー。
+    アプリ内で参照している Supabase の User の属性 (id, email, user_metadata 等) のみを持つ。
+    """
+
+    def __init__(self, claims: dict):
+        self.id = claims.get("sub")
+        self.email = claims.get("email")
+        self.phone = claims.get("phone")
+        self.role = claims.get("role")
+        self.aud = claims.get("aud")
+        self.user_metadata = dict(claims.get("user_metadata") or {})
+        self.app_metadata = dict(claims.get("app_metadata") or {})
+
+    def __repr__(self):
+        return f"AuthUser(id={self.id}, email={self.email})"
+
+
+def _cache_key(access_token: str) -> str:
+    # トークン文字列そのものをメモリに保持しないようハッシュ化してキーにする
+    return hashlib.sha256(access_token.encode()).hexdigest()
+
+
+def _get_jwks():
+    """
+    Supabase の JWKS (公開鍵セット) を取得する。JWKS_TTL 秒間キャッシュする。
+    """
+    jwks = _jwks_cache.get("jwks")
+    if jwks is None and SUPABASE_URL:
+        response = httpx.get(f"{SUPABASE_URL}/auth/v1/.well-known/jwks.json", timeout=5.0)
+        response.raise_for_status()
+        jwks = response.json()
+        _jwks_cache.set("jwks", jwks)
+    return jwks
+
+
+def verify_access_token(access_token: str):
+    """
+    アクセストークンの署名・有効期限・audience をローカルで検証し、クレームを返す。
+    ローカル検証に必要な鍵がない場合は None を返す (呼び出し側で Supabase へ問い合わせる)。
+    期限切れや署名不正の場合は JWTError を送出する。
+    """
+    header = jwt.get_unverified_header(access_token)
+    algorithm = header.get("alg")
+
+    if algorithm == "HS256":
+        if not SUPABASE_JWT_SECRET:
+            return None
+        key = SUPABASE_JWT_SECRET
+    else:
+        key = _get_jwks()
+        if not key:
+            return None
+
+    return jwt.decode(access_token, key, algorithms=[algorithm], audience=JWT_AUDIENCE)
+
+
+def get_cached_user(access_token: str):
+    """
+    検証済みトークンに対応するユーザーをキャッシュから取得する。
+    """
+    return _token_cache.get(_cache_key(access_token))
+
+
+def cache_user(access_token: str, user, expires_at: float = None):
+    """
+    検証済みトークンとユーザーをキャッシュする。
+    有効期限 (exp) が TOKEN_EXPIRY_MARGIN 以内に迫っている場合はキャッシュしない。
+    """
+    if expires_at is None:
+        try:
+            expires_at = jwt.get_unverified_claims(access_token).get("exp")
+        except JWTError:
+            return
+    if not expires_at:
+        return
+
+    remaining = expires_at - time.time() - TOKEN_EXPIRY_MARGIN
+    if remaining <= 0:
+        return
+    _token_cache.set(_cache_key(access_token), user, ttl=min(TOKEN_CACHE_TTL, remaining))
+
+
+def authenticate_locally(access_token: str):
+    """
+    キャッシュ → ローカル JWT 検証 の順でユーザーを解決する。
+
+    戻り値は (user, needs_remote) のタプル。
+    - user: 解決できたユーザー (できなければ None)
+    - needs_remote: Supabase への問い合わせが必要か
+      (鍵がない・期限間近・鍵のローテーション等でローカル判定できない場合に True)
+    """
+    user = get_cached_user(access_token)
+    if user:
+        return user, False
+
+    try:
+        claims = verify_access_token(access_token)
+    except ExpiredSignatureError:
+        # 期限切れはリモートに問い合わせても失敗するため、リフレッシュ処理に任せる
+        return None, False
+    except (JWTError, httpx.HTTPError):
+        return None, True
+
+    if claims is None:
+        return None, True
+
+    exp = claims.get("exp")
+    if not exp or exp - time.time() <= TOKEN_EXPIRY_MARGIN:
+        return None, True
+
+    user = AuthUser(claims)
+    cache_user(access_token, user, exp)
+    return user, False
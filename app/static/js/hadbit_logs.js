@@ -0,0 +1,59 @@
+// 記録データ (直近1年) の共有ローダー
+// カレンダー・日付グリッドの各タブから呼ばれ、同じページ内では1回だけ取得する。
+// サーバーは ETag を返すため、ページを開き直してもデータに変更がなければ 304 (ブラウザのキャッシュ) で済む
+window.HadbitLogs = (function () {
+  let pending = null;
+
+  function load() {
+    if (!pending) {
+      pending = fetch("/api/hadbit/records/logs", { credentials: "same-origin" })
+        .then((res) => {
+          if (!res.ok) throw new Error(`記録の取得に失敗しました (${res.status})`);
+          return res.json();
+        })
+        .catch((err) => {
+          // 失敗した場合は次回呼び出し時に再取得する
+          pending = null;
+          throw err;
+        });
+    }
+    return pending;
+  }
+
+  function invalidate() {
+    pending = null;
+  }
+
+  // 辞書エンコードされたデータを、項目名を引いた記録の配列に展開する
+  // t はタイムゾーンなしの日時を UTC とみなしたエポック秒のため、UTC として整形すると記録時の時刻になる
+  function rows(data) {
+    const logs = data.logs;
+    const result = new Array(logs.id.length);
+    for (let i = 0; i < logs.id.length; i++) {
+      const item = data.items[logs.item[i]];
+      const parent = data.items[item.parent_id] || {};
+      const iso = new Date(logs.t[i] * 1000).toISOString().substring(0, 19);
+      result[i] = {
+        id: logs.id[i],
+        iso: iso,
+        date: iso.substring(0, 10),
+        item_id: logs.item[i],
+        child_name: item.name,
+        child_short_name: item.short_name,
+        parent_id: item.parent_id,
+        parent_name: parent.name,
+        parent_short_name: parent.short_name,
+        comment: logs.comment[i] === null ? null : data.comments[logs.comment[i]],
+      };
+    }
+    return result;
+  }
+
+  // 記録の登録・更新・削除 (GET 以外のリクエスト) の後は再取得させる
+  document.addEventListener("htmx:afterRequest", (evt) => {
+    const verb = evt.detail.requestConfig && evt.detail.requestConfig.verb;
+    if (verb && verb !== "get") invalidate();
+  });
+
+  return { load, invalidate, rows };
+})();
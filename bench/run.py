@@ -0,0 +1,277 @@
+"""
+エンドツーエンドの負荷ベンチマーク
+
+ローカルの PostgreSQL に合成データを投入し、アプリ (ASGI) に対して各ルートを指定の並列数で呼び出す。
+ルートごとにスループット、レイテンシ (p50 / p95 / p99)、1リクエストあたりのDBクエリ数を表示する。
+
+Supabase の認証はスタブ化する: SUPABASE_JWT_SECRET をベンチマーク用の値にし、
+その鍵で署名したアクセストークンを Cookie に載せる (ローカルの JWT 検証だけで認証が完了する)。
+
+使い方:
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/hadbit_bench \\
+        python -m bench.run --users 20 --items 15 --years 3 --concurrency 10 --requests 200
+
+    --migrate     : 実行前に migrations/ を適用する
+    --skip-seed   : 投入済みのデータをそのまま使う
+    --routes      : 対象ルートをカンマ区切りで指定 (既定: 全て)
+    --json PATH   : 結果を JSON でも保存する
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+BENCH_JWT_SECRET = "bench-jwt-secret-for-local-use-only"
+
+# 1リクエスト中に実行されたDBクエリ数 (リクエストごとに辞書を差し替える)
+_query_counter = contextvars.ContextVar("bench_query_counter", default=None)
+
+ROUTES = [
+    "records",
+    "records_calendar",
+    "records_heatmap",
+    "records_heatmap_counts",
+    "records_dategrid",
+    "records_logs",
+    "items",
+    "record_create",
+    "record_update",
+    "record_delete",
+]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="hadbit のエンドツーエンド負荷ベンチマーク")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"), help="ベンチマーク用DB (既定: BENCH_DATABASE_URL)")
+    parser.add_argument("--users", type=int, default=10, help="合成ユーザー数")
+    parser.add_argument("--items", type=int, default=15, help="ユーザーあたりの項目数")
+    parser.add_argument("--years", type=float, default=2, help="記録を生成する年数")
+    parser.add_argument("--logs-per-day", type=int, default=3, help="1日あたりの記録数")
+    parser.add_argument("--concurrency", type=int, default=10, help="同時実行数")
+    parser.add_argument("--requests", type=int, default=100, help="ルートあたりのリクエスト数")
+    parser.add_argument("--warmup", type=int, default=5, help="計測前のウォームアップ回数 (ルートごと)")
+    parser.add_argument("--routes", default=",".join(ROUTES), help="対象ルート (カンマ区切り)")
+    parser.add_argument("--migrate", action="store_true", help="実行前に migrations/ を適用する")
+    parser.add_argument("--skip-seed", action="store_true", help="データ投入を行わない")
+    parser.add_argument("--json", dest="json_path", help="結果を保存する JSON ファイル")
+    args = parser.parse_args(argv)
+    if not args.database_url:
+        parser.error("--database-url か BENCH_DATABASE_URL を指定してください (本番DBを誤って使わないよう DATABASE_URL は参照しません)")
+    unknown = set(args.routes.split(",")) - set(ROUTES)
+    if unknown:
+        parser.error(f"未知のルート: {', '.join(sorted(unknown))}")
+    return args
+
+
+def configure_environment(args):
+    """
+    アプリの import 前に環境変数を設定する (.env より優先される)
+    """
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ["SUPABASE_JWT_SECRET"] = BENCH_JWT_SECRET
+    # Supabase クライアントは生成されるが、ローカル検証で認証が完了するため呼び出されない
+    os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:54321")
+    os.environ.setdefault("SUPABASE_KEY", "bench")
+    os.environ["DB_POOL_SIZE"] = os.getenv("DB_POOL_SIZE", str(max(5, args.concurrency)))
+
+
+def mint_token(user: dict) -> str:
+    from jose import jwt
+
+    now = int(time.time())
+    claims = {
+        "sub": user["id"],
+        "email": user["email"],
+        "aud": "authenticated",
+        "role": "authenticated",
+        "iat": now,
+        "exp": now + 24 * 3600,
+        "user_metadata": {},
+    }
+    return jwt.encode(claims, BENCH_JWT_SECRET, algorithm="HS256")
+
+
+def percentile(sorted_values, p: float):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class RouteResult:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.queries = []
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        return {
+            "route": self.name,
+            "requests": count,
+            "errors": self.errors,
+            "rps": round(count / self.elapsed, 1) if self.elapsed else 0,
+            "p50_ms": round(percentile(latencies, 50), 1),
+            "p95_ms": round(percentile(latencies, 95), 1),
+            "p99_ms": round(percentile(latencies, 99), 1),
+            "max_ms": round(latencies[-1], 1) if latencies else 0,
+            "queries_avg": round(statistics.mean(self.queries), 1) if self.queries else 0,
+            "queries_max": max(self.queries) if self.queries else 0,
+        }
+
+
+def build_request(route: str, user: dict, state: dict):
+    """
+    ルート名から (method, path, kwargs) を組み立てる
+    """
+    hx = {"HX-Request": "true"}
+    if route == "records":
+        return "GET", "/hadbit/records", {}
+    if route == "records_calendar":
+        return "GET", "/hadbit/records/calendar", {}
+    if route == "records_heatmap":
+        return "GET", "/hadbit/records/heatmap", {}
+    if route == "records_heatmap_counts":
+        return "GET", "/api/hadbit/records/heatmap", {}
+    if route == "records_dategrid":
+        return "GET", "/hadbit/records/dategrid", {}
+    if route == "records_logs":
+        return "GET", "/api/hadbit/records/logs", {}
+    if route == "items":
+        return "GET", "/hadbit/items", {}
+    if route == "record_create":
+        return "POST", "/api/hadbit/records/create", {
+            "headers": hx,
+            "data": {"hadbit_item_id": random.choice(user["item_ids"]), "memo": "bench"},
+        }
+    if route == "record_update":
+        log_id = random.choice(state["log_ids"][user["id"]])
+        return "PUT", f"/api/hadbit/records/regist/{log_id}", {
+            "headers": hx,
+            "data": {"record_date": time.strftime("%Y-%m-%dT%H:%M"), "memo": "bench-updated"},
+        }
+    if route == "record_delete":
+        log_ids = state["log_ids"][user["id"]]
+        log_id = log_ids.pop() if log_ids else 0
+        return "DELETE", f"/api/logs/delete/{log_id}", {"headers": hx}
+    raise ValueError(route)
+
+
+async def run_route(client, route: str, users: list, tokens: dict, state: dict, total: int, concurrency: int, record: bool = True):
+    result = RouteResult(route)
+    queue = asyncio.Queue()
+    for _ in range(total):
+        queue.put_nowait(None)
+
+    async def worker():
+        while True:
+            try:
+                queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            user = random.choice(users)
+            method, path, kwargs = build_request(route, user, state)
+            counter = {"queries": 0}
+            token = _query_counter.set(counter)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, cookies={"access_token": tokens[user["id"]]}, **kwargs)
+                if response.status_code >= 400:
+                    result.errors += 1
+            except Exception as e:
+                result.errors += 1
+                print(f"[{route}] request failed: {e}", file=sys.stderr)
+            finally:
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                _query_counter.reset(token)
+            if record:
+                result.latencies.append(elapsed_ms)
+                result.queries.append(counter["queries"])
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def print_report(results, args):
+    header = f"{'route':<24}{'req':>6}{'err':>5}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'q/req':>7}{'q max':>7}"
+    print()
+    print(f"users={args.users} items={args.items} years={args.years} logs/day={args.logs_per_day} "
+          f"concurrency={args.concurrency} requests/route={args.requests}  (latency: ms)")
+    print(header)
+    print("-" * len(header))
+    for summary in results:
+        print(f"{summary['route']:<24}{summary['requests']:>6}{summary['errors']:>5}{summary['rps']:>9}"
+              f"{summary['p50_ms']:>9}{summary['p95_ms']:>9}{summary['p99_ms']:>9}{summary['max_ms']:>9}"
+              f"{summary['queries_avg']:>7}{summary['queries_max']:>7}")
+
+
+async def main(args):
+    import httpx
+    from sqlalchemy import event
+
+    from app.main import app
+    from app.database import AsyncSessionLocal, async_engine
+    from bench.seed import seed_user, load_user, sample_log_ids
+
+    @event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+    def _count_query(conn, cursor, statement, parameters, context, executemany):
+        counter = _query_counter.get()
+        if counter is not None:
+            counter["queries"] += 1
+
+    if args.migrate:
+        from app.cli import migrate
+        migrate.main()
+
+    users = []
+    async with AsyncSessionLocal() as db:
+        for index in range(args.users):
+            if args.skip_seed:
+                users.append(await load_user(db, index))
+            else:
+                started = time.perf_counter()
+                users.append(await seed_user(db, index, args.items, args.years, args.logs_per_day))
+                print(f"seeded {users[-1]['email']} ({time.perf_counter() - started:.1f}s)")
+        users = [user for user in users if user["item_ids"]]
+        if not users:
+            print("ベンチマーク用ユーザーのデータがありません (--skip-seed を外して投入してください)")
+            return
+        # 更新・削除の対象にする記録ID (削除で消費されるため多めに確保する)
+        per_user = (args.requests + args.warmup) * 2 // len(users) + 10
+        state = {"log_ids": {user["id"]: await sample_log_ids(db, user["id"], per_user) for user in users}}
+
+    tokens = {user["id"]: mint_token(user) for user in users}
+    routes = [route for route in ROUTES if route in args.routes.split(",")]
+
+    summaries = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for route in routes:
+            if args.warmup:
+                await run_route(client, route, users, tokens, state, args.warmup, min(args.warmup, args.concurrency), record=False)
+            result = await run_route(client, route, users, tokens, state, args.requests, args.concurrency)
+            summaries.append(result.summary())
+            print(f"done: {route}")
+
+    await async_engine.dispose()
+
+    print_report(summaries, args)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"params": vars(args), "results": summaries}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    configure_environment(arguments)
+    asyncio.run(main(arguments))
@@ -0,0 +1,116 @@
+"""
+ベンチマーク用の合成データを投入する
+
+ユーザー数 × 項目数 × 年数分の記録を、ローカルの PostgreSQL に生成する。
+ベンチマーク用ユーザーの UUID はユーザー番号から決まるため、再投入時は同じユーザーのデータを作り直す。
+"""
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.services.hadbit_record_service import rebuild_daily_counts
+from app.services.hadbit_service import ORDER_GAP
+
+BENCH_NAMESPACE = uuid.UUID("6f1d2c1e-5b7a-4c8e-9a51-3d0f8b2e7c44")
+# 1種別あたりの項目数
+ITEMS_PER_PARENT = 5
+
+
+def bench_user_id(index: int) -> str:
+    return str(uuid.uuid5(BENCH_NAMESPACE, f"bench-user-{index}"))
+
+
+def bench_user_email(index: int) -> str:
+    return f"bench-user-{index}@example.com"
+
+
+async def clear_user(db: AsyncSession, user_id: str):
+    """
+    ベンチマーク用ユーザーの既存データを削除する
+    """
+    params = {"user_id": user_id}
+    await db.execute(text("DELETE FROM hadbit_logs WHERE user_id = :user_id"), params)
+    await db.execute(text("DELETE FROM hadbit_daily_counts WHERE user_id = :user_id"), params)
+    # hadbit_trees は hadbit_items の削除で連鎖削除される
+    await db.execute(text("DELETE FROM hadbit_items WHERE user_id = :user_id"), params)
+
+
+async def seed_user(db: AsyncSession, index: int, items: int, years: float, logs_per_day: int):
+    """
+    1ユーザー分の習慣マスタと記録を投入する
+    記録は直近 years 年間に、1日あたり logs_per_day 件を項目にランダムに割り振って生成する。
+    戻り値: {"index", "id", "email", "item_ids"}
+    """
+    user_id = bench_user_id(index)
+    await clear_user(db, user_id)
+
+    insert_item = text("""
+        INSERT INTO hadbit_items (user_id, name, short_name, description)
+        VALUES (:user_id, :name, :short_name, '')
+        RETURNING id
+    """)
+    insert_tree = text("""
+        INSERT INTO hadbit_trees (item_id, user_id, parent_id, order_no)
+        VALUES (:item_id, :user_id, :parent_id, :order_no)
+    """)
+
+    item_ids = []
+    parent_count = max(1, -(-items // ITEMS_PER_PARENT))
+    for p in range(parent_count):
+        parent_id = (await db.execute(insert_item, {"user_id": user_id, "name": f"種別{p + 1}", "short_name": f"種{p + 1}"})).scalar()
+        await db.execute(insert_tree, {"item_id": parent_id, "user_id": user_id, "parent_id": 0, "order_no": (p + 1) * ORDER_GAP})
+        for c in range(min(ITEMS_PER_PARENT, items - p * ITEMS_PER_PARENT)):
+            name = f"項目{p + 1}-{c + 1}"
+            child_id = (await db.execute(insert_item, {"user_id": user_id, "name": name, "short_name": name})).scalar()
+            await db.execute(insert_tree, {"item_id": child_id, "user_id": user_id, "parent_id": parent_id, "order_no": (c + 1) * ORDER_GAP})
+            item_ids.append(child_id)
+
+    # 記録はサーバー側で generate_series により生成する
+    end = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = end - timedelta(days=int(365 * years))
+    await db.execute(text("SELECT setseed(:seed)"), {"seed": (index % 1000) / 1000})
+    await db.execute(text("""
+        INSERT INTO hadbit_logs (user_id, item_id, done_at, comment)
+        SELECT
+            :user_id,
+            (CAST(:item_ids AS integer[]))[1 + floor(random() * :item_count)::int],
+            d + random() * interval '1 day',
+            CASE WHEN random() < 0.1 THEN 'bench' END
+        FROM generate_series(CAST(:start AS timestamp), CAST(:end AS timestamp), interval '1 day') AS d,
+             generate_series(1, :logs_per_day) AS k
+    """), {
+        "user_id": user_id,
+        "item_ids": item_ids,
+        "item_count": len(item_ids),
+        "start": start,
+        "end": end,
+        "logs_per_day": logs_per_day,
+    })
+    await rebuild_daily_counts(db, user_id)
+    await db.commit()
+    return {"index": index, "id": user_id, "email": bench_user_email(index), "item_ids": item_ids}
+
+
+async def load_user(db: AsyncSession, index: int):
+    """
+    投入済みのベンチマーク用ユーザーを読み込む (--skip-seed 用)
+    """
+    user_id = bench_user_id(index)
+    rows = (await db.execute(text("""
+        SELECT tree.item_id FROM hadbit_trees tree
+        WHERE tree.user_id = :user_id AND tree.parent_id <> 0
+        ORDER BY tree.item_id
+    """), {"user_id": user_id})).fetchall()
+    return {"index": index, "id": user_id, "email": bench_user_email(index), "item_ids": [row.item_id for row in rows]}
+
+
+async def sample_log_ids(db: AsyncSession, user_id: str, limit: int):
+    """
+    更新・削除の対象にする記録IDを無作為に取得する
+    """
+    rows = (await db.execute(text("""
+        SELECT id FROM hadbit_logs WHERE user_id = :user_id ORDER BY random() LIMIT :limit
+    """), {"user_id": user_id, "limit": limit})).fetchall()
+    return [row.id for row in rows]
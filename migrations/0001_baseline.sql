@@ -0,0 +1,66 @@
+-- 0001: 既存スキーマ (README.MD の DDL) のベースライン
+-- 既に Supabase 上に作成済みの環境でもそのまま適用できるよう、すべて IF NOT EXISTS で記述する
+
+create table if not exists public.hadbit_items (
+  id serial not null,
+  user_id uuid not null,
+  name text not null,
+  short_name text null,
+  description text null,
+  parent_flag boolean null default false,
+  public_flag boolean null default false,
+  visible_flag boolean null default true,
+  delete_flag boolean null default false,
+  updated_at timestamp without time zone not null default CURRENT_TIMESTAMP,
+  created_at timestamp without time zone not null default CURRENT_TIMESTAMP,
+  item_style jsonb null,
+  is_deleted boolean null default false,
+  constraint hadbit_items_pkey primary key (id)
+);
+
+alter table public.hadbit_items add column if not exists is_deleted boolean null default false;
+
+create index if not exists idx_hadbit_items_user_id on public.hadbit_items using btree (user_id);
+
+create table if not exists public.hadbit_trees (
+  item_id integer not null,
+  user_id uuid not null,
+  parent_id integer null,
+  order_no integer null,
+  constraint hadbit_trees_pkey primary key (item_id),
+  constraint fk_hadbit_trees_item_id foreign key (item_id) references hadbit_items (id) on delete cascade
+);
+
+create index if not exists idx_hadbit_trees_item_id on public.hadbit_trees using btree (item_id);
+
+create table if not exists public.hadbit_logs (
+  id serial not null,
+  user_id uuid not null,
+  item_id integer not null,
+  done_at timestamp without time zone null,
+  updated_at timestamp without time zone not null default CURRENT_TIMESTAMP,
+  created_at timestamp without time zone not null default CURRENT_TIMESTAMP,
+  comment text null,
+  constraint hadbit_logs_pkey primary key (id)
+);
+
+create index if not exists idx_hadbit_logs_user_id on public.hadbit_logs using btree (user_id);
+create index if not exists idx_hadbit_logs_item_id on public.hadbit_logs using btree (item_id);
+
+create table if not exists public.hadbit_daily_counts (
+  user_id uuid not null,
+  item_id integer not null,
+  day date not null,
+  count integer not null default 0,
+  constraint hadbit_daily_counts_pkey primary key (user_id, item_id, day)
+);
+
+create index if not exists idx_hadbit_daily_counts_user_day on public.hadbit_daily_counts using btree (user_id, day);
+
+create table if not exists public.mail_to_id (
+  id serial not null,
+  mail text not null,
+  constraint mail_to_id_pkey primary key (id)
+);
+
+create unique index if not exists uq_mail_to_id_mail on public.mail_to_id using btree (mail);
@@ -0,0 +1,19 @@
+-- migrate: no-transaction
+-- 0002: 実際のクエリに合わせた複合インデックス・部分インデックス
+-- 本番テーブルをロックしないよう CONCURRENTLY で作成する (トランザクション外で1文ずつ実行される)
+
+-- 記録一覧・カレンダー等: user_id で絞り込み、done_at の範囲指定 + done_at DESC (キーセットページングは id DESC も) で並べる
+create index concurrently if not exists idx_hadbit_logs_user_done_at on public.hadbit_logs using btree (user_id, done_at desc, id desc);
+
+-- 並び替え・移動: ユーザー・親ごとに order_no 順で兄弟を取得する
+create index concurrently if not exists idx_hadbit_trees_user_parent_order on public.hadbit_trees using btree (user_id, parent_id, order_no);
+
+-- get_hadbits: 親のツリーから子のツリーを parent_id で結合する
+create index concurrently if not exists idx_hadbit_trees_parent_order on public.hadbit_trees using btree (parent_id, order_no);
+
+-- 一覧系は論理削除されていない項目のみを対象とする
+create index concurrently if not exists idx_hadbit_items_user_active on public.hadbit_items using btree (user_id, id) where is_deleted = false;
+
+-- 上記の複合インデックスの先頭列・主キーと重複するため削除する
+drop index concurrently if exists public.idx_hadbit_logs_user_id;
+drop index concurrently if exists public.idx_hadbit_trees_item_id;
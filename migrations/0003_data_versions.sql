@@ -0,0 +1,59 @@
+-- 0003: ユーザーごとのデータバージョン (カレンダー・ヒートマップ・日付グリッドの ETag 用)
+-- hadbit_logs / hadbit_items / hadbit_trees が変更されるたびに、変更された行の user_id のバージョンを 1 上げる
+-- 文単位のトリガーのため、一括登録 (変換・インポート) でも1文につき1回の更新で済む
+
+create table if not exists public.hadbit_data_versions (
+  user_id uuid not null,
+  version bigint not null default 0,
+  updated_at timestamp without time zone not null default CURRENT_TIMESTAMP,
+  constraint hadbit_data_versions_pkey primary key (user_id)
+);
+
+create or replace function public.hadbit_bump_data_version() returns trigger
+language plpgsql as $$
+begin
+  if tg_op = 'DELETE' then
+    insert into public.hadbit_data_versions (user_id, version)
+    select distinct user_id, 1 from old_rows where user_id is not null order by user_id
+    on conflict (user_id) do update
+      set version = hadbit_data_versions.version + 1, updated_at = CURRENT_TIMESTAMP;
+  else
+    insert into public.hadbit_data_versions (user_id, version)
+    select distinct user_id, 1 from new_rows where user_id is not null order by user_id
+    on conflict (user_id) do update
+      set version = hadbit_data_versions.version + 1, updated_at = CURRENT_TIMESTAMP;
+  end if;
+  return null;
+end;
+$$;
+
+-- 遷移テーブル (new_rows / old_rows) を使うトリガーはイベントごとに定義する必要がある
+drop trigger if exists trg_hadbit_logs_version_ins on public.hadbit_logs;
+create trigger trg_hadbit_logs_version_ins after insert on public.hadbit_logs
+  referencing new table as new_rows for each statement execute function public.hadbit_bump_data_version();
+drop trigger if exists trg_hadbit_logs_version_upd on public.hadbit_logs;
+create trigger trg_hadbit_logs_version_upd after update on public.hadbit_logs
+  referencing new table as new_rows for each statement execute function public.hadbit_bump_data_version();
+drop trigger if exists trg_hadbit_logs_version_del on public.hadbit_logs;
+create trigger trg_hadbit_logs_version_del after delete on public.hadbit_logs
+  referencing old table as old_rows for each statement execute function public.hadbit_bump_data_version();
+
+drop trigger if exists trg_hadbit_items_version_ins on public.hadbit_items;
+create trigger trg_hadbit_items_version_ins after insert on public.hadbit_items
+  referencing new table as new_rows for each statement execute function public.hadbit_bump_data_version();
+drop trigger if exists trg_hadbit_items_version_upd on public.hadbit_items;
+create trigger trg_hadbit_items_version_upd after update on public.hadbit_items
+  referencing new table as new_rows for each statement execute function public.hadbit_bump_data_version();
+drop trigger if exists trg_hadbit_items_version_del on public.hadbit_items;
+create trigger trg_hadbit_items_version_del after delete on public.hadbit_items
+  referencing old table as old_rows for each statement execute function public.hadbit_bump_data_version();
+
+drop trigger if exists trg_hadbit_trees_version_ins on public.hadbit_trees;
+create trigger trg_hadbit_trees_version_ins after insert on public.hadbit_trees
+  referencing new table as new_rows for each statement execute function public.hadbit_bump_data_version();
+drop trigger if exists trg_hadbit_trees_version_upd on public.hadbit_trees;
+create trigger trg_hadbit_trees_version_upd after update on public.hadbit_trees
+  referencing new table as new_rows for each statement execute function public.hadbit_bump_data_version();
+drop trigger if exists trg_hadbit_trees_version_del on public.hadbit_trees;
+create trigger trg_hadbit_trees_version_del after delete on public.hadbit_trees
+  referencing old table as old_rows for each statement execute function public.hadbit_bump_data_version();
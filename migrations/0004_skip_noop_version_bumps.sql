@@ -0,0 +1,42 @@
+-- 0004: 値が変わらない UPDATE ではデータバージョンを上げない
+-- (保存ボタンを押しただけの更新で、ETag・描画済みHTMLのキャッシュが無効にならないようにする)
+
+create or replace function public.hadbit_bump_data_version() returns trigger
+language plpgsql as $$
+begin
+  if tg_op = 'DELETE' then
+    insert into public.hadbit_data_versions (user_id, version)
+    select distinct user_id, 1 from old_rows where user_id is not null order by user_id
+    on conflict (user_id) do update
+      set version = hadbit_data_versions.version + 1, updated_at = CURRENT_TIMESTAMP;
+  elsif tg_op = 'UPDATE' then
+    -- 更新前後で全く同じ行は除く
+    insert into public.hadbit_data_versions (user_id, version)
+    select distinct user_id, 1 from (
+      select * from new_rows
+      except all
+      select * from old_rows
+    ) changed
+    where user_id is not null order by user_id
+    on conflict (user_id) do update
+      set version = hadbit_data_versions.version + 1, updated_at = CURRENT_TIMESTAMP;
+  else
+    insert into public.hadbit_data_versions (user_id, version)
+    select distinct user_id, 1 from new_rows where user_id is not null order by user_id
+    on conflict (user_id) do update
+      set version = hadbit_data_versions.version + 1, updated_at = CURRENT_TIMESTAMP;
+  end if;
+  return null;
+end;
+$$;
+
+-- UPDATE のトリガーは更新前後の両方の遷移テーブルを参照する
+drop trigger if exists trg_hadbit_logs_version_upd on public.hadbit_logs;
+create trigger trg_hadbit_logs_version_upd after update on public.hadbit_logs
+  referencing old table as old_rows new table as new_rows for each statement execute function public.hadbit_bump_data_version();
+drop trigger if exists trg_hadbit_items_version_upd on public.hadbit_items;
+create trigger trg_hadbit_items_version_upd after update on public.hadbit_items
+  referencing old table as old_rows new table as new_rows for each statement execute function public.hadbit_bump_data_version();
+drop trigger if exists trg_hadbit_trees_version_upd on public.hadbit_trees;
+create trigger trg_hadbit_trees_version_upd after update on public.hadbit_trees
+  referencing old table as old_rows new table as new_rows for each statement execute function public.hadbit_bump_data_version();
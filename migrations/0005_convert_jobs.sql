@@ -0,0 +1,30 @@
+-- 0005: 旧システムからのデータ移行 (ConvertService) をバックグラウンドで分割実行するためのジョブ管理
+-- 移行の途中で失敗しても、コミット済みの位置 (phase / last_old_log_id) から再開できる
+
+create table if not exists public.hadbit_convert_jobs (
+  id serial not null,
+  user_id uuid not null,
+  old_user_id integer not null,
+  status text not null default 'pending',  -- pending / running / done / failed
+  phase text not null default 'clear',     -- clear (既存データ削除) / items (項目・階層) / logs (記録) / finish (集計) / done
+  items_count integer not null default 0,
+  total_logs integer not null default 0,
+  processed_logs integer not null default 0,
+  copied_logs integer not null default 0,
+  last_old_log_id integer not null default 0,
+  error text null,
+  created_at timestamp without time zone not null default CURRENT_TIMESTAMP,
+  updated_at timestamp without time zone not null default CURRENT_TIMESTAMP,
+  constraint hadbit_convert_jobs_pkey primary key (id)
+);
+
+create index if not exists idx_hadbit_convert_jobs_user_id on public.hadbit_convert_jobs using btree (user_id, id desc);
+
+-- 旧項目ID → 新項目ID の対応 (ジョブごとに1回だけ作成し、階層・記録の移行はこの表で結合する)
+create table if not exists public.hadbit_convert_item_map (
+  job_id integer not null,
+  old_item_id integer not null,
+  new_item_id integer not null,
+  constraint hadbit_convert_item_map_pkey primary key (job_id, old_item_id),
+  constraint fk_hadbit_convert_item_map_job_id foreign key (job_id) references hadbit_convert_jobs (id) on delete cascade
+);
@@ -0,0 +1,44 @@
+-- 0006: 習慣の階層 (hadbit_items / hadbit_trees) だけのバージョンを追加する
+-- 記録 (hadbit_logs) の登録・更新・削除では上がらないため、階層のキャッシュ (get_hadbits) は記録のたびに無効にならない
+-- version は従来どおり3テーブルすべての変更で上がる (ETag・描画済みHTML・統計のキャッシュ用)
+
+alter table public.hadbit_data_versions
+  add column if not exists hierarchy_version bigint not null default 0;
+
+create or replace function public.hadbit_bump_data_version() returns trigger
+language plpgsql as $$
+declare
+  -- 記録以外 (項目・階層) の変更の場合のみ hierarchy_version も上げる
+  hierarchy_step bigint := case when tg_table_name = 'hadbit_logs' then 0 else 1 end;
+begin
+  if tg_op = 'DELETE' then
+    insert into public.hadbit_data_versions (user_id, version, hierarchy_version)
+    select distinct user_id, 1, hierarchy_step from old_rows where user_id is not null order by user_id
+    on conflict (user_id) do update
+      set version = hadbit_data_versions.version + 1,
+          hierarchy_version = hadbit_data_versions.hierarchy_version + hierarchy_step,
+          updated_at = CURRENT_TIMESTAMP;
+  elsif tg_op = 'UPDATE' then
+    -- 更新前後で全く同じ行は除く
+    insert into public.hadbit_data_versions (user_id, version, hierarchy_version)
+    select distinct user_id, 1, hierarchy_step from (
+      select * from new_rows
+      except all
+      select * from old_rows
+    ) changed
+    where user_id is not null order by user_id
+    on conflict (user_id) do update
+      set version = hadbit_data_versions.version + 1,
+          hierarchy_version = hadbit_data_versions.hierarchy_version + hierarchy_step,
+          updated_at = CURRENT_TIMESTAMP;
+  else
+    insert into public.hadbit_data_versions (user_id, version, hierarchy_version)
+    select distinct user_id, 1, hierarchy_step from new_rows where user_id is not null order by user_id
+    on conflict (user_id) do update
+      set version = hadbit_data_versions.version + 1,
+          hierarchy_version = hadbit_data_versions.hierarchy_version + hierarchy_step,
+          updated_at = CURRENT_TIMESTAMP;
+  end if;
+  return null;
+end;
+$$;
@@ -0,0 +1,4 @@
+import os
+
+# テストではSQL実行数の予算超過・N+1 をエラーにする (app の import より前に設定する)
+os.environ.setdefault("QUERY_BUDGET_MODE", "raise")
@@ -0,0 +1,113 @@
+import asyncio
+from datetime import date, datetime, timezone
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.services import analytics_service, hadbit_record_service
+from app.services.analytics_service import compute_analytics, grouped_streaks
+
+
+def epoch(value: str) -> int:
+    # done_at (タイムゾーンなし) を UTC とみなしたエポック秒 (load_log_times と同じ)
+    return int(datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp())
+
+
+def test_grouped_streaks():
+    """
+    グループごとの連続日数の確認
+    1. 同じ日の複数の記録は1日として数える
+    2. 前日まで続いている連続は現在の連続日数に含め、それより前に途切れた連続は含めない
+    """
+    groups = np.array([0, 0, 0, 0, 0, 1, 1, 1])
+    days = np.array([1, 2, 2, 3, 9, 5, 6, 7])
+    current, longest = grouped_streaks(groups, days, 3, today=10)
+    assert current.tolist() == [1, 0, 0]
+    assert longest.tolist() == [3, 3, 0]
+
+
+def test_compute_analytics():
+    """
+    統計の集計の確認
+    1. 全体の連続日数・曜日/時間帯ごとの件数
+    2. 親項目ごとの件数・連続日数 (前日に実施した親項目は連続中。項目一覧に無い項目の記録は除く)
+    3. 今週の実施率は今日までの日数で割る
+    """
+    hadbits = [
+        {"parent_id": 10, "parent_name": "運動", "parent_short_name": "運", "child_id": 11},
+        {"parent_id": 10, "parent_name": "運動", "parent_short_name": "運", "child_id": 12},
+        {"parent_id": 20, "parent_name": "読書", "parent_short_name": "読", "child_id": 21},
+    ]
+    logs = [
+        ("2024-05-13 07:30:00", 11),  # 月
+        ("2024-05-14 07:10:00", 12),  # 火
+        ("2024-05-14 21:00:00", 21),
+        ("2024-05-15 07:45:00", 11),  # 水 (今日)
+        ("2024-05-01 12:00:00", 99),  # 項目一覧に無い項目
+    ]
+    times = np.array([epoch(t) for t, _ in logs], dtype=np.int64)
+    item_ids = np.array([item_id for _, item_id in logs], dtype=np.int64)
+
+    result = compute_analytics(times, item_ids, hadbits, date(2024, 5, 15))
+
+    assert result["total_logs"] == 5
+    assert result["active_days"] == 4
+    assert result["first_day"] == date(2024, 5, 1)
+    assert result["current_streak"] == 3
+    assert result["longest_streak"] == 3
+    assert [w["count"] for w in result["weekdays"]] == [1, 2, 2, 0, 0, 0, 0]
+    assert result["hours"][7]["count"] == 3
+    assert result["weekly"][-1] == {"label": "05/13", "active_days": 3, "days": 3, "rate": 100}
+    assert result["monthly"][-1] == {"label": "2024-05", "active_days": 4, "days": 15, "rate": 27}
+    assert result["by_parent"] == [
+        {"name": "運動", "total": 3, "active_days": 3, "recent_30": 3, "current_streak": 3, "longest_streak": 3},
+        {"name": "読書", "total": 1, "active_days": 1, "recent_30": 1, "current_streak": 1, "longest_streak": 1},
+    ]
+
+
+def test_compute_analytics_empty():
+    """
+    記録が無い場合もエラーにならず、すべて 0 になる
+    """
+    empty = np.zeros(0, dtype=np.int64)
+    result = compute_analytics(empty, empty, [], date(2024, 5, 15))
+    assert result["total_logs"] == 0
+    assert result["current_streak"] == 0
+    assert result["first_day"] is None
+    assert result["by_parent"] == []
+    assert all(w["rate"] == 0 for w in result["weekly"])
+
+
+def test_get_analytics_uses_jst_today(monkeypatch):
+    """
+    当日は日本時間で決まる
+    UTC ではまだ前日 (2024-05-14 20:00 UTC = 2024-05-15 05:00 JST) でも、日本時間の当日の記録が今週・今月に数えられる
+    """
+    class FixedDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime(2024, 5, 14, 20, 0, tzinfo=timezone.utc).astimezone(tz)
+
+    async def load_data_versions(db, user_id):
+        return 1, 1
+
+    async def get_hadbits(db, user, hierarchy_version=None):
+        return [{"parent_id": 10, "parent_name": "運動", "parent_short_name": "運", "child_id": 11}]
+
+    async def load_log_times(db, user_id):
+        times = [epoch("2024-05-14 07:00:00"), epoch("2024-05-15 04:30:00")]
+        return np.array(times, dtype=np.int64), np.array([11, 11], dtype=np.int64)
+
+    monkeypatch.setattr(hadbit_record_service, "datetime", FixedDatetime)
+    monkeypatch.setattr(analytics_service, "load_data_versions", load_data_versions)
+    monkeypatch.setattr(analytics_service, "get_hadbits", get_hadbits)
+    monkeypatch.setattr(analytics_service, "load_log_times", load_log_times)
+    monkeypatch.setattr(analytics_service, "_analytics_cache", analytics_service.LRUCache(maxsize=8))
+
+    result = asyncio.run(analytics_service.get_analytics(None, SimpleNamespace(id="user-1")))
+
+    assert result["current_streak"] == 2
+    assert result["weekly"][-1] == {"label": "05/13", "active_days": 2, "days": 3, "rate": 67}
+    assert result["monthly"][-1]["active_days"] == 2
+    assert result["monthly"][-1]["days"] == 15
+    assert analytics_service._analytics_cache.get(("user-1", 1, date(2024, 5, 15))) is result
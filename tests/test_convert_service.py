@@ -0,0 +1,138 @@
+import asyncio
+import uuid
+
+import pytest
+from sqlalchemy import text
+
+from app.database import AsyncSessionLocal, SessionLocal, async_engine
+from app.services import convert_service
+from app.services.convert_service import ConvertService
+
+
+@pytest.fixture
+def old_user():
+    """
+    旧テーブル (habit_items / habit_item_tree / habit_logs) のテストデータ (DBを使用。終了時に削除する)
+    親項目「運動」「勉強」の下に、同じ名前の子項目「朝」を1つずつ作り、記録を5件登録する
+    """
+    db = SessionLocal()
+    old_user_id = db.execute(text("SELECT COALESCE(MAX(user_id), 0) + 1000000 FROM habit_items")).scalar()
+    user_id = str(uuid.uuid4())
+    items = {}
+    for name in ("運動", "勉強", "運動/朝", "勉強/朝"):
+        items[name] = db.execute(text("""
+            INSERT INTO habit_items (user_id, name, short_name) VALUES (:uid, :name, :name) RETURNING id
+        """), {"uid": old_user_id, "name": name.split("/")[-1]}).scalar()
+    for name, item_id in items.items():
+        parent_id = items[name.split("/")[0]] if "/" in name else None
+        db.execute(text("INSERT INTO habit_item_tree (item_id, parent_id, order_no) VALUES (:iid, :pid, :ord)"), {
+            "iid": item_id, "pid": parent_id, "ord": item_id,
+        })
+    for day, name in enumerate(["運動/朝", "勉強/朝", "運動/朝", "勉強/朝", "運動/朝"], start=1):
+        db.execute(text("""
+            INSERT INTO habit_logs (user_id, item_id, done_at, comment) VALUES (:uid, :iid, :done_at, :comment)
+        """), {"uid": old_user_id, "iid": items[name], "done_at": f"2024-01-0{day} 07:00:00", "comment": name})
+    db.commit()
+    try:
+        yield db, old_user_id, user_id
+    finally:
+        db.rollback()
+        db.execute(text("DELETE FROM habit_logs WHERE user_id = :uid"), {"uid": old_user_id})
+        db.execute(text("DELETE FROM habit_item_tree WHERE item_id = ANY(:ids)"), {"ids": list(items.values())})
+        db.execute(text("DELETE FROM habit_items WHERE user_id = :uid"), {"uid": old_user_id})
+        for table in ("hadbit_convert_jobs", "hadbit_logs", "hadbit_daily_counts", "hadbit_trees", "hadbit_items", "hadbit_data_versions"):
+            db.execute(text(f"DELETE FROM {table} WHERE user_id = :uid"), {"uid": user_id})
+        db.commit()
+        db.close()
+
+
+def test_run_job_resumes_from_last_old_log_id(old_user, monkeypatch):
+    """
+    移行ジョブの再開の確認
+    1. 記録の移行の途中 (2チャンク目) で失敗すると、1チャンク目までがコミットされ last_old_log_id に旧IDが残る
+    2. 再実行すると last_old_log_id の続きから移行し、記録が重複・欠落しない
+    3. 同じ名前の項目も、旧項目IDの対応表で正しい親の項目に対応付けられる
+    """
+    db, old_user_id, user_id = old_user
+    monkeypatch.setattr(convert_service, "CONVERT_CHUNK_SIZE", 2)
+
+    # invalidate_fragments は既存データの削除後に1回、記録の移行の1チャンクごとに1回呼ばれる。3回目 (2チャンク目) で失敗させる
+    calls = []
+    invalidate_fragments = convert_service.invalidate_fragments
+
+    def fail_on_second_chunk(session, uid):
+        calls.append(uid)
+        if len(calls) == 3:
+            raise RuntimeError("connection lost")
+        invalidate_fragments(session, uid)
+
+    monkeypatch.setattr(convert_service, "invalidate_fragments", fail_on_second_chunk)
+
+    async def run():
+        try:
+            async with AsyncSessionLocal() as session:
+                job = await ConvertService.create_job(session, user_id, old_user_id)
+            failed = await ConvertService.run_job(job["id"])
+            done = await ConvertService.run_job(job["id"])
+            return failed, done
+        finally:
+            await async_engine.dispose()
+
+    failed, done = asyncio.run(run())
+    old_log_ids = db.execute(text("SELECT id FROM habit_logs WHERE user_id = :uid ORDER BY id"), {"uid": old_user_id}).scalars().all()
+
+    assert failed["status"] == "failed"
+    assert failed["phase"] == "logs"
+    assert failed["error"] == "connection lost"
+    assert failed["last_old_log_id"] == old_log_ids[1]
+    assert failed["copied_logs"] == 2
+
+    assert done["status"] == "done"
+    assert done["items_count"] == 4
+    assert done["processed_logs"] == 5
+    assert done["copied_logs"] == 5
+    rows = db.execute(text("""
+        SELECT logs.comment, pitem.name AS parent_name, citem.name AS item_name
+        FROM hadbit_logs logs
+        INNER JOIN hadbit_items citem ON citem.id = logs.item_id
+        INNER JOIN hadbit_trees tree ON tree.item_id = logs.item_id
+        INNER JOIN hadbit_items pitem ON pitem.id = tree.parent_id
+        WHERE logs.user_id = :uid
+        ORDER BY logs.done_at
+    """), {"uid": user_id}).fetchall()
+    assert [row.comment for row in rows] == ["運動/朝", "勉強/朝", "運動/朝", "勉強/朝", "運動/朝"]
+    assert all(row.comment == f"{row.parent_name}/{row.item_name}" for row in rows)
+
+
+def test_run_job_skips_job_locked_by_another_process(old_user):
+    """
+    更新日時が古くなっていても、他のプロセスがフェーズの途中 (アドバイザリロックを保持) の場合は再開しない
+    """
+    db, old_user_id, user_id = old_user
+
+    async def create_job():
+        try:
+            async with AsyncSessionLocal() as session:
+                return await ConvertService.create_job(session, user_id, old_user_id)
+        finally:
+            await async_engine.dispose()
+
+    job = asyncio.run(create_job())
+    db.execute(text("""
+        UPDATE hadbit_convert_jobs SET status = 'running', phase = 'items', updated_at = CURRENT_TIMESTAMP - interval '1 hour'
+        WHERE id = :job_id
+    """), {"job_id": job["id"]})
+    db.commit()
+
+    # 長い項目の移行のトランザクションの途中にある、別のプロセスの代わり
+    db.execute(text("SELECT pg_advisory_xact_lock(hashtext('hadbit_convert_jobs'), :job_id)"), {"job_id": job["id"]})
+
+    async def run():
+        try:
+            return await ConvertService.run_job(job["id"])
+        finally:
+            await async_engine.dispose()
+
+    assert asyncio.run(run()) is None
+    db.rollback()
+    assert db.execute(text("SELECT COUNT(*) FROM hadbit_items WHERE user_id = :uid"), {"uid": user_id}).scalar() == 0
@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+from sqlalchemy import text
+
+from app.database import AsyncSessionLocal, async_engine
+
+
+def test_query_timer_is_cleared_after_failed_statement():
+    """
+    失敗したSQLの開始時刻が残らず、次のSQLの時間計測に影響しない (DBを使用)
+    """
+    async def run():
+        try:
+            async with AsyncSessionLocal() as db:
+                with pytest.raises(Exception):
+                    await db.execute(text("SELECT * FROM table_that_does_not_exist"))
+                await db.rollback()
+                await db.execute(text("SELECT 1"))
+                connection = await db.connection()
+                return list(connection.sync_connection.info.get("query_start_time", []))
+        finally:
+            await async_engine.dispose()
+
+    assert asyncio.run(run()) == []
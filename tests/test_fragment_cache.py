@@ -0,0 +1,136 @@
+import asyncio
+import gzip
+from datetime import date, datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.requests import Request
+
+from app.dependencies import fragment_response
+from app.routers import hadbit_record_api
+from app.services import fragment_cache
+from app.services.cache import LRUCache
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    """
+    テストごとに空のキャッシュを使う (圧縮あり)
+    """
+    monkeypatch.setattr(fragment_cache, "FRAGMENT_CACHE_ENABLED", True)
+    monkeypatch.setattr(fragment_cache, "FRAGMENT_CACHE_COMPRESS", True)
+    monkeypatch.setattr(fragment_cache, "_fragment_cache", LRUCache(maxsize=16))
+
+
+def make_request(headers: dict) -> Request:
+    return Request({
+        "type": "http",
+        "method": "GET",
+        "path": "/",
+        "headers": [(key.lower().encode(), value.encode()) for key, value in headers.items()],
+    })
+
+
+def test_put_and_get_fragment():
+    """
+    同じユーザー・画面・バージョン・描画条件でのみキャッシュが使われる
+    """
+    fragment = fragment_cache.put_fragment("user-1", "records_day", 3, (date(2024, 5, 1), None), "<p>記録</p>")
+
+    assert fragment_cache.get_fragment("user-1", "records_day", 3, date(2024, 5, 1), None) is fragment
+    assert fragment.text() == "<p>記録</p>"
+    assert fragment_cache.get_fragment("user-1", "records_day", 4, date(2024, 5, 1), None) is None
+    assert fragment_cache.get_fragment("user-1", "records_day", 3, date(2024, 5, 2), None) is None
+    assert fragment_cache.get_fragment("user-2", "records_day", 3, date(2024, 5, 1), None) is None
+    # バージョンを取得できない場合はキャッシュしない
+    fragment_cache.put_fragment("user-1", "records", None, (), "<p>x</p>")
+    assert fragment_cache.get_fragment("user-1", "records", None) is None
+
+
+def test_invalidate_fragments_evicts_after_commit():
+    """
+    invalidate_fragments したユーザーのエントリは、コミット時に削除される (ロールバック時は残る)
+    """
+    fragment_cache.put_fragment("user-1", "records", 1, (), "<p>1</p>")
+    fragment_cache.put_fragment("user-2", "records", 1, (), "<p>2</p>")
+
+    async def run(finish):
+        async with AsyncSession() as db:
+            fragment_cache.invalidate_fragments(db, "user-1")
+            # コミットまでは残る
+            assert fragment_cache.get_fragment("user-1", "records", 1) is not None
+            await finish(db)
+
+    asyncio.run(run(lambda db: db.rollback()))
+    assert fragment_cache.get_fragment("user-1", "records", 1) is not None
+
+    asyncio.run(run(lambda db: db.commit()))
+    assert fragment_cache.get_fragment("user-1", "records", 1) is None
+    assert fragment_cache.get_fragment("user-2", "records", 1) is not None
+
+
+def test_fragment_response_gzip():
+    """
+    gzip を受け付けるクライアントには圧縮済みのまま、それ以外には展開して返す
+    """
+    fragment = fragment_cache.put_fragment("user-1", "records", 1, (), "<p>記録</p>")
+
+    response = fragment_response(make_request({"Accept-Encoding": "gzip, deflate"}), fragment)
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert gzip.decompress(response.body).decode("utf-8") == "<p>記録</p>"
+
+    response = fragment_response(make_request({}), fragment)
+    assert "content-encoding" not in response.headers
+    assert response.body.decode("utf-8") == "<p>記録</p>"
+
+
+def test_render_day_cards(monkeypatch):
+    """
+    変更のあった日付カードの OOB swap
+    1. 記録の残る日は置き換え、記録がなくなった日は削除
+    2. その日の最初の記録は、直前の日付カードの前 (最も古い日付なら #records-end の前) に差し込む
+    3. 同じバージョン・変更内容では描画済みのHTMLを返す
+    """
+    def log(log_id, day):
+        return SimpleNamespace(
+            log_id=log_id, done_at=datetime.combine(day, datetime.min.time()), comment=None,
+            parent_item_id=10, parent_short_name="運", child_short_name="走",
+        )
+
+    logs = {
+        date(2024, 5, 3): [log(1, date(2024, 5, 3)), log(2, date(2024, 5, 3))],
+        date(2024, 5, 2): [],
+        date(2024, 5, 4): [log(3, date(2024, 5, 4))],
+        date(2024, 5, 1): [log(4, date(2024, 5, 1))],
+    }
+    previous_days = {date(2024, 5, 4): date(2024, 5, 3), date(2024, 5, 1): None}
+    loaded = []
+
+    async def load_data_version(db, user_id):
+        return 7
+
+    async def get_logs_for_day(db, user_id, day):
+        loaded.append(day)
+        return logs[day]
+
+    async def get_previous_log_day(db, user_id, day):
+        return previous_days[day]
+
+    monkeypatch.setattr(hadbit_record_api, "load_data_version", load_data_version)
+    monkeypatch.setattr(hadbit_record_api, "get_logs_for_day", get_logs_for_day)
+    monkeypatch.setattr(hadbit_record_api, "get_previous_log_day", get_previous_log_day)
+
+    changes = [(date(2024, 5, 3), True), (date(2024, 5, 2), False), (date(2024, 5, 4), True), (date(2024, 5, 1), True)]
+    html = asyncio.run(hadbit_record_api.render_day_cards(None, "user-1", changes)).text()
+
+    assert 'id="day-2024-05-03"' in html and 'hx-swap-oob="true"' in html
+    assert '<div id="day-2024-05-02" hx-swap-oob="delete"></div>' in html
+    assert 'hx-swap-oob="beforebegin:#day-2024-05-03"' in html
+    assert 'hx-swap-oob="beforebegin:#records-end"' in html
+
+    loaded.clear()
+    again = asyncio.run(hadbit_record_api.render_day_cards(None, "user-1", changes)).text()
+    assert again == html
+    assert loaded == []
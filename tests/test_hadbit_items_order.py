@@ -0,0 +1,128 @@
+import asyncio
+import uuid
+
+import pytest
+from sqlalchemy import text
+
+from app.database import AsyncSessionLocal, SessionLocal, async_engine
+from app.services.hadbit_service import move_hadbit_item
+from app.services.data_version_service import get_data_versions
+
+
+@pytest.fixture
+def children():
+    """
+    親項目の下に子項目 A, B, C, D を作る (B は削除済み)。終了時に削除する (DBを使用)
+    戻り値: (db, user_id, {名前: 項目ID})
+    """
+    db = SessionLocal()
+    user_id = str(uuid.uuid4())
+    ids = {}
+    for name in ("P", "A", "B", "C", "D"):
+        ids[name] = db.execute(text("""
+            INSERT INTO hadbit_items (user_id, name, short_name, is_deleted) VALUES (:uid, :name, :name, :deleted) RETURNING id
+        """), {"uid": user_id, "name": name, "deleted": name == "B"}).scalar()
+    db.execute(text("INSERT INTO hadbit_trees (item_id, user_id, parent_id, order_no) VALUES (:iid, :uid, 0, 1024)"), {"iid": ids["P"], "uid": user_id})
+    for order_no, name in enumerate(("A", "B", "C", "D"), start=1):
+        db.execute(text("INSERT INTO hadbit_trees (item_id, user_id, parent_id, order_no) VALUES (:iid, :uid, :pid, :ord)"), {
+            "iid": ids[name], "uid": user_id, "pid": ids["P"], "ord": order_no * 1024,
+        })
+    db.commit()
+    try:
+        yield db, user_id, ids
+    finally:
+        db.rollback()
+        for table in ("hadbit_logs", "hadbit_daily_counts", "hadbit_trees", "hadbit_items", "hadbit_data_versions"):
+            db.execute(text(f"DELETE FROM {table} WHERE user_id = :uid"), {"uid": user_id})
+        db.commit()
+        db.close()
+
+
+def visible_order(db, user_id, ids):
+    names = {item_id: name for name, item_id in ids.items()}
+    rows = db.execute(text("""
+        SELECT t.item_id FROM hadbit_trees t
+        INNER JOIN hadbit_items i ON i.id = t.item_id AND i.is_deleted = false
+        WHERE t.user_id = :uid AND t.parent_id = :pid
+        ORDER BY t.order_no, t.item_id
+    """), {"uid": user_id, "pid": ids["P"]}).scalars().all()
+    return [names[item_id] for item_id in rows]
+
+
+def move(user_id, item_id, position):
+    async def run():
+        try:
+            async with AsyncSessionLocal() as session:
+                result = await move_hadbit_item(session, user_id, item_id, position=position)
+                await session.commit()
+                return result
+        finally:
+            await async_engine.dispose()
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("gap", [1024, 1])
+def test_move_hadbit_item_skips_deleted_sibling(children, gap):
+    """
+    移動先の位置は画面に表示される兄弟の中で数える (削除済みの B は数えない)
+    gap=1 は order_no に間隔が無く、兄弟全体の振り直しになる場合
+    """
+    db, user_id, ids = children
+    for order_no, name in enumerate(("A", "B", "C", "D"), start=1):
+        db.execute(text("UPDATE hadbit_trees SET order_no = :ord WHERE item_id = :iid"), {"ord": order_no * gap, "iid": ids[name]})
+    db.commit()
+
+    # 表示上 A, C, D の A を2番目 (position=1) へ
+    assert move(user_id, ids["A"], 1) == 1
+    assert visible_order(db, user_id, ids) == ["C", "A", "D"]
+
+    # D を先頭へ
+    assert move(user_id, ids["D"], 0) == 0
+    assert visible_order(db, user_id, ids) == ["D", "C", "A"]
+
+
+def test_move_hadbit_item_skips_childless_parent(children):
+    """
+    親項目 (種別) の位置は、子項目のない (画面に表示されない) 親項目を数えない
+    """
+    db, user_id, ids = children
+    for name, order_no in (("Q", 2048), ("R", 3072), ("E", 1024)):
+        ids[name] = db.execute(text("INSERT INTO hadbit_items (user_id, name, short_name) VALUES (:uid, :name, :name) RETURNING id"), {
+            "uid": user_id, "name": name,
+        }).scalar()
+        parent_id = ids["R"] if name == "E" else 0
+        db.execute(text("INSERT INTO hadbit_trees (item_id, user_id, parent_id, order_no) VALUES (:iid, :uid, :pid, :ord)"), {
+            "iid": ids[name], "uid": user_id, "pid": parent_id, "ord": order_no,
+        })
+    db.commit()
+
+    # 表示上 P, R の P を2番目 (position=1) へ
+    assert move(user_id, ids["P"], 1) == 1
+    rows = db.execute(text("SELECT item_id FROM hadbit_trees WHERE user_id = :uid AND parent_id = 0 AND item_id <> :q ORDER BY order_no, item_id"), {
+        "uid": user_id, "q": ids["Q"],
+    }).scalars().all()
+    assert rows == [ids["R"], ids["P"]]
+
+
+def test_hierarchy_version_ignores_log_changes(children):
+    """
+    記録の登録では階層のバージョンは変わらない (get_hadbits のキャッシュが無効にならない)。項目の移動では変わる
+    """
+    db, user_id, ids = children
+
+    def versions():
+        async def run():
+            try:
+                async with AsyncSessionLocal() as session:
+                    return await get_data_versions(session, user_id)
+            finally:
+                await async_engine.dispose()
+        return asyncio.run(run())
+
+    version, hierarchy_version = versions()
+    db.execute(text("INSERT INTO hadbit_logs (user_id, item_id, done_at) VALUES (:uid, :iid, CURRENT_TIMESTAMP)"), {"uid": user_id, "iid": ids["A"]})
+    db.commit()
+    assert versions() == (version + 1, hierarchy_version)
+
+    move(user_id, ids["A"], 2)
+    assert versions() == (version + 2, hierarchy_version + 1)
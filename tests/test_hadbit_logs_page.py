@@ -0,0 +1,67 @@
+import asyncio
+import uuid
+from datetime import datetime
+
+from sqlalchemy import text
+
+from app.database import AsyncSessionLocal, SessionLocal, async_engine
+from app.services.hadbit_record_service import get_logs_page
+
+# テスト用のユーザー (実行ごとに別のユーザーにし、終了時にデータを削除する)
+USER_ID = str(uuid.uuid4())
+
+
+def test_get_logs_page_skips_null_done_at():
+    """
+    記録一覧のページ取得の確認
+    1. done_at が NULL の記録があっても、日付つきの記録だけが (done_at, id) の降順で返る
+    2. 最終ページでは次ページ取得用のカーソルが None になる
+    """
+    db = SessionLocal()
+    try:
+        parent_id = db.execute(text("""
+            INSERT INTO hadbit_items (user_id, name, short_name) VALUES (:uid, 'Test Parent', 'P') RETURNING id
+        """), {"uid": USER_ID}).scalar()
+        child_id = db.execute(text("""
+            INSERT INTO hadbit_items (user_id, name, short_name) VALUES (:uid, 'Test Child', 'C') RETURNING id
+        """), {"uid": USER_ID}).scalar()
+        db.execute(text("""
+            INSERT INTO hadbit_trees (item_id, user_id, parent_id, order_no)
+            VALUES (:parent_id, :uid, 0, 1024), (:child_id, :uid, :parent_id, 1024)
+        """), {"uid": USER_ID, "parent_id": parent_id, "child_id": child_id})
+        db.execute(text("""
+            INSERT INTO hadbit_logs (user_id, item_id, done_at, comment)
+            VALUES (:uid, :iid, NULL, 'no date'), (:uid, :iid, :d1, 'day1'), (:uid, :iid, :d2, 'day2')
+        """), {"uid": USER_ID, "iid": child_id, "d1": datetime(2025, 1, 1, 10, 0), "d2": datetime(2025, 1, 2, 10, 0)})
+        db.commit()
+
+        async def fetch_page():
+            try:
+                async with AsyncSessionLocal() as session:
+                    return await get_logs_page(session, USER_ID, limit=1)
+            finally:
+                await async_engine.dispose()
+
+        logs, cursor = asyncio.run(fetch_page())
+        assert [log.comment for log in logs] == ["day2"]
+        assert cursor == (datetime(2025, 1, 2, 10, 0), logs[0].log_id)
+
+        async def fetch_next_page():
+            try:
+                async with AsyncSessionLocal() as session:
+                    return await get_logs_page(session, USER_ID, *cursor, limit=1)
+            finally:
+                await async_engine.dispose()
+
+        logs, cursor = asyncio.run(fetch_next_page())
+        assert [log.comment for log in logs] == ["day1"]
+        assert cursor is None
+    finally:
+        db.rollback()
+        db.execute(text("DELETE FROM hadbit_logs WHERE user_id = :uid"), {"uid": USER_ID})
+        db.execute(text("DELETE FROM hadbit_daily_counts WHERE user_id = :uid"), {"uid": USER_ID})
+        db.execute(text("DELETE FROM hadbit_trees WHERE user_id = :uid"), {"uid": USER_ID})
+        db.execute(text("DELETE FROM hadbit_items WHERE user_id = :uid"), {"uid": USER_ID})
+        db.execute(text("DELETE FROM hadbit_data_versions WHERE user_id = :uid"), {"uid": USER_ID})
+        db.commit()
+        db.close()
@@ -5,7 +5,7 @@ from datetime import datetime
 
 # アプリケーションのインポート（パスは環境に合わせて調整してください）
 from app.main import app
-from app.database import get_db
+from app.database import SessionLocal
 from app.dependencies import get_current_user
 
 # テスト用クライアントの作成
@@ -31,8 +31,8 @@ def test_update_record_endpoint():
     3. レスポンスとDBの値を確認
     4. テストデータを削除
     """
-    # DBセッションを取得
-    db = next(get_db())
+    # DBセッションを取得 (データ準備・検証は同期セッションで行う)
+    db = SessionLocal()
     
     item_id = None
     log_id = None
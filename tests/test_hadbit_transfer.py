@@ -0,0 +1,86 @@
+import asyncio
+import io
+import uuid
+from datetime import datetime
+
+from sqlalchemy import text
+
+from app.database import AsyncSessionLocal, SessionLocal, async_engine
+from app.services.hadbit_transfer_service import import_logs, parse_done_at, read_import_rows
+
+
+def test_parse_done_at():
+    """
+    インポートの日時の変換の確認
+    1. タイムゾーンなしの日時はそのまま (日本時間として扱う)
+    2. タイムゾーン付きの日時は日本時間に変換し、タイムゾーンを外す
+    """
+    assert parse_done_at("2024-01-01 10:00:00") == datetime(2024, 1, 1, 10, 0, 0)
+    assert parse_done_at(" 2024-01-01T00:00:00+00:00 ") == datetime(2024, 1, 1, 9, 0, 0)
+
+
+def test_read_import_rows():
+    """
+    インポートファイルの読み込みの確認
+    1. CSV は BOM 付きでもヘッダーを列名として読み、行番号はヘッダーを1行目として数える
+    2. NDJSON は空行を飛ばす
+    3. 読み終えた後も元のファイルは閉じず、seek して読み直せる
+    4. JSON として読めない行・オブジェクトでない行・値が文字列でない行は、エラーの内容を返して読み進める
+    """
+    file = io.BytesIO("\ufeffdone_at,parent_name,item_name,comment\n2024-01-01 10:00,運動,ランニング,朝\n".encode("utf-8"))
+    rows = list(read_import_rows(file, "csv"))
+    assert rows == [(2, {"done_at": "2024-01-01 10:00", "parent_name": "運動", "item_name": "ランニング", "comment": "朝"}, None)]
+    file.seek(0)
+    assert list(read_import_rows(file, "csv")) == rows
+
+    file = io.BytesIO('{"type": "item", "parent_name": null, "name": "運動"}\n\n{"type": "log", "done_at": "2024-01-01T10:00:00"}\n'.encode("utf-8"))
+    rows = list(read_import_rows(file, "ndjson"))
+    assert [line_no for line_no, _, _ in rows] == [1, 3]
+    assert rows[1][1]["type"] == "log"
+
+    file = io.BytesIO('{"done_at": \n[1]\n{"done_at": 20240101}\n'.encode("utf-8"))
+    rows = list(read_import_rows(file, "ndjson"))
+    assert [(line_no, row) for line_no, row, _ in rows] == [(1, None), (2, None), (3, None)]
+    assert rows[2][2] == "done_at は文字列で指定してください"
+
+
+def test_import_logs_skips_bad_rows():
+    """
+    不正な行が混ざったファイルのインポートの確認 (DBを使用)
+    1. 正しい行だけが登録され、不正な行は行番号付きでエラーとして返る
+    2. 未登録の項目は作成される
+    """
+    user_id = str(uuid.uuid4())
+    file = io.BytesIO("\n".join([
+        '{"type": "log", "done_at": "2024-01-01T10:00:00", "parent_name": "運動", "item_name": "ランニング"}',
+        '{"type": "log", "done_at": ',
+        '[1]',
+        '{"type": "log", "done_at": 20240101, "parent_name": "運動", "item_name": "ランニング"}',
+        '{"type": "log", "done_at": "yesterday", "parent_name": "運動", "item_name": "ランニング"}',
+        '{"type": "log", "done_at": "2024-01-02T10:00:00", "item_name": "ランニング"}',
+        '{"type": "log", "done_at": "2024-01-02T10:00:00", "parent_name": "運動", "item_name": "ランニング", "comment": "朝"}',
+    ]).encode("utf-8"))
+
+    async def run_import():
+        try:
+            async with AsyncSessionLocal() as db:
+                result = await import_logs(db, user_id, file, "ndjson")
+                await db.commit()
+                return result
+        finally:
+            await async_engine.dispose()
+
+    db = SessionLocal()
+    try:
+        result = asyncio.run(run_import())
+        assert result["imported"] == 2
+        assert result["created_items"] == 2
+        assert result["skipped"] == 5
+        assert [error.split(":")[0] for error in result["errors"]] == ["2行目", "3行目", "4行目", "5行目", "6行目"]
+        comments = db.execute(text("SELECT comment FROM hadbit_logs WHERE user_id = :uid ORDER BY done_at"), {"uid": user_id}).scalars().all()
+        assert comments == [None, "朝"]
+    finally:
+        for table in ("hadbit_logs", "hadbit_daily_counts", "hadbit_trees", "hadbit_items", "hadbit_data_versions"):
+            db.execute(text(f"DELETE FROM {table} WHERE user_id = :uid"), {"uid": user_id})
+        db.commit()
+        db.close()
@@ -0,0 +1,41 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+from app.services.hadbit_record_service import encode_logs_payload
+
+
+def test_encode_logs_payload():
+    """
+    記録の辞書エンコードの確認
+    1. 項目名は items に1回だけ入り、記録は列ごとの配列になる
+    2. コメントは重複を除いた comments への添字になり、空のコメントは null になる
+    3. 項目一覧に無い項目の記録は除かれる
+    """
+    row = SimpleNamespace(
+        log_ids=[3, 2, 1, 9],
+        times=[1700000300, 1700000200, 1700000100, 1700000000],
+        item_ids=[11, 12, 11, 99],
+        comments=["memo", None, "memo", "orphan"],
+        dict_item_ids=[10, 11, 12],
+        dict_names=["運動", "ランニング", "スクワット"],
+        dict_short_names=["運", None, "スク"],
+        dict_parent_ids=[0, 10, 10],
+    )
+    payload = encode_logs_payload(row, datetime(2024, 1, 1), datetime(2024, 12, 31, 23, 59, 59))
+
+    assert payload["items"]["11"] == {"name": "ランニング", "short_name": None, "parent_id": 10}
+    assert payload["logs"] == {
+        "id": [3, 2, 1],
+        "t": [1700000300, 1700000200, 1700000100],
+        "item": [11, 12, 11],
+        "comment": [0, None, 0],
+    }
+    assert payload["comments"] == ["memo"]
+    assert payload["start"] == "2024-01-01T00:00:00"
+
+    empty = SimpleNamespace(
+        log_ids=[], times=[], item_ids=[], comments=[],
+        dict_item_ids=[], dict_names=[], dict_short_names=[], dict_parent_ids=[],
+    )
+    payload = encode_logs_payload(empty, datetime(2024, 1, 1), datetime(2024, 12, 31))
+    assert payload["logs"]["id"] == [] and payload["items"] == {}
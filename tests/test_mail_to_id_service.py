@@ -0,0 +1,72 @@
+import asyncio
+import uuid
+
+import pytest
+from sqlalchemy import text
+
+from app.database import AsyncSessionLocal, SessionLocal, async_engine
+from app.services import mail_to_id_service
+from app.services.cache import LRUCache
+
+
+@pytest.fixture
+def mail(monkeypatch):
+    """
+    テスト用のメールアドレス。キャッシュは空にし、終了時に mail_to_id から削除する (DBを使用)
+    """
+    monkeypatch.setattr(mail_to_id_service, "_mail_id_cache", LRUCache(maxsize=8))
+    mail = f"{uuid.uuid4()}@example.com"
+    try:
+        yield mail
+    finally:
+        with SessionLocal() as db:
+            db.execute(text("DELETE FROM mail_to_id WHERE mail = :mail"), {"mail": mail})
+            db.commit()
+
+
+def test_resolve_mail_id_concurrent_insert(mail):
+    """
+    同じメールアドレスを他のトランザクションが同時に追加した場合も、そのIDを返す
+    """
+    async def run():
+        try:
+            async with AsyncSessionLocal() as other, AsyncSessionLocal() as db:
+                other_id = (await other.execute(text("INSERT INTO mail_to_id (mail) VALUES (:mail) RETURNING id"), {"mail": mail})).scalar()
+                # 一意制約の確認で、other のコミットまで待たされる
+                task = asyncio.create_task(mail_to_id_service.resolve_mail_id(db, mail))
+                await asyncio.sleep(0.3)
+                assert not task.done()
+                await other.commit()
+                return other_id, await task
+        finally:
+            await async_engine.dispose()
+
+    other_id, mail_id = asyncio.run(run())
+    assert mail_id == other_id
+
+
+def test_resolve_mail_id_commits_only_on_insert(mail):
+    """
+    新規追加した場合のみコミットし、既存のメールアドレスではコミットしない
+    """
+    async def run():
+        try:
+            async with AsyncSessionLocal() as db:
+                commits = []
+                original_commit = db.commit
+
+                async def commit():
+                    commits.append(True)
+                    await original_commit()
+
+                db.commit = commit
+                created_id = await mail_to_id_service.resolve_mail_id(db, mail)
+                mail_to_id_service._mail_id_cache.clear()
+                found_id = await mail_to_id_service.resolve_mail_id(db, mail)
+                return created_id, found_id, len(commits)
+        finally:
+            await async_engine.dispose()
+
+    created_id, found_id, commits = asyncio.run(run())
+    assert created_id == found_id
+    assert commits == 1
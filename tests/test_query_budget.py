@@ -0,0 +1,78 @@
+import pytest
+
+from app.services import query_budget
+
+
+def test_query_budget_detects_overrun_and_repeats(monkeypatch):
+    """
+    SQL実行数の予算チェックと N+1 検出の動作確認
+    1. 予算内で繰り返しもなければ問題なし
+    2. 予算を超えると検出される
+    3. 同じSQL (空白の違いは無視) が閾値回数以上実行されると検出される
+    4. raise モードでは QueryBudgetExceeded が送出される
+    """
+    @query_budget.query_budget(3)
+    async def endpoint():
+        pass
+
+    assert query_budget.budget_for(endpoint) == 3
+
+    record, token = query_budget.start_request()
+    try:
+        query_budget.record_statement("SELECT 1")
+        query_budget.record_statement("SELECT 2")
+    finally:
+        query_budget.end_request(token)
+    assert record.count == 2
+    assert query_budget.find_problems(record, 3) == []
+
+    # リクエスト外の実行は記録されない
+    query_budget.record_statement("SELECT 3")
+    assert record.count == 2
+
+    record.add("SELECT 3")
+    record.add("SELECT 4")
+    assert len(query_budget.find_problems(record, 3)) == 1
+
+    repeated = query_budget.QueryRecord()
+    for _ in range(5):
+        repeated.add("SELECT * FROM hadbit_logs\n  WHERE id = %(id)s")
+    repeated.add("SELECT *   FROM hadbit_logs WHERE id = %(id)s")
+    problems = query_budget.find_problems(repeated, budget=None, repeat_threshold=5)
+    assert len(problems) == 1 and "6 回" in problems[0]
+
+    monkeypatch.setattr(query_budget, "QUERY_BUDGET_MODE", "raise")
+    with pytest.raises(query_budget.QueryBudgetExceeded):
+        query_budget.check("GET /test", record, endpoint)
+
+
+def test_query_budget_counts_streamed_statements(monkeypatch):
+    """
+    StreamingResponse の本文の生成中に実行されたSQLも、送信後に予算のチェック対象になる
+    """
+    from fastapi import FastAPI
+    from fastapi.responses import StreamingResponse
+    from fastapi.testclient import TestClient
+
+    from app.main import enforce_query_budget
+
+    monkeypatch.setattr(query_budget, "QUERY_BUDGET_MODE", "raise")
+    app = FastAPI()
+    app.middleware("http")(enforce_query_budget)
+
+    async def body(statements):
+        yield "<p>"
+        for i in range(statements):
+            query_budget.record_statement(f"SELECT {i}")
+        yield "</p>"
+
+    @app.get("/stream/{statements}")
+    @query_budget.query_budget(1)
+    async def stream(statements: int):
+        query_budget.record_statement("SELECT user")
+        return StreamingResponse(body(statements), media_type="text/html")
+
+    client = TestClient(app)
+    assert client.get("/stream/0").text == "<p></p>"
+    with pytest.raises(query_budget.QueryBudgetExceeded):
+        client.get("/stream/1")
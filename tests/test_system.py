@@ -0,0 +1,23 @@
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.routers import system
+
+client = TestClient(app)
+
+
+def test_metrics_requires_token(monkeypatch):
+    """
+    /metrics の公開範囲の確認
+    1. METRICS_TOKEN が未設定の場合は 404
+    2. 設定した場合は Authorization: Bearer <METRICS_TOKEN> が一致するときだけ参照できる
+    """
+    monkeypatch.setattr(system, "METRICS_TOKEN", "")
+    assert client.get("/metrics").status_code == 404
+
+    monkeypatch.setattr(system, "METRICS_TOKEN", "s3cret")
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    response = client.get("/metrics", headers={"Authorization": "Bearer s3cret"})
+    assert response.status_code == 200
+    assert "db_pool_overflow_total" in response.json()
@@ -0,0 +1,45 @@
+import time
+from jose import jwt
+
+from app.services import token_service
+
+SECRET = "test-jwt-secret"
+
+
+def make_token(exp_in: int, sub: str = "00000000-0000-0000-0000-000000000001"):
+    claims = {
+        "sub": sub,
+        "email": "test@example.com",
+        "aud": "authenticated",
+        "exp": int(time.time()) + exp_in,
+        "user_metadata": {},
+    }
+    return jwt.encode(claims, SECRET, algorithm="HS256")
+
+
+def test_authenticate_locally(monkeypatch):
+    """
+    ローカル検証とキャッシュの動作確認
+    1. 有効なトークンはローカル検証され、キャッシュされる
+    2. 期限切れのトークンはリモート問い合わせ不要として None になる
+    3. 期限間近のトークンはリモート問い合わせが必要と判定される
+    """
+    monkeypatch.setattr(token_service, "SUPABASE_JWT_SECRET", SECRET)
+    token_service._token_cache.clear()
+
+    token = make_token(3600)
+    user, needs_remote = token_service.authenticate_locally(token)
+    assert user is not None and not needs_remote
+    assert user.email == "test@example.com"
+    assert token_service.get_cached_user(token) is user
+
+    user, needs_remote = token_service.authenticate_locally(make_token(-10))
+    assert user is None and not needs_remote
+
+    user, needs_remote = token_service.authenticate_locally(make_token(10))
+    assert user is None and needs_remote
+
+    # 署名が異なるトークンはローカルで判定できないためリモートに回す
+    forged = jwt.encode({"sub": "x", "aud": "authenticated", "exp": int(time.time()) + 3600}, "other", algorithm="HS256")
+    user, needs_remote = token_service.authenticate_locally(forged)
+    assert user is None and needs_remote